@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+'''
+Append-only key/value log, used for the morph cache.
+
+Every put() appends one small record to the log file instead of rewriting the whole file.
+The index (Map Key Offset) lives in memory and is checkpointed to `<path>.idx`, so opening a
+log only reads the index plus the records appended after the last checkpoint. Values are
+unpickled when they are first asked for.
+
+Records carry a crc; a torn record at the end of the file (crash during a write) is cut off
+when the log is opened. Overwritten records stay in the file until the log is compacted.
+'''
+import os, pickle, struct, zlib
+
+LOG_MAGIC       = b'MMLOG1\n'
+HEADER          = struct.Struct( '<8s' )      # generation, changes whenever the file is rewritten
+RECORD_HEADER   = struct.Struct( '<III' )     # key length, value length, crc32 of key and value
+COMPACT_MIN_DEAD = 10000                     # don't bother compacting small logs
+
+class AppendLog:
+    def __init__( self, path ): # FilePath -> IO ()
+        self.path       = path
+        self.idxPath    = path + '.idx'
+        self.index      = {}    # Map Key Offset
+        self.dead       = 0     # number of overwritten records still in the file
+        self._open()
+
+    ############################################################################
+    ## Opening
+    ############################################################################
+    def _open( self ): # IO ()
+        if not os.path.exists( self.path ):
+            self._create( self.path )
+        with open( self.path, 'rb' ) as f:
+            magic, gen = f.read( len( LOG_MAGIC ) ), f.read( HEADER.size )
+        if magic != LOG_MAGIC or len( gen ) != HEADER.size:
+            raise IOError( 'Not a MorphMan log file: %s' % self.path )
+        self.generation = HEADER.unpack( gen )[0]
+
+        start = self._loadIndex()
+        end = self._scan( start )
+        if end < os.path.getsize( self.path ): # torn write at the end
+            with open( self.path, 'r+b' ) as f:
+                f.truncate( end )
+        self.size = self.flushedSize = end
+        self.reader = open( self.path, 'rb' )
+        self.writer = open( self.path, 'ab' )
+
+    def _create( self, path ): # FilePath -> IO Bytes
+        gen = os.urandom( 8 )
+        with open( path, 'wb' ) as f:
+            f.write( LOG_MAGIC + HEADER.pack( gen ) )
+            f.flush()
+            os.fsync( f.fileno() )
+        return gen
+
+    def _loadIndex( self ): # IO Offset
+        '''Loads the last checkpoint and returns the offset where records after it start'''
+        dataStart = len( LOG_MAGIC ) + HEADER.size
+        try:
+            with open( self.idxPath, 'rb' ) as f:
+                gen, size, dead, index = pickle.load( f )
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return dataStart
+        # an index from before a compaction or for a shorter file (eg. restored backup) is useless
+        if gen != self.generation or size > os.path.getsize( self.path ):
+            return dataStart
+        self.index, self.dead = index, dead
+        return size
+
+    def _scan( self, start ): # Offset -> IO Offset
+        '''Adds records from `start` on to the index. Returns the offset after the last intact record.'''
+        with open( self.path, 'rb' ) as f:
+            f.seek( start )
+            pos = start
+            while True:
+                h = f.read( RECORD_HEADER.size )
+                if len( h ) < RECORD_HEADER.size: break
+                klen, vlen, crc = RECORD_HEADER.unpack( h )
+                kb, vb = f.read( klen ), f.read( vlen )
+                if len( kb ) < klen or len( vb ) < vlen or zlib.crc32( vb, zlib.crc32( kb ) ) != crc: break
+                key = pickle.loads( kb )
+                if key in self.index: self.dead += 1
+                self.index[ key ] = pos
+                pos += RECORD_HEADER.size + klen + vlen
+        return pos
+
+    ############################################################################
+    ## Access
+    ############################################################################
+    def __contains__( self, key ): # Key -> Bool
+        return key in self.index
+
+    def __len__( self ): # Int
+        return len( self.index )
+
+    def keys( self ): # [Key]
+        return self.index.keys()
+
+    def _readRaw( self, off ): # Offset -> IO (Bytes, Bytes)
+        if off >= self.flushedSize:
+            self.flush()
+        self.reader.seek( off )
+        klen, vlen, crc = RECORD_HEADER.unpack( self.reader.read( RECORD_HEADER.size ) )
+        return self.reader.read( klen ), self.reader.read( vlen )
+
+    def get( self, key, default=None ): # Key -> a -> IO a
+        off = self.index.get( key )
+        if off is None: return default
+        return pickle.loads( self._readRaw( off )[1] )
+
+    def put( self, key, value ): # Key -> a -> IO ()
+        kb, vb = pickle.dumps( key, -1 ), pickle.dumps( value, -1 )
+        self.writer.write( RECORD_HEADER.pack( len( kb ), len( vb ), zlib.crc32( vb, zlib.crc32( kb ) ) ) )
+        self.writer.write( kb )
+        self.writer.write( vb )
+        if key in self.index: self.dead += 1
+        self.index[ key ] = self.size
+        self.size += RECORD_HEADER.size + len( kb ) + len( vb )
+
+    ############################################################################
+    ## Persistence
+    ############################################################################
+    def flush( self ): # IO ()
+        '''Hands appended records to the OS; enough to survive a crash of Anki itself'''
+        self.writer.flush()
+        self.flushedSize = self.size
+
+    def checkpoint( self ): # IO ()
+        '''Makes appended records durable and saves the index, compacting first if mostly garbage'''
+        if self.dead > COMPACT_MIN_DEAD and self.dead > len( self.index ):
+            return self.compact()
+        self.flush()
+        os.fsync( self.writer.fileno() )
+        tmp = self.idxPath + '.tmp'
+        with open( tmp, 'wb' ) as f:
+            pickle.dump( ( self.generation, self.size, self.dead, self.index ), f, -1 )
+            f.flush()
+            os.fsync( f.fileno() )
+        os.replace( tmp, self.idxPath )
+
+    def compact( self ): # IO ()
+        '''Rewrites the log with only the live records'''
+        self.flush()
+        tmp = self.path + '.tmp'
+        gen = self._create( tmp )
+        index, pos = {}, len( LOG_MAGIC ) + HEADER.size
+        with open( tmp, 'ab' ) as f:
+            for key, off in self.index.items():
+                kb, vb = self._readRaw( off )
+                f.write( RECORD_HEADER.pack( len( kb ), len( vb ), zlib.crc32( vb, zlib.crc32( kb ) ) ) )
+                f.write( kb )
+                f.write( vb )
+                index[ key ] = pos
+                pos += RECORD_HEADER.size + len( kb ) + len( vb )
+            f.flush()
+            os.fsync( f.fileno() )
+        self.close()
+        os.replace( tmp, self.path )
+        self.generation, self.index, self.dead = gen, index, 0
+        self.size = self.flushedSize = pos
+        self.reader = open( self.path, 'rb' )
+        self.writer = open( self.path, 'ab' )
+        self.checkpoint()
+
+    def close( self ): # IO ()
+        self.writer.close()
+        self.reader.close()
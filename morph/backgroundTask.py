@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+'''
+Runs a sequence of stages without blocking Anki's window.
+
+Stages that only work on MorphMan's own data run in a worker thread; stages that touch the
+collection (whose sqlite connection belongs to the main thread) or Qt run on the main thread
+from a timer, with the worker idle. The same timer polls the worker and shows its progress in a
+non-modal dialog with a Cancel button.
+
+A worker stage can also hand work to the main thread with `onMain()`, eg. to write its results
+a batch at a time while it computes the next ones. Those calls are queued and run by the timer.
+
+Cancelling is cooperative: the next `progress.update()` (or `start()`) a worker stage makes
+raises Cancelled, and no further stage is started. Main thread stages always run to their end,
+and once a worker stage called `onMain()` it and all stages after it do too, so once writes to
+the collection started they are finished.
+'''
+import queue, threading, traceback
+
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+
+from anki.hooks import addHook
+from . import instrument
+from .util import mw, printf
+
+POLL_MS = 100
+MAX_QUEUED_CALLS = 4 # onMain() calls a worker stage may be ahead of the main thread; keeps their arguments' memory bounded
+
+class Cancelled( Exception ):
+    pass
+
+class Progress:
+    '''Same interface as the parts of `mw.progress` MorphMan uses; the task's dialog shows what
+    the stages report here'''
+    def __init__( self ): # ()
+        self.lock = threading.Lock()
+        self.stage, self.label, self.value, self.max = '', '', 0, 0
+        self.cancelRequested = False
+        self.interruptible = False # whether the running stage may be stopped
+
+    def check( self ): # IO ()
+        if self.cancelRequested and self.interruptible:
+            raise Cancelled()
+
+    def start( self, label=None, max=0, **ka ): # Maybe Str -> Int -> IO ()
+        with self.lock:
+            self.label, self.value, self.max = label or '', 0, max or 0
+        self.check()
+
+    def update( self, label=None, value=None, max=None, **ka ): # Maybe Str -> Maybe Int -> Maybe Int -> IO ()
+        with self.lock:
+            if label is not None:   self.label = label
+            if value is not None:   self.value = value
+            if max is not None:     self.max = max
+        self.check()
+
+    def finish( self ): # IO ()
+        pass
+
+    def state( self ): # IO ( Str, Str, Int, Int )
+        with self.lock:
+            return self.stage, self.label, self.value, self.max
+
+class Task:
+    '''`stages` are ( name, inWorker, f ) where `f` takes the dict the stages share. A stage
+    returning False ends the task early (eg. after it showed an error).'''
+    def __init__( self, title, stages, onFinished=None ): # Str -> [ ( Str, Bool, Map Str a -> IO Maybe Bool ) ] -> Maybe ( Bool -> IO () ) -> ()
+        self.title, self.stages, self.onFinished = title, list( stages ), onFinished
+        self.state = {}
+        self.progress = Progress()
+        self.thread = None
+        self.result = None # ( Maybe Bool, Maybe Exception ) of the worker stage that just ended
+        self.calls = queue.Queue( MAX_QUEUED_CALLS ) # ( f, args ) from onMain(), to run on the main thread
+        self.callError = None # Maybe Exception; raised by one of them, the rest are dropped
+        self.committed = False # whether the stages have to run to their end
+        self.timer = self.dialog = None
+
+    def start( self ): # IO ()
+        global _running
+        _running = self
+        self.dialog = d = QProgressDialog( self.title, 'Cancel', 0, 0, mw )
+        d.setWindowTitle( self.title )
+        d.setWindowModality( Qt.NonModal )
+        d.setAutoClose( False )
+        d.setAutoReset( False )
+        d.canceled.connect( self.cancel )
+        d.show()
+        self.timer = QTimer( mw )
+        self.timer.timeout.connect( self.poll )
+        self.timer.start( POLL_MS )
+
+    def cancel( self, wait=False ): # Bool -> IO ()
+        '''Stops the task at the next chance; `wait` blocks until the worker stage ended'''
+        if not self.progress.cancelRequested:
+            self.progress.cancelRequested = True
+            printf( '%s: cancelling' % self.title )
+            if self.dialog is not None:
+                self.dialog.setLabelText( 'Cancelling...' )
+        if wait:
+            while self.thread is not None and self.thread.is_alive():
+                self.runCalls() # else the worker may wait for them forever
+                self.thread.join( POLL_MS / 1000 )
+            self.runCalls()
+            self.finish( False )
+
+    def runWorker( self, f ): # ( Map Str a -> IO Maybe Bool ) -> IO ()
+        try:
+            instrument.claim()
+            self.result = ( f( self.state ), None )
+        except BaseException as e:
+            self.result = ( None, e )
+
+    def callOnMain( self, f, args ): # ( a... -> IO () ) -> [a] -> IO ()
+        '''Called by the worker: queues `f` for the main thread; waits while the queue is full'''
+        self.committed, self.progress.interruptible = True, False
+        if self.callError is not None:
+            raise self.callError
+        self.calls.put( ( f, args ) )
+
+    def runCalls( self ): # IO ()
+        '''Runs the queued onMain() calls, in order'''
+        while True:
+            try:
+                f, args = self.calls.get_nowait()
+            except queue.Empty:
+                return
+            if self.callError is not None: continue
+            try:
+                f( *args )
+            except BaseException as e:
+                self.callError = e
+
+    def poll( self ): # IO ()
+        '''Called by the timer: shows progress, runs queued calls, collects a finished worker stage,
+        starts the next stage'''
+        self.runCalls()
+        if self.thread is not None:
+            if self.thread.is_alive():
+                self.show()
+                return
+            self.runCalls() # queued right before it ended
+            self.thread = None
+            r, error = self.result
+            if self.callError is not None:
+                error = self.callError
+            if isinstance( error, Cancelled ):
+                return self.finish( False )
+            if error is not None:
+                self.finish( False )
+                raise error # shown by Anki's error handler, with the worker's traceback
+            if r is False:
+                return self.finish( False )
+        if self.progress.cancelRequested and not self.committed:
+            return self.finish( False )
+        if not self.stages:
+            return self.finish( True )
+
+        name, inWorker, f = self.stages.pop( 0 )
+        self.progress.stage, self.progress.interruptible = name, inWorker and not self.committed
+        self.show()
+        if inWorker:
+            self.thread = threading.Thread( target=self.runWorker, args=( f, ), name='MorphMan: %s' % name, daemon=True )
+            self.thread.start()
+            return
+        instrument.claim()
+        try:
+            r = f( self.state )
+        except BaseException:
+            self.finish( False )
+            raise
+        if r is False:
+            self.finish( False )
+
+    def show( self ): # IO ()
+        stage, label, value, max = self.progress.state()
+        if self.dialog is None or self.progress.cancelRequested: return
+        self.dialog.setLabelText( '%s\n%s' % ( stage, label ) if label and label != stage else stage )
+        self.dialog.setMaximum( max )
+        self.dialog.setValue( min( value, max ) if max else 0 )
+
+    def finish( self, completed ): # Bool -> IO ()
+        global _running
+        if self.timer is None: return # already finished
+        self.timer.stop()
+        self.timer = None
+        self.dialog.canceled.disconnect( self.cancel )
+        self.dialog.close()
+        self.dialog = None
+        if _running is self:
+            _running = None
+        if not completed and self.progress.cancelRequested:
+            printf( '%s: cancelled' % self.title )
+        if self.onFinished is not None:
+            try:
+                self.onFinished( completed )
+            except Exception:
+                printf( traceback.format_exc() )
+
+_running = None # Maybe Task
+def running(): # Maybe Task
+    return _running
+
+def onMain( f, *args ): # ( a... -> IO () ) -> a... -> IO ()
+    '''Runs `f` on the main thread: right away, unless called from a worker stage; then it is
+    queued and the stage goes on (or waits while MAX_QUEUED_CALLS calls are queued already).
+    Errors are raised by the next onMain() of the stage, or else when the stage ended.'''
+    t = _running
+    if t is None or t.thread is not threading.current_thread():
+        return f( *args )
+    t.callOnMain( f, args )
+
+def cancelRunning(): # IO ()
+    '''Cancels the running task and waits for its worker, eg. before the collection is closed'''
+    if _running is not None:
+        _running.cancel( wait=True )
+addHook( 'unloadProfile', cancelRunning )
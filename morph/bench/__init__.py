@@ -0,0 +1,11 @@
+'''
+Benchmarks for Recalc and the other hot paths, run on a generated collection:
+
+    python -m morph.bench                       # all scenarios, 5000 Japanese notes, JSON on stdout
+    python -m morph.bench -n 20000 --languages ja,en -k recalc -o after.json --compare before.json
+    python -m morph.bench --list
+    python -m morph.bench.parity                # scoring against the old MMI arithmetic; exits with 1 on a difference
+
+Run it from the directory containing `morph`. MeCab is replaced by a fake (see fakeMecab.py)
+unless --real-mecab is given, so timings don't depend on the dictionary installed.
+'''
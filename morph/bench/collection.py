@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+'''
+Synthetic Anki collections for benchmarking.
+
+makeCollection() writes a SQLite file with the parts of the Anki (schema 11) collection
+that MorphMan reads and writes: the `col` row with models/decks/conf, `notes` and `cards`.
+Sentences are drawn from a Zipf distributed vocabulary, so morpheme frequencies look like
+those of real decks. BenchCollection and BenchMainWindow wrap such a file with just enough of
+the `mw`/`mw.col` interface for Recalc and the reviewer hooks to run outside of Anki.
+'''
+import hashlib, itertools, json, os, random, re, sqlite3, time
+
+# language -> ( tag, morphemizer, how words are joined, sentence end )
+# Japanese words are separated by spaces so the fake mecab (see fakeMecab.py) can split them.
+LANGUAGES = {
+    'ja': ( 'japanese', 'MecabMorphemizer', ' ', ' 。' ),
+    'en': ( 'english',  'SpaceMorphemizer', ' ', '.' ),
+    'zh': ( 'chinese',  'CjkCharMorphemizer', '', '。' ),
+}
+SYLLABLES = {
+    'ja': 'か き く け こ さ し す せ そ た ち つ て と な に ぬ ね の ま み む め も ら り れ ろ わ'.split(),
+    'en': 'ba be bi bo ka ke ki ko la le li lo ma me mi mo na ne ni no ra re ri ro sa se si so ta te ti to'.split(),
+    'zh': list( '的一是不了人我在有他这中大来上国个到说们为子和你地出道也时年得就那要下以生会自着去之过家学对可她里后小么心多天而能好都然没日于起还发成事只作当想看文无开手十用主行方又如前所本见经头面公同三已老从动两长知民样现分将外但身些与高意进把法此实回二理美点月明其种声全工己话儿者向情部正名定女问力机给等几很业最间新什打便位因重被走电四第门相次东政海口使教西再平真听世气信北少关并内加化由却代军产入先山五太水万市眼体别处总才场师书比住员九笑性通目华报立马命张活难神数件安表原车白应路期叫死常提感金何更反合放做系计或司利受光王果亲界及今京务制解各任至清物台象记边共风战干接它许八特觉望直服毛林题建南度统色字请交爱让认算论百吃义科怎元社术结六功指思非流每青管夫连远资队跟带花快条院变联言权往展该领传近留红治决周保达办运武半候七必城父强步完革深区即求品士转量空甚众技轻程告江语英基派满式李息写呢识极令黄德收脸钱党倒未持取设始版双历越史商千片容研像找友孩站广改议形委早房音火际则首单据导影失拿网香似斯专石若兵弟谁校读志飞观争究包组造落视济喜离虽坏兴议类' ),
+}
+FIELD_NAMES = [ 'Expression', 'Meaning', 'Reading', 'Notes', 'Source', 'Extra' ]
+MORPHMAN_FIELDS = [ 'MorphMan_FocusMorph', 'MorphMan_Index', 'MorphMan_Unmatures', 'MorphMan_UnmatureMorphCount',
+                    'MorphMan_Unknowns', 'MorphMan_UnknownFreq', 'MorphMan_UnknownMorphCount' ]
+DECK_ID = 1
+
+SCHEMA = '''
+create table col (
+    id      integer primary key,
+    crt     integer not null,
+    mod     integer not null,
+    scm     integer not null,
+    ver     integer not null,
+    dty     integer not null,
+    usn     integer not null,
+    ls      integer not null,
+    conf    text not null,
+    models  text not null,
+    decks   text not null,
+    dconf   text not null,
+    tags    text not null
+);
+create table notes (
+    id      integer primary key,
+    guid    text not null,
+    mid     integer not null,
+    mod     integer not null,
+    usn     integer not null,
+    tags    text not null,
+    flds    text not null,
+    sfld    integer not null,
+    csum    integer not null,
+    flags   integer not null,
+    data    text not null
+);
+create table cards (
+    id      integer primary key,
+    nid     integer not null,
+    did     integer not null,
+    ord     integer not null,
+    mod     integer not null,
+    usn     integer not null,
+    type    integer not null,
+    queue   integer not null,
+    due     integer not null,
+    ivl     integer not null,
+    factor  integer not null,
+    reps    integer not null,
+    lapses  integer not null,
+    left    integer not null,
+    odue    integer not null,
+    odid    integer not null,
+    flags   integer not null,
+    data    text not null
+);
+create index ix_notes_usn on notes ( usn );
+create index ix_cards_usn on cards ( usn );
+create index ix_cards_nid on cards ( nid );
+create index ix_cards_sched on cards ( did, queue, due );
+'''
+
+def modelName( lang ): # Lang -> Str
+    return 'MorphMan Bench (%s)' % lang
+
+def modelId( lang ): # Lang -> ModelId
+    return 1500000000000 + sorted( LANGUAGES ).index( lang )
+
+def stripHTML( s ): # Str -> Str
+    return re.sub( '<[^>]*>', '', s )
+
+def fieldChecksum( s ): # Str -> Int
+    '''Same as anki.utils.fieldChecksum for fields without media references'''
+    return int( hashlib.sha1( stripHTML( s ).encode( 'utf-8' ) ).hexdigest()[:8], 16 )
+
+def mkModel( lang, fields ): # Lang -> Int -> Model
+    names = FIELD_NAMES[ :fields ] + [ 'Field%d' % i for i in range( len( FIELD_NAMES ), fields ) ] + MORPHMAN_FIELDS
+    return { 'id':modelId( lang ), 'name':modelName( lang ), 'type':0, 'mod':0, 'usn':0, 'sortf':0, 'did':DECK_ID,
+             'flds':[ { 'name':n, 'ord':i, 'sticky':False, 'rtl':False, 'font':'Arial', 'size':20, 'media':[] } for i,n in enumerate( names ) ],
+             'tmpls':[ { 'name':'Card %d' % ( i+1 ), 'ord':i, 'qfmt':'{{Expression}}', 'afmt':'{{Meaning}}', 'did':None, 'bqfmt':'', 'bafmt':'' } for i in range( 3 ) ],
+             'tags':[], 'vers':[], 'css':'', 'latexPre':'', 'latexPost':'', 'req':[] }
+
+class Vocabulary:
+    '''A Zipf distributed word list for one language'''
+    def __init__( self, lang, size, rnd ): # Lang -> Int -> Random -> ()
+        syllables = SYLLABLES[ lang ]
+        words, seen = [], set()
+        n = 1
+        while len( words ) < size:
+            for combo in itertools.product( syllables, repeat=n ):
+                w = ''.join( combo )
+                if lang == 'ja' and rnd.random() < 0.2: w += 'る' # some verbs for the reading fixes
+                if w in seen: continue
+                seen.add( w )
+                words.append( w )
+                if len( words ) >= size: break
+            n += 1
+        rnd.shuffle( words )
+        self.words = words
+        self.cumWeights = list( itertools.accumulate( 1.0 / ( r+1 ) for r in range( size ) ) )
+
+    def sentence( self, rnd, length, lang ): # Random -> Int -> Lang -> Str
+        tag, mizer, sep, end = LANGUAGES[ lang ]
+        return sep.join( rnd.choices( self.words, cum_weights=self.cumWeights, k=length ) ) + end
+
+def drawInterval( rnd, newRatio, maxIvl ): # Random -> Float -> Int -> ( CardType, Queue, Ivl )
+    '''Card state: new, learning (ivl 0) or review with a roughly log-uniform interval'''
+    r = rnd.random()
+    if r < newRatio:            return 0, 0, 0
+    if r < newRatio + 0.05:     return 1, 1, 0
+    return 2, 2, max( 1, int( round( maxIvl ** rnd.random() ) ) )
+
+def makeCollection( path, notes=5000, fields=2, tags=20, languages=( 'ja', ), cardsPerNote=1, newRatio=0.4, maxIvl=365,
+                    vocab=20000, sentenceLength=( 3, 15 ), seed=0 ): # FilePath -> ... -> IO ()
+    '''Writes a synthetic collection. Every note has the `morphman` tag and its language's tag,
+    plus up to three random tags out of a pool of `tags`.'''
+    rnd = random.Random( seed )
+    if os.path.exists( path ): os.remove( path )
+    os.makedirs( os.path.dirname( os.path.abspath( path ) ), exist_ok=True )
+    now = int( time.time() )
+    fields = max( 1, min( fields, 9 ) )
+    languages = list( languages )
+    vocabs = dict( ( lang, Vocabulary( lang, vocab, rnd ) ) for lang in languages )
+    tagPool = [ 'bench%d' % i for i in range( tags ) ]
+    models = dict( ( str( modelId( lang ) ), mkModel( lang, fields ) ) for lang in languages )
+    decks = { str( DECK_ID ): { 'id':DECK_ID, 'name':'Default', 'conf':1, 'dyn':0, 'usn':0, 'mod':now } }
+    conf = { 'curModel':str( modelId( languages[0] ) ), 'activeDecks':[ DECK_ID ], 'curDeck':DECK_ID, 'nextPos':notes + 1 }
+    allTags = dict( ( t, 0 ) for t in [ 'morphman' ] + tagPool + [ LANGUAGES[ l ][0] for l in languages ] )
+
+    conn = sqlite3.connect( path )
+    try:
+        conn.execute( 'pragma journal_mode = off' )
+        conn.execute( 'pragma synchronous = off' )
+        conn.executescript( SCHEMA )
+        conn.execute( 'insert into col values ( 1,?,?,?,11,0,0,0,?,?,?,?,? )',
+                ( now - 86400*365, now, now, json.dumps( conf ), json.dumps( models ), json.dumps( decks ), json.dumps( {} ), json.dumps( allTags ) ) )
+
+        def noteRows():
+            for i in range( notes ):
+                nid = 1400000000000 + i
+                lang = languages[ i % len( languages ) ]
+                v = vocabs[ lang ]
+                fs = [ v.sentence( rnd, rnd.randint( *sentenceLength ), lang ) for f in range( fields ) ] + [ '' ] * len( MORPHMAN_FIELDS )
+                ts = [ 'morphman', LANGUAGES[ lang ][0] ] + rnd.sample( tagPool, min( len( tagPool ), rnd.randint( 0, 3 ) ) )
+                yield ( nid, 'g%d' % i, modelId( lang ), now - rnd.randint( 0, 86400*365 ), 0, ' %s ' % ' '.join( ts ),
+                        '\x1f'.join( fs ), stripHTML( fs[0] ), fieldChecksum( fs[0] ), 0, '' )
+        conn.executemany( 'insert into notes values ( ?,?,?,?,?,?,?,?,?,?,? )', noteRows() )
+
+        def cardRows():
+            cid = 1400000000000
+            for i in range( notes ):
+                for o in range( cardsPerNote ):
+                    ctype, queue, ivl = drawInterval( rnd, newRatio, maxIvl )
+                    cid += 1
+                    due = i + 1 if ctype == 0 else rnd.randint( 0, 365 )
+                    yield ( cid, 1400000000000 + i, DECK_ID, o, now - rnd.randint( 0, 86400*365 ), 0, ctype, queue, due, ivl, 2500, 0, 0, 0, 0, 0, 0, '' )
+        conn.executemany( 'insert into cards values ( ?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,? )', cardRows() )
+        conn.commit()
+    finally:
+        conn.close()
+
+def touchNotes( conn, fraction, seed=1 ): # sqlite3.Connection -> Float -> Int -> IO Int
+    '''Marks a fraction of the notes (and their cards) as modified now, as if they were edited or
+    reviewed; half of them get a new first field. Returns how many notes were touched.'''
+    rnd = random.Random( seed )
+    now = int( time.time() ) + 1
+    nids = [ r[0] for r in conn.execute( 'select id from notes' ) ]
+    touched = rnd.sample( nids, int( len( nids ) * fraction ) )
+    for nid in touched:
+        if rnd.random() < 0.5:
+            flds = conn.execute( 'select flds from notes where id = ?', ( nid, ) ).fetchone()[0].split( '\x1f' )
+            words = flds[0].split( ' ' )
+            rnd.shuffle( words )
+            flds[0] = ' '.join( words[ 1: ] or words )
+            conn.execute( 'update notes set flds = ?, mod = ? where id = ?', ( '\x1f'.join( flds ), now, nid ) )
+        else:
+            conn.execute( 'update cards set ivl = ivl + 1, type = 2, queue = 2, mod = ? where nid = ?', ( now, nid ) )
+    conn.commit()
+    return len( touched )
+
+def languageFilters( languages ): # [Lang] -> [Filter]
+    '''The MorphMan 'Filter' preference that analyzes the bench models'''
+    return [ { 'Type':modelName( lang ), 'TypeId':None, 'Tags':[], 'Fields':[ 'Expression' ],
+               'Morphemizer':LANGUAGES[ lang ][1], 'Modify':True } for lang in languages ]
+
+################################################################################
+## Stand-ins for the parts of mw and mw.col MorphMan uses
+################################################################################
+
+class DBProxy:
+    '''The query helpers of anki.dbproxy.DBProxy'''
+    def __init__( self, path ): # FilePath -> IO ()
+        self.conn = sqlite3.connect( path )
+        self.mod = False
+
+    def execute( self, sql, *a, **ka ):
+        self.mod = self.mod or not sql.lstrip().lower().startswith( 'select' )
+        return self.conn.execute( sql, ka or a )
+
+    def executemany( self, sql, l ):
+        self.mod = True
+        self.conn.executemany( sql, l )
+
+    def scalar( self, *a, **ka ):
+        r = self.execute( *a, **ka ).fetchone()
+        return r[0] if r else None
+
+    def all( self, *a, **ka ):
+        return self.execute( *a, **ka ).fetchall()
+
+    def first( self, *a, **ka ):
+        return self.execute( *a, **ka ).fetchone()
+
+    def list( self, *a, **ka ):
+        return [ r[0] for r in self.execute( *a, **ka ) ]
+
+    def commit( self ):
+        self.conn.commit()
+
+    def close( self ):
+        self.conn.close()
+
+class Models:
+    def __init__( self, models ): self.models = models
+    def get( self, mid ):         return self.models.get( str( mid ) )
+    def all( self ):              return list( self.models.values() )
+    def byName( self, name ):     return next( ( m for m in self.models.values() if m['name'] == name ), None )
+
+class Decks:
+    def __init__( self, decks ):  self.decks = decks
+    def get( self, did ):         return self.decks.get( str( did ) )
+    def active( self ):           return [ int( d ) for d in self.decks ]
+
+class Tags:
+    '''String handling of anki.tags.TagManager'''
+    def __init__( self, tags ):   self.tags = tags
+    def register( self, tags, usn=None ):
+        for t in tags: self.tags.setdefault( t, 0 )
+    def split( self, tags ):      return [ t for t in tags.replace( '　', ' ' ).split( ' ' ) if t ]
+    def join( self, tags ):       return ' %s ' % ' '.join( tags ) if tags else ''
+    def canonify( self, tags ):
+        seen, out = set(), []
+        for t in tags:
+            if t.lower() not in seen:
+                seen.add( t.lower() )
+                out.append( t )
+        return sorted( out )
+
+class BenchCollection:
+    def __init__( self, path ): # FilePath -> IO ()
+        self.path = path
+        self.db = DBProxy( path )
+        conf, models, decks, tags = self.db.first( 'select conf, models, decks, tags from col' )
+        self.conf = json.loads( conf )
+        self.models = Models( json.loads( models ) )
+        self.decks = Decks( json.loads( decks ) )
+        self.tags = Tags( json.loads( tags ) )
+        self.crt = self.db.scalar( 'select crt from col' )
+
+    def usn( self ): return -1
+    def setMod( self ): self.db.mod = True
+    def updateFieldCache( self, nids ): pass
+
+    def save( self ): # IO ()
+        self.db.execute( 'update col set conf = ?, tags = ?, mod = ?', json.dumps( self.conf ), json.dumps( self.tags.tags ), int( time.time() ) )
+        self.db.commit()
+
+    def close( self ): # IO ()
+        self.save()
+        self.db.close()
+
+class Progress:
+    def start( self, *a, **ka ):  pass
+    def update( self, *a, **ka ): pass
+    def finish( self ):           pass
+
+class Toolbar:
+    def draw( self ): pass
+
+class ProfileManager:
+    def __init__( self, folder, name='bench' ): # FilePath -> Str -> ()
+        self.folder, self.name = folder, name
+    def profileFolder( self ): return self.folder
+
+def mainWindowClass(): # IO Type
+    '''MorphMan asserts that `mw` is an AnkiQt. The stand-in subclasses it (when aqt is around) but
+    is created without running Qt's constructor, since none of its Qt methods are used.'''
+    try:
+        from aqt.main import AnkiQt
+    except ImportError:
+        AnkiQt = object
+    class BenchMainWindow( AnkiQt ):
+        def reset( self, *a, **ka ): pass
+    return BenchMainWindow
+
+def mkMainWindow( colPath, profileFolder ): # FilePath -> FilePath -> IO BenchMainWindow
+    cls = mainWindowClass()
+    mw = cls.__new__( cls )
+    mw.col = BenchCollection( colPath )
+    mw.pm = ProfileManager( profileFolder )
+    mw.progress = Progress()
+    mw.toolbar = Toolbar()
+    return mw
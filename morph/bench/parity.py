@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+'''
+Parity check of the MMI scoring (scoring.py, scoringKernel.py) against the note by note
+arithmetic updateNotes used before, which is kept here as `legacyScore`.
+
+    python -m morph.bench.parity                # exits with 1 and lists the differences on a mismatch
+    python -m morph.bench -k scoring.parity     # the same as a bench scenario
+
+The fixture is random but built so every part of the MMI is exercised: German verb forms with
+an unknown infinitive (DEPENDS), inflected forms whose base is unknown, priority.db morphemes,
+unknown verbs, known but not yet mature morphemes (with maturities below and above 1) and notes
+at, below and above the length limits of their model.
+'''
+import random, sys
+
+# Maturity thresholds (seen, known, mature; config.py's defaults) and the model settings notes are scored with
+THRESHOLDS = ( 1/86400., 10/86400., 21 )
+WEIGHTS = [
+    { 'priority.db weight':200, 'reinforce new vocab weight':5.0, 'verb bonus':100, 'min good sentence length':2, 'max good sentence length':8 },
+    { 'priority.db weight':30, 'reinforce new vocab weight':7, 'verb bonus':0, 'min good sentence length':0, 'max good sentence length':4 },
+    { 'priority.db weight':0, 'reinforce new vocab weight':2.5, 'verb bonus':450, 'min good sentence length':5, 'max good sentence length':5 },
+]
+
+def filterDbByMat( db, mat ): # MorphDb -> Maturity -> MorphDb
+    from ..morphemes import MorphDb
+    newDb = MorphDb()
+    for loc, ms in db.locDb().items():
+        if loc.maturity > mat:
+            newDb.addMsL( ms, loc )
+    return newDb
+
+def legacyScore( allDb, knownDb, matureDb, priorityDb, thresholdMature, C, morphemes ): # MorphDb -> MorphDb -> MorphDb -> Map Morpheme a -> Maturity -> ( Str -> a ) -> {Morpheme} -> ( Int, Int, Int, Number, Bool, Int, Int )
+    '''The MMI of one note, as updateNotes computed it before scoring.py'''
+    from ..morphemes import Morpheme
+    from ..scoring import DEPENDS
+    unknowns, unmatures, newKnowns = set(), set(), set()
+    for morpheme in morphemes:
+        if morpheme not in knownDb.db:     unknowns.add( morpheme )
+        if morpheme not in matureDb.db:    unmatures.add( morpheme )
+        if morpheme not in matureDb.db and morpheme in knownDb.db:
+            newKnowns.add( morpheme )
+    N, N_k, N_m = len( morphemes ), len( unknowns ), len( unmatures )
+
+    F_k = 0
+    for focusMorph in unknowns:
+        F_kt = allDb.frequency( focusMorph )
+        if focusMorph.subPos in DEPENDS and DEPENDS[ focusMorph.subPos ] != focusMorph.subPos:
+            baseMorph = Morpheme( focusMorph.base, focusMorph.inflected, focusMorph.pos, DEPENDS[ focusMorph.subPos ], focusMorph.read )
+            if baseMorph in allDb.db and baseMorph not in knownDb.db:
+                F_kt = max( 0, F_kt - ( allDb.frequency( baseMorph ) * ( 1 - max( min( allDb.maturity( baseMorph ) / thresholdMature, 1 ), 0 ) ) ) )
+        if focusMorph.base != focusMorph.inflected:
+            baseMorph = Morpheme( focusMorph.inflected, focusMorph.inflected, focusMorph.pos, focusMorph.subPos, focusMorph.inflected )
+            if baseMorph in allDb.db and baseMorph not in knownDb.db:
+                F_kt = max( 0, F_kt - ( allDb.frequency( baseMorph ) * ( 1 - max( min( allDb.maturity( baseMorph ) / thresholdMature, 1 ), 0 ) ) ) )
+        F_k += F_kt
+    F_k_avg = F_k // N_k if N_k > 0 else F_k
+    usefulness = F_k_avg
+
+    isPriority = False
+    for focusMorph in unknowns:
+        if focusMorph in priorityDb:
+            isPriority = True
+            usefulness += C('priority.db weight')
+
+    for morpheme in newKnowns:
+        locs = allDb.db[ morpheme ]
+        if locs:
+            ivl = min( 1, max( loc.maturity for loc in locs ) )
+            usefulness += C('reinforce new vocab weight') // ivl
+
+    if any( morpheme.pos == '動詞' for morpheme in unknowns ):
+        usefulness += C('verb bonus')
+
+    usefulness = 999 - min( 999, usefulness )
+
+    lenDiffRaw = min( N - C('min good sentence length'), max( 0, N - C('max good sentence length') ) )
+    lenDiff = min( 9, abs( lenDiffRaw ) )
+
+    mmi = 10000*N_k + 1000*lenDiff + usefulness
+    return N, N_k, N_m, F_k_avg, isPriority, lenDiffRaw, int( mmi )
+
+def mkFixture( notes, seed ): # Int -> Int -> IO ( MorphDb, Map Morpheme Location, [ ( [Morpheme], Int ) ] )
+    '''all.db, priority.db and the morphemes and weights (index into WEIGHTS) of every note'''
+    from ..morphemes import Morpheme, MorphDb, AnkiDeck, Nowhere
+    rnd = random.Random( seed )
+    vocab = []
+    for i in range( 120 ):
+        w = 'w%d' % i
+        vocab.append( Morpheme( w, w, '名詞', '一般', w ) )
+        vocab.append( Morpheme( 'v%d' % i, 'v%d' % i, '動詞', '自立', 'v%d' % i ) )
+        # inflected form, whose base is counted on its own too
+        vocab.append( Morpheme( 'i%d' % i, 'j%d' % i, '動詞', '自立', 'i%d' % i ) )
+        vocab.append( Morpheme( 'j%d' % i, 'j%d' % i, '動詞', '自立', 'j%d' % i ) )
+        # German verb forms and their infinitive
+        for subPos in [ 'VVFIN', 'VAPP', 'VMFIN' ]:
+            vocab.append( Morpheme( 'g%d' % i, 'g%d' % i, 'VERB', subPos, 'g%d' % i ) )
+        vocab += [ Morpheme( 'g%d' % i, 'g%d' % i, 'VERB', inf, 'g%d' % i ) for inf in [ 'VVINF', 'VAINF', 'VMINF' ] ]
+    # maturities: unseen, seen, known but unmature (some of them below 1), mature
+    maturity = dict( ( m, rnd.choice( [ 0, 5/86400., 0.25, 0.5, 3, 12, 40, 90 ] ) ) for m in vocab )
+
+    allDb, noteMs = MorphDb(), []
+    for nid in range( notes ):
+        ms = set( rnd.sample( vocab, rnd.choice( [ 0, 1, 2, 3, 4, 5, 5, 6, 8, 9, 12, 20 ] ) ) )
+        # no card is more mature than the least mature morpheme of its note is meant to be
+        mats = [ min( [ maturity[ m ] for m in ms ] or [ 0 ] ) * rnd.choice( [ 0, 0.5, 1 ] ) ]
+        allDb.addMsL( ms, AnkiDeck( nid, 'Expression', '', 'g%d' % nid, mats ) )
+        noteMs.append( ( ms, nid % len( WEIGHTS ) ) )
+    # each morpheme reaches its maturity somewhere else (eg. in ext.db); some only occur there
+    for m in vocab:
+        if m in allDb.db or m.subPos.endswith( 'INF' ) or m.base == m.inflected and m.pos == '動詞':
+            allDb.addML( m, Nowhere( maturity[ m ] ) )
+
+    priorityDb = MorphDb()
+    for m in rnd.sample( vocab, len( vocab ) // 5 ):
+        priorityDb.addML( m, Nowhere() )
+    return allDb, priorityDb.db, noteMs
+
+def check( notes=3000, seed=0, processes=2 ): # Int -> Int -> Int -> IO Map Str Int
+    '''Raises AssertionError if a scoring path differs from `legacyScore` on any note; returns
+    how often each part of the MMI was exercised'''
+    from ..morphemes import MaturityTiers, MATURE
+    from ..scoring import MorphemeTable, NoteWeights, numpyOrNone, scoreNote, scoreNotesNumpy, scoreNotesParallel
+    allDb, priorityDb, noteMs = mkFixture( notes, seed )
+    tiers = MaturityTiers( allDb, *THRESHOLDS )
+    table = MorphemeTable( allDb, priorityDb, tiers )
+    ids = [ [ m.id for m in ms ] for ms, w in noteMs ]
+    weights = [ NoteWeights( WEIGHTS[ w ].__getitem__ ) for ms, w in noteMs ]
+
+    knownDb, matureDb = filterDbByMat( allDb, THRESHOLDS[1] ), filterDbByMat( allDb, THRESHOLDS[2] )
+    expected = [ legacyScore( allDb, knownDb, matureDb, priorityDb, tiers.thresholds[ MATURE ], WEIGHTS[ w ].__getitem__, ms ) for ms, w in noteMs ]
+
+    paths = [ ( 'scoreNote', [ scoreNote( table, i, w ) for i, w in zip( ids, weights ) ] ) ]
+    np = numpyOrNone()
+    if np is not None:
+        paths.append( ( 'scoreNotesNumpy', scoreNotesNumpy( np, table, ids, weights ) ) )
+    if processes:
+        paths.append( ( 'scoreNotesParallel', scoreNotesParallel( table, ids, weights, processes ) ) )
+
+    mismatches = []
+    for name, scores in paths:
+        for nid, ( old, new ) in enumerate( zip( expected, scores ) ):
+            if tuple( old ) != tuple( new ):
+                mismatches.append( '%s, note %d: %r instead of %r' % ( name, nid, tuple( new ), old ) )
+        if len( scores ) != len( expected ):
+            mismatches.append( '%s: %d scores for %d notes' % ( name, len( scores ), len( expected ) ) )
+
+    # what the fixture covers; a part that isn't exercised can't be checked
+    unknown = lambda m: not tiers.isKnown( m )
+    covered = {
+        'notes':len( noteMs ),
+        'depends penalties':sum( 1 for ms, w in noteMs for m in ms if unknown( m ) and m.subPos in ( 'VVFIN', 'VAPP', 'VMFIN' ) and table.focusFreq[ m.id ] != allDb.frequency( m ) ),
+        'inflected penalties':sum( 1 for ms, w in noteMs for m in ms if unknown( m ) and m.base != m.inflected and table.focusFreq[ m.id ] != allDb.frequency( m ) ),
+        'priority':sum( 1 for ( N, N_k, N_m, F, isPriority, l, mmi ) in expected if isPriority ),
+        'verb bonus':sum( 1 for ( ms, w ) in noteMs if WEIGHTS[ w ]['verb bonus'] and any( unknown( m ) and m.pos == '動詞' for m in ms ) ),
+        'reinforce':sum( 1 for ms, w in noteMs if any( tiers.isKnown( m ) and not tiers.isMature( m ) for m in ms ) ),
+        'reinforce below 1':sum( 1 for ms, w in noteMs if any( tiers.isKnown( m ) and not tiers.isMature( m ) and allDb.maxMaturity( m ) < 1 for m in ms ) ),
+        'at min length':sum( 1 for ms, w in noteMs if len( ms ) == WEIGHTS[ w ]['min good sentence length'] ),
+        'at max length':sum( 1 for ms, w in noteMs if len( ms ) == WEIGHTS[ w ]['max good sentence length'] ),
+        'too short':sum( 1 for N, N_k, N_m, F, p, lenDiffRaw, mmi in expected if lenDiffRaw < 0 ),
+        'too long':sum( 1 for N, N_k, N_m, F, p, lenDiffRaw, mmi in expected if lenDiffRaw > 0 ),
+        'paths':len( paths ),
+    }
+    for part, n in covered.items():
+        if not n: mismatches.append( 'fixture exercises no %s' % part )
+    assert not mismatches, '%d differences from the old scoring:\n%s' % ( len( mismatches ), '\n'.join( mismatches[ :50 ] ) )
+    return covered
+
+def main():
+    try:
+        covered = check()
+    except AssertionError as e:
+        print( e, file=sys.stderr )
+        sys.exit( 1 )
+    print( 'Scoring matches the old updateNotes arithmetic: %s' % ', '.join( '%s %d' % kv for kv in covered.items() ) )
+
+if __name__ == '__main__':
+    main()
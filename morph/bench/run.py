@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+'''
+Timed benchmark scenarios over a synthetic collection, reported as JSON.
+
+Every scenario is a function that prepares one repetition and returns the callable to time;
+that callable may return a dict of counts (notes, morphemes, ...) that is reported with the
+timings. Scenarios marked `anki` drive Recalc and the reviewer hooks through main.py and
+newMorphHelper.py, so they need Anki's Python packages; without them they are reported as
+skipped.
+'''
+import argparse, json, os, platform, shutil, statistics, sys, tempfile, time
+
+from . import collection, fakeMecab
+
+SCENARIOS = [] # [ ( Name, Bool, Env -> IO ( IO Maybe Map Str a ) ) ]
+
+def scenario( name, anki=False ):
+    def register( f ):
+        SCENARIOS.append( ( name, anki, f ) )
+        return f
+    return register
+
+# config.py values the scenarios outside of Anki use
+THRESHOLDS = ( 1/86400., 10/86400., 21 ) # seen, known, mature
+WEIGHTS = { 'priority.db weight':200, 'reinforce new vocab weight':5.0, 'verb bonus':100,
+            'min good sentence length':0, 'max good sentence length':8 }
+MORPHEMIZER_CACHES = [ 'morph cache', 'mecab interact', 'mecab morphemes', 'mecab readings' ]
+
+class Env:
+    '''The fixture: a pristine collection, a copy scenarios may modify, and a profile folder'''
+    def __init__( self, workDir, args ): # FilePath -> Namespace -> IO ()
+        self.workDir, self.args = workDir, args
+        self.pristine = os.path.join( workDir, 'pristine.anki2' )
+        self.colPath = os.path.join( workDir, 'collection.anki2' )
+        self.profile = os.path.join( workDir, 'profile' )
+        self.mw = None
+        self.ankiMissing = None # why Anki scenarios can't run
+
+    def path( self, *names ): # Str... -> FilePath
+        p = os.path.join( self.workDir, 'scratch', *names )
+        os.makedirs( os.path.dirname( p ), exist_ok=True )
+        return p
+
+    def notes( self ): # IO [ ( NoteId, Guid, Lang, [Tag], Str, [Maturity] ) ]
+        '''Expression field, language and card maturities of every note'''
+        import sqlite3
+        langs = dict( ( collection.modelId( l ), l ) for l in collection.LANGUAGES )
+        conn = sqlite3.connect( self.pristine )
+        try:
+            return [ ( nid, guid, langs[ mid ], tags.split(), flds.split( '\x1f' )[0], [ int( i ) for i in ivls.split( ',' ) ] )
+                     for nid, guid, mid, tags, flds, ivls in conn.execute( '''select n.id, n.guid, n.mid, n.tags, n.flds, group_concat( c.ivl )
+                        from notes n join cards c on c.nid = n.id group by n.id''' ) ]
+        finally:
+            conn.close()
+
+    def freshCollection( self ): # IO ()
+        '''Resets the collection Recalc works on to the generated state'''
+        if self.mw is not None:
+            self.mw.col.db.close()
+        shutil.copyfile( self.pristine, self.colPath )
+        if self.mw is not None:
+            self.mw.col = collection.BenchCollection( self.colPath )
+            self.configureAnki()
+
+    def setupAnki( self ): # IO ()
+        '''Installs the `mw` stand-in; has to happen before any module importing morph.util is loaded'''
+        try:
+            import aqt, anki.utils
+        except ImportError as e:
+            self.ankiMissing = 'Anki is not importable (%s)' % e
+            return
+        shutil.copyfile( self.pristine, self.colPath )
+        os.makedirs( os.path.join( self.profile, 'dbs' ), exist_ok=True )
+        self.mw = aqt.mw = collection.mkMainWindow( self.colPath, self.profile )
+        from .. import util
+        util.initCfg()
+        self.configureAnki()
+
+    def configureAnki( self ): # IO ()
+        from .. import util
+        util.initJcfg()
+        util.jcfgUpdate( { 'Filter':collection.languageFilters( self.args.languages ) } )
+        util._allDb = None
+
+def morphemizerFor( lang ): # Lang -> Morphemizer
+    from ..morphemizer import getMorphemizerByName
+    return getMorphemizerByName( collection.LANGUAGES[ lang ][1] )
+
+def clearMorphemizerCaches(): # IO ()
+    from ..util_external import namedCache
+    for name in MORPHEMIZER_CACHES:
+        namedCache( name ).clear()
+
+def useMorphCache( path, fresh=True ): # FilePath -> Bool -> IO MorphCache
+    '''Points getMorphemes at a cache log of its own'''
+    from ..morphemes import MorphCache, getMorphCacheDB
+    if fresh and os.path.exists( path ):
+        os.remove( path )
+    clearMorphemizerCaches()
+    cache = getMorphCacheDB.cache[ () ] = MorphCache( path )
+    return cache
+
+def morphemesOfNotes( env ): # Env -> IO [ ( Note, [Morpheme] ) ]
+    from ..morphemes import getMorphemes
+    useMorphCache( env.path( 'morph_cache.log' ) )
+    return [ ( n, getMorphemes( morphemizerFor( n[2] ), n[4], n[3] ) ) for n in env.notes() ]
+
+def buildDb( notesMs ): # [ ( Note, [Morpheme] ) ] -> MorphDb
+    from ..morphemes import MorphDb, AnkiDeck
+    db = MorphDb()
+    for ( nid, guid, lang, tags, expr, mats ), ms in notesMs:
+        db.addMsL( ms, AnkiDeck( nid, 'Expression', expr, guid, mats ) )
+    return db
+
+################################################################################
+## Scenarios without Anki
+################################################################################
+
+@scenario( 'getMorphemes.cold' )
+def getMorphemesCold( env ):
+    '''Every expression morphemized and written to an empty cache log'''
+    from ..morphemes import getMorphemes
+    notes = env.notes()
+    cache = useMorphCache( env.path( 'morph_cache.log' ) )
+    def run():
+        for nid, guid, lang, tags, expr, mats in notes:
+            getMorphemes( morphemizerFor( lang ), expr, tags )
+        cache.save()
+        return { 'expressions':len( notes ) }
+    return run
+
+@scenario( 'getMorphemes.log' )
+def getMorphemesLog( env ):
+    '''Every expression read back from the cache log of a previous run (as after restarting Anki)'''
+    from ..morphemes import getMorphemes
+    notes = env.notes()
+    getMorphemesCold( env )()
+    useMorphCache( env.path( 'morph_cache.log' ), fresh=False )
+    def run():
+        for nid, guid, lang, tags, expr, mats in notes:
+            getMorphemes( morphemizerFor( lang ), expr, tags )
+        return { 'expressions':len( notes ) }
+    return run
+
+@scenario( 'getMorphemes.warm' )
+def getMorphemesWarm( env ):
+    '''Every expression found in the in-memory cache'''
+    from ..morphemes import getMorphemes
+    notes = env.notes()
+    getMorphemesCold( env )()
+    def run():
+        for nid, guid, lang, tags, expr, mats in notes:
+            getMorphemes( morphemizerFor( lang ), expr, tags )
+        return { 'expressions':len( notes ) }
+    return run
+
+@scenario( 'morphemizer.bulk' )
+def morphemizerBulk( env ):
+    '''The bulk morphemizer methods Recalc uses, on all distinct expressions'''
+    notes = env.notes()
+    byLang = {}
+    for nid, guid, lang, tags, expr, mats in notes:
+        byLang.setdefault( lang, set() ).add( expr )
+    clearMorphemizerCaches()
+    def run():
+        n = 0
+        for lang, exprs in byLang.items():
+            mizer = morphemizerFor( lang )
+            bulk = getattr( mizer, 'getMorphemesFromExprBulk', None )
+            if bulk is None: continue
+            bulk( list( exprs ) )
+            n += len( exprs )
+        return { 'expressions':n }
+    return run
+
+@scenario( 'morphdb.build' )
+def morphDbBuild( env ):
+    '''all.db built from the morphemes of every note'''
+    notesMs = morphemesOfNotes( env )
+    def run():
+        db = buildDb( notesMs )
+        return { 'morphemes':len( db.db ), 'locations':len( db.locDb() ) }
+    return run
+
+@scenario( 'morphdb.save' )
+def morphDbSave( env ):
+    '''Writing all.db'''
+    db, path = buildDb( morphemesOfNotes( env ) ), env.path( 'all.db' )
+    def run():
+        db.save( path )
+        return { 'morphemes':len( db.db ), 'bytes':os.path.getsize( path ) }
+    return run
+
+@scenario( 'morphdb.load' )
+def morphDbLoad( env ):
+    '''Reading all.db'''
+    from ..morphemes import MorphDb
+    path = env.path( 'all.db' )
+    buildDb( morphemesOfNotes( env ) ).save( path )
+    def run():
+        return { 'morphemes':len( MorphDb( path ).db ) }
+    return run
+
+@scenario( 'morphstore.lookups' )
+def morphStoreLookups( env ):
+    '''Single morpheme questions answered from the file (stats, mm next)'''
+    from ..morphStore import MorphStore
+    path = env.path( 'all.db' )
+    db = buildDb( morphemesOfNotes( env ) )
+    db.save( path )
+    ms = list( db.db )[ :2000 ]
+    def run():
+        store = MorphStore( path )
+        try:
+            for m in ms:
+                store.frequency( m )
+                store.maxMaturity( m )
+        finally:
+            store.close()
+        return { 'lookups':2 * len( ms ) }
+    return run
+
+@scenario( 'snapshot.lookups' )
+def snapshotLookups( env ):
+    '''The same questions answered from the reviewer's mapped snapshot, including opening it'''
+    from .. import morphSnapshot
+    path = env.path( 'all.snapshot' )
+    db = buildDb( morphemesOfNotes( env ) )
+    morphSnapshot.write( path, db )
+    ms = list( db.db )[ :2000 ]
+    def run():
+        snap = morphSnapshot.Snapshot( path )
+        try:
+            for m in ms:
+                snap.frequency( m )
+                snap.maxMaturity( m )
+        finally:
+            snap.close()
+        return { 'lookups':2 * len( ms ) }
+    return run
+
+@scenario( 'snapshot.write' )
+def snapshotWrite( env ):
+    '''Writing the snapshot at the end of Recalc'''
+    from .. import morphSnapshot
+    db, path = buildDb( morphemesOfNotes( env ) ), env.path( 'all.snapshot' )
+    def run():
+        morphSnapshot.write( path, db )
+        return { 'morphemes':len( db.db ), 'bytes':os.path.getsize( path ) }
+    return run
+
+@scenario( 'scoring' )
+def scoring( env ):
+    '''Maturity tiers, the per-morpheme table and the MMI of every note'''
+    from ..morphemes import MaturityTiers
+    from ..scoring import MorphemeTable, NoteWeights, scoreNotes
+    notesMs = morphemesOfNotes( env )
+    db = buildDb( notesMs )
+    ids = [ sorted( set( m.id for m in ms ) ) for n, ms in notesMs ]
+    weights = [ NoteWeights( WEIGHTS.__getitem__ ) ] * len( ids )
+    def run():
+        tiers = MaturityTiers( db, *THRESHOLDS )
+        scoreNotes( MorphemeTable( db, {}, tiers ), ids, weights )
+        return { 'notes':len( ids ), 'morphemes':len( db.db ) }
+    return run
+
+@scenario( 'scoring.parallel' )
+def scoringParallel( env ):
+    '''The same, with the notes scored in 4 worker processes'''
+    from ..morphemes import MaturityTiers
+    from ..scoring import MorphemeTable, NoteWeights, scoreNotesParallel
+    notesMs = morphemesOfNotes( env )
+    db = buildDb( notesMs )
+    ids = [ sorted( set( m.id for m in ms ) ) for n, ms in notesMs ]
+    weights = [ NoteWeights( WEIGHTS.__getitem__ ) ] * len( ids )
+    def run():
+        tiers = MaturityTiers( db, *THRESHOLDS )
+        scoreNotesParallel( MorphemeTable( db, {}, tiers ), ids, weights, 4 )
+        return { 'notes':len( ids ), 'morphemes':len( db.db ), 'processes':4 }
+    return run
+
+@scenario( 'scoring.parity' )
+def scoringParity( env ):
+    '''All scoring paths against the old note by note MMI (see parity.py); fails on a difference'''
+    from . import parity
+    def run():
+        return parity.check( notes=env.args.notes, seed=env.args.seed )
+    return run
+
+################################################################################
+## Scenarios through Anki's code paths
+################################################################################
+
+def cfgPath( key ): # Str -> FilePath
+    from ..util import cfg1
+    return cfg1( key )
+
+def removeDbs(): # IO ()
+    for key in [ 'path_all', 'path_seen', 'path_known', 'path_mature' ]:
+        if os.path.exists( cfgPath( key ) ):
+            os.remove( cfgPath( key ) )
+
+@scenario( 'recalc.full', anki=True )
+def recalcFull( env ):
+    '''mkAllDb from scratch: reading notes, bulk morphemizing, building and saving all.db'''
+    from .. import main
+    env.freshCollection()
+    removeDbs()
+    useMorphCache( env.path( 'morph_cache.log' ) )
+    def run():
+        return { 'morphemes':len( main.mkAllDb( None ).db ) }
+    return run
+
+@scenario( 'recalc.incremental', anki=True )
+def recalcIncremental( env ):
+    '''mkAllDb after a fraction of the notes was edited or reviewed'''
+    from .. import main
+    env.freshCollection()
+    removeDbs()
+    useMorphCache( env.path( 'morph_cache.log' ) )
+    allDb = main.mkAllDb( None )
+    n = collection.touchNotes( env.mw.col.db.conn, env.args.touch )
+    def run():
+        main.mkAllDb( allDb )
+        return { 'touched notes':n }
+    return run
+
+@scenario( 'updateNotes', anki=True )
+def updateNotes( env ):
+    '''Tiering, scoring and writing note fields, tags and new card order'''
+    from .. import main
+    env.freshCollection()
+    useMorphCache( env.path( 'morph_cache.log' ) )
+    allDb = main.mkAllDb( None )
+    def run():
+        return { 'known':len( main.updateNotes( allDb ) ) }
+    return run
+
+@scenario( 'reviewer.highlight', anki=True )
+def reviewerHighlight( env ):
+    '''The morphHighlight field filter on the expressions of the first 1000 notes'''
+    from .. import main, util, newMorphHelper, morphSnapshot
+    env.freshCollection()
+    useMorphCache( env.path( 'morph_cache.log' ) )
+    util.closeSnapshot()
+    morphSnapshot.write( cfgPath( 'path_snapshot' ), main.mkAllDb( None ) )
+    fieldDicts = [ ( expr, { 'Tags':' '.join( tags ), 'Type':collection.modelName( lang ), 'Expression':expr } )
+                   for nid, guid, lang, tags, expr, mats in env.notes()[ :1000 ] ]
+    def run():
+        for expr, fieldDict in fieldDicts:
+            newMorphHelper.highlight( expr, '', fieldDict, 'Expression', 'morphHighlight' )
+        return { 'fields':len( fieldDicts ) }
+    return run
+
+################################################################################
+## Running
+################################################################################
+
+def runScenario( env, name, anki, f, repeat ): # Env -> Name -> Bool -> ( Env -> IO ( IO a ) ) -> Int -> IO Map Str a
+    if anki and env.ankiMissing:
+        return { 'name':name, 'skipped':env.ankiMissing }
+    times, info = [], None
+    for i in range( repeat ):
+        run = f( env )
+        t_0 = time.perf_counter()
+        info = run()
+        times.append( time.perf_counter() - t_0 )
+    return { 'name':name, 'seconds':times, 'min':min( times ), 'median':statistics.median( times ), 'info':info or {} }
+
+def compare( old, new ): # Map Str a -> Map Str a -> Str
+    '''Median time of every scenario relative to an earlier report'''
+    before = dict( ( r['name'], r ) for r in old['results'] if 'median' in r )
+    lines = []
+    for r in new['results']:
+        if 'median' not in r or r['name'] not in before: continue
+        ratio = r['median'] / before[ r['name'] ]['median'] if before[ r['name'] ]['median'] else float( 'inf' )
+        lines.append( '%-24s %10.4fs -> %10.4fs  x%.2f' % ( r['name'], before[ r['name'] ]['median'], r['median'], ratio ) )
+    return '\n'.join( lines )
+
+def main( argv=None ):
+    from .. import version
+    parser = argparse.ArgumentParser( prog='python -m morph.bench', description=__doc__.strip().split( '\n' )[0] )
+    parser.add_argument( '-k', '--scenario', action='append', default=[], help='only run scenarios whose name starts with this (repeatable)' )
+    parser.add_argument( '-l', '--list', action='store_true', help='list the scenarios and exit' )
+    parser.add_argument( '-n', '--notes', type=int, default=5000 )
+    parser.add_argument( '--fields', type=int, default=2, help='text fields per note (besides the MorphMan fields)' )
+    parser.add_argument( '--tags', type=int, default=20, help='size of the pool of extra tags' )
+    parser.add_argument( '--languages', default='ja', help='comma separated, out of %s' % ','.join( sorted( collection.LANGUAGES ) ) )
+    parser.add_argument( '--cards-per-note', type=int, default=1 )
+    parser.add_argument( '--new-ratio', type=float, default=0.4, help='fraction of new cards' )
+    parser.add_argument( '--max-ivl', type=int, default=365, help='longest review interval in days' )
+    parser.add_argument( '--vocab', type=int, default=20000, help='distinct words per language' )
+    parser.add_argument( '--touch', type=float, default=0.05, help='fraction of notes changed before an incremental Recalc' )
+    parser.add_argument( '--seed', type=int, default=0 )
+    parser.add_argument( '-r', '--repeat', type=int, default=3 )
+    parser.add_argument( '--real-mecab', action='store_true', help='use the installed mecab instead of the fake one' )
+    parser.add_argument( '--work-dir', help='keep the fixture here instead of a temporary directory' )
+    parser.add_argument( '-o', '--out', help='write the report here instead of stdout' )
+    parser.add_argument( '--compare', help='earlier report to print relative timings against (to stderr)' )
+    args = parser.parse_args( argv )
+    args.languages = [ l for l in args.languages.split( ',' ) if l ]
+    for l in args.languages:
+        if l not in collection.LANGUAGES: parser.error( 'unknown language: %s' % l )
+
+    selected = [ s for s in SCENARIOS if not args.scenario or any( s[0].startswith( k ) for k in args.scenario ) ]
+    if args.list:
+        for name, anki, f in SCENARIOS:
+            print( '%-24s %s%s' % ( name, ( f.__doc__ or '' ).strip(), ' (needs Anki)' if anki else '' ) )
+        return
+
+    workDir = args.work_dir or tempfile.mkdtemp( prefix='morphman-bench-' )
+    try:
+        if not args.real_mecab:
+            fakeMecab.install( os.path.join( workDir, 'bin' ) )
+        env = Env( workDir, args )
+        t_0 = time.perf_counter()
+        collection.makeCollection( env.pristine, notes=args.notes, fields=args.fields, tags=args.tags, languages=args.languages,
+                cardsPerNote=args.cards_per_note, newRatio=args.new_ratio, maxIvl=args.max_ivl, vocab=args.vocab, seed=args.seed )
+        generated = time.perf_counter() - t_0
+        env.setupAnki()
+
+        results = []
+        for name, anki, f in selected:
+            print( 'running %s' % name, file=sys.stderr )
+            results.append( runScenario( env, name, anki, f, args.repeat ) )
+    finally:
+        from ..morphemizer import mecabPool
+        mecabPool().shutdown()
+        if not args.work_dir:
+            shutil.rmtree( workDir, ignore_errors=True )
+
+    from ..scoring import numpyOrNone
+    report = {
+        'morphman':version, 'python':platform.python_version(), 'platform':platform.platform(),
+        'numpy':numpyOrNone() is not None, 'mecab':'real' if args.real_mecab else 'fake',
+        'fixture':{ 'notes':args.notes, 'fields':args.fields, 'tags':args.tags, 'languages':args.languages, 'cards per note':args.cards_per_note,
+                    'new ratio':args.new_ratio, 'max ivl':args.max_ivl, 'vocab':args.vocab, 'seed':args.seed, 'seconds to generate':generated },
+        'repeat':args.repeat,
+        'results':results,
+    }
+    out = json.dumps( report, indent=2, ensure_ascii=False )
+    if args.out:
+        with open( args.out, 'w' ) as f:
+            f.write( out + '\n' )
+    else:
+        print( out )
+    if args.compare:
+        with open( args.compare ) as f:
+            print( compare( json.load( f ), report ), file=sys.stderr )
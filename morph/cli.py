@@ -1,14 +1,21 @@
 import argparse
 import codecs
 from collections import Counter, defaultdict
+import functools
 import glob
+import heapq
 import itertools
 import math
+import multiprocessing
 import os.path
 import signal
 import sys
+import tempfile
 
 from .morphemes import MorphDb, Morpheme
+from .morphStore import MorphStore
+from . import corpusIndex
+from .util_external import fileLock
 from .morphemizer import SpaceMorphemizer, SpacyMorphemizer, MecabMorphemizer, CjkCharMorphemizer
 import morph
 
@@ -110,28 +117,164 @@ def cmd_dump(args):
     path = db_path(db_name)
     if not os.access(path, os.R_OK):
         die('can\'t read db file: %s' % (path,))
-    db = MorphDb(path)
+    # Only the morpheme table is needed, so don't load the whole db.
+    store = MorphStore(path)
 
-    for m in list(db.db.keys()):
-        m_formatted = m.show().encode('utf-8')
-        if inc_freq:
-            print('%d\t%s' % (db.frequency(m), m_formatted))
-        else:
-            print(m_formatted)
+    if inc_freq:
+        for m, freq in store.frequencies():
+            print('%d\t%s' % (freq, m.show()))
+    else:
+        for m in store.morphemes():
+            print(m.show())
 
 
-def cmd_count(args):
-    files = args.files
-    mizer = MIZERS[args.mizer]
-
-    freqs = Counter()
+def read_chunks(files, chunk_lines):
+    '''Yield the stripped lines of `files` in lists of at most `chunk_lines`, without reading whole files.'''
     for path in files:
         with codecs.open(path, 'r', 'utf-8') as f:
-            for line in f.readlines():
-                freqs.update(mizer.getMorphemesFromExpr(line.strip()))
+            while True:
+                lines = [line.strip() for line in itertools.islice(f, chunk_lines)]
+                if not lines:
+                    break
+                yield lines
+
+
+def morphemize_lines(mizer_name, lines):
+    '''The morphemes of each of `lines`, in bulk if the morphemizer can.'''
+    mizer = MIZERS[mizer_name]
+    bulk = getattr(mizer, 'getMorphemesFromExprBulk', None)
+    return bulk(lines) if bulk is not None else [mizer.getMorphemesFromExpr(line) for line in lines]
+
+
+def count_lines(mizer_name, lines):
+    '''Count the morphemes (by their `show()` form) in `lines`.'''
+    return Counter(m.show() for ms in morphemize_lines(mizer_name, lines) for m in ms)
+
+
+def show_lines(mizer_name, lines):
+    '''The `show()` forms of the morphemes of each of `lines`.'''
+    return [[m.show() for m in ms] for ms in morphemize_lines(mizer_name, lines)]
+
+
+def map_chunks(func, chunks, jobs):
+    '''Yield `func(chunk)` for each chunk in order, over `jobs` worker processes if more than one.'''
+    if jobs == 1:
+        for chunk in chunks:
+            yield func(chunk)
+        return
+    pool = multiprocessing.Pool(jobs, initializer=init_count_worker)
+    try:
+        for result in pool.imap(func, chunks):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def init_count_worker():
+    # Each worker is already one of N processes; don't let it start a MeCab per core on top.
+    from .morphemizer import setMecabPoolSize
+    setMecabPoolSize(1)
+
+
+class SpillingCounter(object):
+    '''A Counter of strings that writes its contents to sorted run files in `spill_dir`
+    whenever it holds more than `max_entries` keys, to keep memory bounded.'''
+
+    def __init__(self, max_entries=None, spill_dir=None):
+        self.max_entries = max_entries
+        self.spill_dir = spill_dir
+        self.counts = Counter()
+        self.runs = []
+
+    def update(self, counts):
+        self.counts.update(counts)
+        if self.max_entries is not None and len(self.counts) > self.max_entries:
+            self.runs.append(self._write_run(sorted(self.counts.items())))
+            self.counts = Counter()
+
+    def _write_run(self, items):
+        fd, path = tempfile.mkstemp(prefix='mm-count-', suffix='.txt', dir=self.spill_dir)
+        with codecs.open(path, 'w', 'utf-8') as f:
+            os.close(fd)
+            for key, c in items:
+                f.write('%s\t%d\n' % (key, c))
+        return path
+
+    @staticmethod
+    def _read_run(path):
+        with codecs.open(path, 'r', 'utf-8') as f:
+            for line in f:
+                key, c = line.rstrip('\n').rsplit('\t', 1)
+                yield key, int(c)
+
+    def most_common(self):
+        '''Yield (key, count) by decreasing count (ties by key), merging spilled runs if there are any.'''
+        order = lambda kc: (-kc[1], kc[0])
+        if not self.runs:
+            for kc in sorted(self.counts.items(), key=order):
+                yield kc
+            return
+
+        runs = self.runs + [self._write_run(sorted(self.counts.items()))]
+        self.counts, self.runs = Counter(), []
+        by_count = []
+        try:
+            # sum the counts of each key over all runs, then sort the totals by count, again in bounded runs
+            merged = heapq.merge(*[self._read_run(path) for path in runs])
+            batch = []
+            for key, group in itertools.groupby(merged, key=lambda kc: kc[0]):
+                batch.append((key, sum(c for _, c in group)))
+                if len(batch) >= self.max_entries:
+                    by_count.append(self._write_run(sorted(batch, key=order)))
+                    batch = []
+            by_count.append(self._write_run(sorted(batch, key=order)))
+            for kc in heapq.merge(*[self._read_run(path) for path in by_count], key=order):
+                yield kc
+        finally:
+            for path in runs + by_count:
+                os.remove(path)
+
+
+def cmd_count(args):
+    files = args.files
+    jobs = args.jobs or multiprocessing.cpu_count()
+
+    freqs = SpillingCounter(args.max_entries, args.spill_dir)
+    chunks = read_chunks(files, args.chunk_lines)
+    if jobs == 1:
+        for lines in chunks:
+            freqs.update(count_lines(args.mizer, lines))
+    else:
+        pool = multiprocessing.Pool(jobs, initializer=init_count_worker)
+        try:
+            # order doesn't matter for counting
+            for counts in pool.imap_unordered(functools.partial(count_lines, args.mizer), chunks):
+                freqs.update(counts)
+        finally:
+            pool.terminate()
 
     for m, c in freqs.most_common():
-        print('%d\t%s' % (c, m.show().encode('utf-8')))
+        print('%d\t%s' % (c, m))
+
+
+def open_index(path, args, text):
+    '''The corpus index of `path` if it can be used for this command, else None.'''
+    if args.no_index:
+        return None
+    idx = corpusIndex.openIndex(path, args.mizer, text)
+    if idx is None and os.path.exists(corpusIndex.indexPath(path)):
+        warn('ignoring index of %s: the file changed or it was built with other options (rebuild it with `mm index`)' % path)
+    return idx
+
+
+def cmd_index(args):
+    text = corpusIndex.TEXT_FIRST_FIELD if args.first_field else corpusIndex.TEXT_LINE
+    jobs = args.jobs or multiprocessing.cpu_count()
+    for path in args.files:
+        n = corpusIndex.buildIndex(path, args.mizer, text,
+                                   lambda chunks: map_chunks(functools.partial(show_lines, args.mizer), chunks, jobs),
+                                   args.chunk_lines)
+        warn('indexed %d lines of %s' % (n, path))
 
 
 def cmd_next(args):
@@ -139,24 +282,36 @@ def cmd_next(args):
     prio_path = args.prio
     mizer = MIZERS[args.mizer]
 
-    known = load_db('known')
+    # Only the morpheme table of known.db is needed.
+    path = db_path('known')
+    if not os.access(path, os.R_OK):
+        die('can\'t read db file: %s' % (path,))
+    store = MorphStore(path)
+    known = set(m.show() for m in store.morphemes())
+    store.close()
 
     candidates = defaultdict(list)
-    with codecs.open(notes_path, 'r', 'utf-8') as f:
-        for line in f.readlines():
-            note = line.strip()
-            text = note.split('\t', 1)[0]
-            unknowns = [m for m in mizer.getMorphemesFromExpr(text)
-                        if m not in known.db]
-            if len(unknowns) == 1:
-                candidates[unknowns[0].show()].append(note)
+    idx = open_index(notes_path, args, corpusIndex.TEXT_FIRST_FIELD)
+    if idx is not None:
+        for show, line in idx.singleUnknowns(known, corpusIndex.fileStamp(path)):
+            candidates[show].append(line.strip())
+        idx.close()
+    else:
+        with codecs.open(notes_path, 'r', 'utf-8') as f:
+            for line in f:
+                note = line.strip()
+                text = note.split('\t', 1)[0]
+                unknowns = [m for m in mizer.getMorphemesFromExpr(text)
+                            if m.show() not in known]
+                if len(unknowns) == 1:
+                    candidates[unknowns[0].show()].append(note)
 
     with codecs.open(prio_path, 'r', 'utf-8') as f:
-        for line in f.readlines():
+        for line in f:
             freq, m = line.strip().split('\t', 1)
             m_cite = m.split('\t', 1)[0]
             for cand in candidates[m]:
-                print (u'%s\t%s\t%s' % (freq, m_cite, cand)).encode('utf-8')
+                print(u'%s\t%s\t%s' % (freq, m_cite, cand))
 
 
 def cmd_grep(args):
@@ -165,32 +320,42 @@ def cmd_grep(args):
     max_count = args.max_count
     mizer = MIZERS[args.mizer]
 
-    pattern = parse_morpheme(pattern_string.decode('utf-8'))
+    pattern = parse_morpheme(pattern_string)
 
-    count = 0
-    for path in files:
+    def matches(path):
+        idx = open_index(path, args, corpusIndex.TEXT_LINE)
+        if idx is not None:
+            for line in idx.grep(pattern.show()):
+                yield line
+            idx.close()
+            return
         with codecs.open(path, 'r', 'utf-8') as f:
             for line in f:
-                ms = mizer.getMorphemesFromExpr(line)
-                if pattern in ms:
-                    sys.stdout.write(line.encode('utf-8'))
-                    count += 1
-                    if max_count is not None and count >= max_count:
-                        return
+                if pattern in mizer.getMorphemesFromExpr(line):
+                    yield line
+
+    count = 0
+    for path in files:
+        for line in matches(path):
+            sys.stdout.write(line)
+            count += 1
+            if max_count is not None and count >= max_count:
+                return
 
 
 def clear_locs(db, pred):
     '''Remove from `db` locations that match `pred`, and morphemes left without locations.'''
-    empty_ms = []
-    for m, locs in db.db.iteritems():
-        locs.difference_update([loc for loc in locs if pred(loc)])
-        if not locs:
-            empty_ms.append(m)
-    for m in empty_ms:
-        del db.db[m]
+    db.removeLocs(pred)
 
 
 def cmd_sync_known(args):
+    # external.db is read, changed and written back; hold its lock throughout so a concurrent
+    # writer (another mm, or Anki) can't slip in between
+    with fileLock(db_path('external')):
+        sync_known(args)
+
+
+def sync_known(args):
     filenames = args.input or ['known.txt']
     should_merge = args.merge
 
@@ -213,6 +378,11 @@ def cmd_sync_known(args):
 
 
 def cmd_sync_freq(args):
+    with fileLock(db_path('external')):
+        sync_freq(args)
+
+
+def sync_freq(args):
     corpus_name = args.name
     freq_path = args.freqfile
     threshold = args.threshold
@@ -270,12 +440,21 @@ def main():
                         description='Count all morphemes in the given files and emit a frequency table.')
     p_count.set_defaults(action=cmd_count)
     p_count.add_argument('files', nargs='*', metavar='FILE', help='input files of text to morphemize')
+    p_count.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                         help='number of worker processes; 0 means one per CPU (default: 1)')
+    p_count.add_argument('--chunk-lines', type=int, default=10000, metavar='N',
+                         help='lines handed to a worker at a time (default: 10000)')
+    p_count.add_argument('--max-entries', type=int, metavar='N',
+                         help='spill counts to disk whenever more than N distinct morphemes are held in memory')
+    p_count.add_argument('--spill-dir', metavar='DIR',
+                         help='directory for spilled counts (default: system temp dir)')
     add_mizer(p_count)
 
     p_next = subparsers.add_parser('next', help='find next notes to study from a corpus')
     p_next.set_defaults(action=cmd_next)
     p_next.add_argument('prio', metavar='FREQS', help='file of morphemes to study, with frequencies')
     p_next.add_argument('notes', metavar='NOTES', help='file of newline-terminated notes, each tab-separated fields starting with the text')
+    p_next.add_argument('--no-index', action='store_true', help='don\'t use an index of NOTES made by `mm index --first-field`')
     add_mizer(p_next)
 
     p_grep = subparsers.add_parser('grep', help='find given morpheme in a corpus', description='\
@@ -284,8 +463,26 @@ Search the given corpus for the given morpheme and print matches.')
     p_grep.add_argument('pattern', metavar='MORPHEME', help='morpheme, in MorphMan tab-separated form')
     p_grep.add_argument('files', nargs='*', metavar='FILE', help='files of text to search')
     p_grep.add_argument('-m', '--max-count', type=int, metavar='NUM', help='max matches to print')
+    p_grep.add_argument('--no-index', action='store_true', help='don\'t use indexes made by `mm index`')
     add_mizer(p_grep)
 
+    p_index = subparsers.add_parser('index', help='index a corpus for grep and next', description='''\
+Build an index of the morphemes in each given file, stored next to it as FILE%s.
+
+`mm grep` and `mm next` use an index instead of morphemizing the file again, as long as the
+file hasn't changed and the same --mizer is used.  For `mm next`, index the notes file with
+--first-field.
+''' % corpusIndex.INDEX_SUFFIX)
+    p_index.set_defaults(action=cmd_index)
+    p_index.add_argument('files', nargs='*', metavar='FILE', help='files of text to index')
+    p_index.add_argument('--first-field', action='store_true',
+                         help='only index the text before the first tab of each line, as `mm next` reads notes')
+    p_index.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                         help='number of worker processes; 0 means one per CPU (default: 1)')
+    p_index.add_argument('--chunk-lines', type=int, default=10000, metavar='N',
+                         help='lines handed to a worker at a time (default: 10000)')
+    add_mizer(p_index)
+
     p_sync_known = subparsers.add_parser('sync-known', help='sync known-morphemes file to external.db',
                                          description='''\
 Read a text file of known morphemes and sync that information to external.db.
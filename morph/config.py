@@ -8,12 +8,17 @@ default = {
     'path_priority': os.path.join( mw.pm.profileFolder(), 'dbs', 'priority.db' ),
     'path_ext': os.path.join( mw.pm.profileFolder(), 'dbs', 'external.db' ),
     'path_all': os.path.join( mw.pm.profileFolder(), 'dbs', 'all.db' ),
+    'path_snapshot': os.path.join( mw.pm.profileFolder(), 'dbs', 'all.snapshot' ), # max maturity and frequency of every morpheme in all.db, for the reviewer
     'path_mature': os.path.join( mw.pm.profileFolder(), 'dbs', 'mature.db' ),
     'path_known': os.path.join( mw.pm.profileFolder(), 'dbs', 'known.db' ),
     'path_seen': os.path.join( mw.pm.profileFolder(), 'dbs', 'seen.db' ),
     'path_json': os.path.join( mw.pm.profileFolder(), 'dbs', 'morphman_config.json' ),
     'path_log': os.path.join( mw.pm.profileFolder(), 'morphman.log' ),
     'path_stats': os.path.join( mw.pm.profileFolder(), 'morphman.stats' ),
+    'path_timings': os.path.join( mw.pm.profileFolder(), 'morphman.timings' ),   # per-stage timings and counters of every Recalc, one JSON object per line
+    'log level': 'INFO',            # 'DEBUG' also logs per note details during Recalc
+    'log max bytes': 1024*1024,     # morphman.log is moved to morphman.log.1 (and so on) once it gets bigger than this. None means never
+    'log backups': 2,               # how many of those old logs are kept
         # change the thresholds for various stages of maturity, in days
     'threshold_mature': 21,         # 21 days is what Anki uses
     'threshold_known': 10/86400.,   # recommend a few seconds if you want to count things in learning queue or ~3 days otherwise
@@ -30,6 +35,23 @@ default = {
         # so not saving all.db and having it load an out of date copy many produce strange behavior
     'loadAllDb':True,   # whether to load existing all.db when recalculating or create one from scratch
     'saveDbs':True,     # whether to save all.db, known.db, mature.db, and seen.db
+    'incremental recalc':True,  # only re-analyze notes modified since the last Recalc (needs loadAllDb). everything is re-analyzed if the filters or maturity settings change
+    'write batch size': 1000,   # Recalc writes changed notes to the collection this many at a time, as soon as they are computed; only a few such batches are kept in memory
+    'background recalc':True,  # run the analysis and scoring of Recalc in a worker thread, so Anki stays usable; notes are written at the end
+    'scoring processes': 0,     # score notes in this many worker processes during Recalc; 0 scores in Anki itself. needs Anki running on a regular Python install (not the official builds)
+
+    'mecab processes': None,    # how many mecab processes Recalc uses for Japanese; None means one per CPU core. single lookups (eg. from the reviewer) have one more of their own
+
+    # memory limits for caches kept while Anki is running. None means no limit. 'max bytes' is approximate.
+        # 'evict' is 'lru' (drop least recently used entries first) or 'lfu' (drop least frequently used entries first)
+    'cache policies': {
+        'morph cache':      { 'max entries': 200000, 'max bytes': None, 'evict': 'lru' },  # morphemes per expression, backed by dbs/morph_cache.log
+        'mecab interact':   { 'max entries': 50000,  'max bytes': None, 'evict': 'lru' },  # raw mecab output per expression
+        'mecab morphemes':  { 'max entries': 50000,  'max bytes': None, 'evict': 'lru' },  # parsed mecab output per expression
+        'mecab readings':   { 'max entries': 50000,  'max bytes': None, 'evict': 'lfu' },  # base form readings of verbs and adjectives
+        'filters':          { 'max entries': 10000,  'max bytes': None, 'evict': 'lru' },  # matching 'Filter' preference per note type and tag set
+        'highlight':        { 'max entries': 2000,   'max bytes': None, 'evict': 'lru' },  # fields rendered by morphHighlight; emptied by Recalc
+    },
 
     # only these can have model overrides
     'enabled':False,    # whether to analyze notes of a given model, modify their fields, and manipulate due time by Morph Man Index
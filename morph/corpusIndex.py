@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+'''
+Persistent inverted index over a corpus file, used by `mm grep` and `mm next`.
+
+The index of `corpus.txt` lives next to it in `corpus.txt.mmidx` (a SQLite db). It maps every
+morpheme to the lines it occurs in and keeps the byte offset of each line, so a query only
+reads the matching lines instead of morphemizing the whole file again. For `mm next` it also
+keeps the number of unknown morphemes per line; those counts are refreshed whenever known.db
+changed since they were computed.
+
+An index only applies to the file state (size, mtime), morphemizer and text mode it was built
+for; otherwise it is ignored and the corpus is scanned as before.
+'''
+import json, os, sqlite3
+
+from .util_external import atomicPath
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.mmidx'
+
+# What part of a line was morphemized
+TEXT_LINE = 'line'                # the whole line (mm grep)
+TEXT_FIRST_FIELD = 'first field'  # the text before the first tab (notes files for mm next)
+
+SCHEMA = '''
+create table meta (
+    key     text primary key,
+    value   text
+);
+create table morphemes (
+    id      integer primary key,
+    show    text not null unique
+);
+create table lines (
+    no          integer primary key,
+    offset      integer not null,
+    unknowns    integer
+);
+create table postings (
+    mid     integer not null,
+    line    integer not null,
+    n       integer not null,
+    primary key ( mid, line )
+) without rowid;
+'''
+INDEXES = '''
+create index ix_postings_line on postings ( line, mid );
+'''
+
+def indexPath( path ): # FilePath -> FilePath
+    return path + INDEX_SUFFIX
+
+def fileStamp( path ): # FilePath -> IO [Int]
+    st = os.stat( path )
+    return [ st.st_size, st.st_mtime_ns ] # whole seconds would miss a rewrite of the same size within the second
+
+def lineText( line, text ): # Str -> TextMode -> Str
+    line = line.strip()
+    return line.split( '\t', 1 )[0] if text == TEXT_FIRST_FIELD else line
+
+################################################################################
+## Building
+################################################################################
+
+def readLines( path, chunkLines ): # FilePath -> Int -> IO [[( Offset, Str )]]
+    '''Yields the lines of a file with their byte offsets, `chunkLines` at a time'''
+    with open( path, 'rb' ) as f:
+        chunk, offset = [], 0
+        for raw in f:
+            chunk.append( ( offset, raw.decode( 'utf-8' ) ) )
+            offset += len( raw )
+            if len( chunk ) >= chunkLines:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+def buildIndex( path, mizerName, text, analyzeChunks, chunkLines=10000 ): # FilePath -> Str -> TextMode -> ([[Str]] -> IO [[Str]]) -> Int -> IO Int
+    '''Indexes a corpus file. `analyzeChunks` maps chunks of line texts to the `show()`s of the
+    morphemes of each line, chunk by chunk in order (so it may fan out to other processes).
+    Returns the number of lines indexed.'''
+    with atomicPath( indexPath( path ) ) as tmp:
+        return _buildIndex( tmp, path, mizerName, text, analyzeChunks, chunkLines )
+
+def _buildIndex( tmp, path, mizerName, text, analyzeChunks, chunkLines ): # FilePath -> FilePath -> Str -> TextMode -> ([[Str]] -> IO [[Str]]) -> Int -> IO Int
+    stamp = fileStamp( path )
+    conn = sqlite3.connect( tmp )
+    try:
+        conn.execute( 'pragma journal_mode = off' )
+        conn.execute( 'pragma synchronous = off' )
+        conn.executescript( SCHEMA )
+        mids = {} # Map Str Int
+
+        def mid( show ):
+            try:
+                return mids[ show ]
+            except KeyError:
+                i = mids[ show ] = len( mids ) + 1
+                conn.execute( 'insert into morphemes values ( ?,? )', ( i, show ) )
+                return i
+
+        chunks = []     # offsets of the chunks handed out, in order
+        def texts():
+            for chunk in readLines( path, chunkLines ):
+                chunks.append( [ offset for offset, line in chunk ] )
+                yield [ lineText( line, text ) for offset, line in chunk ]
+
+        no = 0
+        for i, showss in enumerate( analyzeChunks( texts() ) ):
+            offsets, chunks[ i ] = chunks[ i ], None
+            for offset, shows in zip( offsets, showss ):
+                no += 1
+                conn.execute( 'insert into lines values ( ?,?,null )', ( no, offset ) )
+                counts = {}
+                for show in shows:
+                    counts[ show ] = counts.get( show, 0 ) + 1
+                conn.executemany( 'insert into postings values ( ?,?,? )', ( ( mid( show ), no, n ) for show, n in counts.items() ) )
+
+        conn.executescript( INDEXES )
+        meta = { 'version':INDEX_VERSION, 'mizer':mizerName, 'text':text, 'stamp':stamp, 'known':None }
+        conn.executemany( 'insert into meta values ( ?,? )', ( ( k, json.dumps( v ) ) for k, v in meta.items() ) )
+        conn.commit()
+    finally:
+        conn.close()
+    return no
+
+################################################################################
+## Querying
+################################################################################
+
+class CorpusIndex:
+    def __init__( self, path ): # FilePath -> IO ()
+        self.path = path
+        self.conn = sqlite3.connect( indexPath( path ) )
+        self.meta = dict( ( k, json.loads( v ) ) for k, v in self.conn.execute( 'select key, value from meta' ) )
+
+    def close( self ): # IO ()
+        self.conn.close()
+
+    def usableFor( self, mizerName, text ): # Str -> TextMode -> IO Bool
+        return ( self.meta.get( 'version' ) == INDEX_VERSION and self.meta.get( 'mizer' ) == mizerName
+                 and self.meta.get( 'text' ) == text and self.meta.get( 'stamp' ) == fileStamp( self.path ) )
+
+    def readLinesAt( self, offsets ): # [Offset] -> IO [Str]
+        with open( self.path, 'rb' ) as f:
+            for offset in offsets:
+                f.seek( offset )
+                yield f.readline().decode( 'utf-8' )
+
+    def grep( self, show ): # Str -> IO [Str]
+        '''Lines containing the morpheme, in file order'''
+        offsets = [ r[0] for r in self.conn.execute( '''select offset from lines join postings on line = no
+                join morphemes on mid = morphemes.id where show = ? order by no''', ( show, ) ) ]
+        return self.readLinesAt( offsets )
+
+    def refreshUnknowns( self, known, knownStamp ): # {Str} -> a -> IO ()
+        '''Recounts the unknown morphemes per line, unless they were counted for the same known.db'''
+        if self.meta.get( 'known' ) == knownStamp: return
+        self._loadKnown( known )
+        self.conn.execute( '''update lines set unknowns = ( select coalesce( sum( n ), 0 ) from postings
+                where line = lines.no and mid not in ( select id from known_ids ) )''' )
+        self.meta[ 'known' ] = knownStamp
+        self.conn.execute( "insert or replace into meta values ( 'known', ? )", ( json.dumps( knownStamp ), ) )
+        self.conn.commit()
+
+    def _loadKnown( self, known ): # {Str} -> IO ()
+        self.conn.execute( 'create temp table if not exists known_shows ( show text primary key )' )
+        self.conn.execute( 'delete from known_shows' )
+        self.conn.executemany( 'insert or ignore into known_shows values ( ? )', ( ( s, ) for s in known ) )
+        self.conn.execute( 'drop view if exists known_ids' )
+        self.conn.execute( 'create temp view known_ids as select id from morphemes join known_shows using ( show )' )
+
+    def singleUnknowns( self, known, knownStamp ): # {Str} -> a -> IO [( Str, Str )]
+        '''(unknown morpheme, line) for every line with exactly one unknown morpheme, in file order'''
+        self.refreshUnknowns( known, knownStamp )
+        self._loadKnown( known )
+        rows = self.conn.execute( '''select show, offset from lines join postings on line = no join morphemes on mid = morphemes.id
+                where unknowns = 1 and mid not in ( select id from known_ids ) order by no''' ).fetchall()
+        return zip( ( show for show, offset in rows ), self.readLinesAt( [ offset for show, offset in rows ] ) )
+
+def openIndex( path, mizerName, text ): # FilePath -> Str -> TextMode -> IO Maybe CorpusIndex
+    '''The index of a corpus file, if there is one that is up to date for this morphemizer and text mode'''
+    if not os.path.isfile( indexPath( path ) ): return None
+    try:
+        idx = CorpusIndex( path )
+    except sqlite3.DatabaseError:
+        return None
+    if idx.usableFor( mizerName, text ):
+        return idx
+    idx.close()
+    return None
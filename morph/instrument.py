@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+'''
+Timing spans and counters for Recalc.
+
+A run is started with `with recording( path ):`. Inside it, `with span( name ):` (or a
+`begin( name )` ... `end( name )` pair) times a stage and `count( name, n )` adds to a counter
+of the innermost open span and to the run's totals.
+When the run ends every span is appended to `path` as one JSON object per line:
+
+    {"run": "2019-01-15T12:00:00.123456", "span": "scoring", "parent": "updateNotes",
+     "start": 1.234, "seconds": 0.567, "counters": {"notes scored": 4711}}
+
+followed by a line for the run itself (span "run") with the total time and counters.
+`start` is relative to the start of the run. Outside of a run these functions do nothing,
+so code shared with the command line tool can call them unconditionally.
+
+A run is recorded from one thread at a time (the one that started it, or the last one that
+called `claim()`); calls from other threads, like the reviewer's while Recalc runs in the
+background, are ignored. `start()` and `stop()` are for runs that don't fit in a `with` block.
+
+Nothing here depends on Anki.
+'''
+import datetime, json, os, threading, time
+from contextlib import contextmanager
+
+class Span:
+    __slots__ = ( 'name', 'parent', 'start', 'seconds', 'counters' )
+
+    def __init__( self, name, parent, start ): # Str -> Maybe Str -> Float -> ()
+        self.name, self.parent, self.start = name, parent, start
+        self.seconds = None
+        self.counters = {} # Map Str Number
+
+    def record( self, run ): # Str -> Map Str a
+        return { 'run':run, 'span':self.name, 'parent':self.parent, 'start':round( self.start, 6 ),
+                 'seconds':None if self.seconds is None else round( self.seconds, 6 ), 'counters':self.counters }
+
+class Recorder:
+    def __init__( self ): # ()
+        self.run = datetime.datetime.now().isoformat()
+        self.t_0 = time.perf_counter()
+        self.spans = []  # [Span]; closed or not, in the order they were opened
+        self.open = []   # [Span]; innermost last
+        self.totals = {} # Map Str Number
+        self.thread = threading.get_ident() # the thread recording
+
+    def now( self ): # IO Float
+        return time.perf_counter() - self.t_0
+
+    def count( self, name, n=1 ): # Str -> Number -> m ()
+        if self.open:
+            c = self.open[-1].counters
+            c[ name ] = c.get( name, 0 ) + n
+        self.totals[ name ] = self.totals.get( name, 0 ) + n
+
+    def lines( self ): # [Str]
+        out = [ json.dumps( s.record( self.run ), ensure_ascii=False ) for s in self.spans ]
+        out.append( json.dumps( { 'run':self.run, 'span':'run', 'parent':None, 'start':0,
+                                  'seconds':round( self.now(), 6 ), 'counters':self.totals }, ensure_ascii=False ) )
+        return out
+
+_recorder = None # Maybe Recorder; the run in progress
+
+def active(): # Bool
+    return _recorder is not None
+
+def current(): # Maybe Recorder
+    '''The run the calling thread records to'''
+    rec = _recorder
+    return rec if rec is not None and rec.thread == threading.get_ident() else None
+
+def claim(): # IO ()
+    '''Makes the calling thread the one recording the run'''
+    if _recorder is not None:
+        _recorder.thread = threading.get_ident()
+
+def start(): # IO ( Maybe Recorder )
+    '''Starts a run; returns the run it interrupts, to be passed to `stop()`'''
+    global _recorder
+    outer, _recorder = _recorder, Recorder()
+    return outer
+
+def stop( path, outer=None ): # Maybe FilePath -> Maybe Recorder -> IO ()
+    '''Ends the run and appends it to `path` (if given)'''
+    global _recorder
+    rec, _recorder = _recorder, outer
+    if rec is None: return
+    t = rec.now()
+    for s in rec.open: # left open by an exception
+        s.seconds = t - s.start
+    if path:
+        par = os.path.dirname( path )
+        if par and not os.path.exists( par ):
+            os.makedirs( par )
+        with open( path, 'a', encoding='utf-8' ) as f:
+            f.write( ''.join( l + '\n' for l in rec.lines() ) )
+
+@contextmanager
+def recording( path ): # Maybe FilePath -> IO ()
+    '''Records a run and appends it to `path` (if given) when it ends, also when it ends with an exception'''
+    outer = start()
+    rec = _recorder
+    try:
+        yield rec
+    finally:
+        stop( path, outer )
+
+def begin( name ): # Str -> IO ()
+    '''Opens a span; for stages that don't fit in a `with` block'''
+    rec = current()
+    if rec is None: return
+    s = Span( name, rec.open[-1].name if rec.open else None, rec.now() )
+    rec.spans.append( s )
+    rec.open.append( s )
+
+def end( name ): # Str -> IO ()
+    '''Closes the innermost open span with this name, and whatever is still open inside it'''
+    rec = current()
+    if rec is None: return
+    names = [ s.name for s in rec.open ]
+    if name not in names: return
+    i = len( names ) - 1 - names[::-1].index( name )
+    t = rec.now()
+    for s in rec.open[ i: ]:
+        s.seconds = t - s.start
+    del rec.open[ i: ]
+
+@contextmanager
+def span( name ): # Str -> IO ()
+    begin( name )
+    try:
+        yield
+    finally:
+        end( name )
+
+def count( name, n=1 ): # Str -> Number -> IO ()
+    rec = current()
+    if rec is not None:
+        rec.count( name, n )
+
+def countFile( name, path ): # Str -> FilePath -> IO ()
+    '''Adds the size of a file that was just written'''
+    rec = current()
+    if rec is not None and os.path.isfile( path ):
+        rec.count( name, os.path.getsize( path ) )
@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
-import time
+import hashlib, json, time
 
 from anki.utils import splitFields, joinFields, stripHTML, intTime, fieldChecksum
-from .morphemes import MorphDb, AnkiDeck, getMorphemes, getMorphCacheDB, Morpheme
+from .morphemes import MorphDb, AnkiDeck, MaturityTiers, SEEN, KNOWN, MATURE, getMorphemes, getMorphCacheDB, hasReplaceRules
 from .morphemizer import getAllMorphemizers, getMorphemizerByName
-from . import stats
-from .util import printf, mw, cfg, cfg1, partial, errorMsg, infoMsg, jcfg, jcfg2, getFilter
+from .scoring import MorphemeTable, NoteWeights, scoreNotes, scoreNotesParallel
+from . import instrument, stats
+from .util import printf, debugf, mw, cfg1, errorMsg, infoMsg, jcfg, jcfg2, getFilterByMidAndTags, resolvedCfg
 from . import util
-from .util_external import memoize
+from .instrument import begin, end, span, count
+from .util_external import memoize, cacheStats
 
 # only for jedi-auto-completion
 import aqt.main
@@ -49,85 +51,91 @@ def setField( mid, fs, k, v ): # nop if field DNE
     idx = getFieldIndex( k, mid )
     if idx: fs[ idx ] = v
 
+def noteRows( db, where ): # DB -> Str -> IO [ ( NoteId, ModelId, Str, Guid, Str, [Maturity] ) ]
+    """
+    Notes matching `where` (with notes aliased as "n") together with the maturities of their cards,
+    fetched with a single query instead of one cards query per note.
+    """
+    for nid, mid, flds, guid, tags, cards in db.execute( '''select n.id, n.mid, n.flds, n.guid, n.tags, group_concat( c.ivl || ':' || c.type )
+            from notes n left join cards c on c.nid = n.id where %s group by n.id''' % where ):
+        mats = []
+        for card in ( cards.split( ',' ) if cards else [] ):
+            ivl, ctype = map( int, card.split( ':' ) )
+            mats.append( 0.5 if ivl == 0 and ctype == 1 else ivl )
+        yield nid, mid, flds, guid, tags, mats
+
+def recalcFingerprint(): # Str
+    '''Hash of the settings that decide which morphemes and maturities notes get in all.db'''
+    settings = [ jcfg('Filter'), jcfg('ReplaceRules'), jcfg('Tag_AlreadyKnown'), cfg1('threshold_mature'), cfg1('ignore maturity'),
+                 util.cfgMod.model_overrides, util.cfgMod.profile_overrides ]
+    return hashlib.sha1( json.dumps( settings, sort_keys=True, default=repr ).encode( 'utf-8' ) ).hexdigest()
+
+def progress(): # Progress
+    '''Where Recalc reports its progress: the background task's dialog, or Anki's'''
+    from . import backgroundTask
+    task = backgroundTask.running()
+    return task.progress if task is not None else mw.progress
+
 def mkAllDb( allDb=None ):
-    from . import config; importlib.reload(config)
+    if not allDb: allDb = MorphDb()
+    batch = readAllDbNotes( allDb )
+    return batch and analyzeNotes( allDb, batch )
+
+def readAllDbNotes( allDb ): # MorphDb -> IO Maybe NoteBatch
+    '''The part of updating all.db that reads the collection: the notes that have to be analyzed
+    again. Notes that aren't analyzed anymore are removed from `allDb` right away.'''
+    from . import config; importlib.reload(config); util.applyCfg()
     t_0, db, TAG = time.time(), mw.col.db, mw.col.tags
+
+    # Only notes that (or whose cards) were modified since the last Recalc have to be looked at.
+    # Configuration changes can affect every note though, so then all of them are processed again.
+    fingerprint = recalcFingerprint()
+    since = allDb.meta.get( 'recalc mod' ) if cfg1('incremental recalc') and allDb.meta.get( 'recalc cfg' ) == fingerprint else None
+    highWater = max( db.scalar( 'select max(mod) from notes' ) or 0, db.scalar( 'select max(mod) from cards' ) or 0 )
+
     # TODO search for unsuspended cards rather than looking in tags
     # This would be more expected behaviour.
     # Unfortuantly, notes aren't suspended => cards are suspended
-    N_notes = db.scalar( 'select count() from notes where tags like "% morphman %"' )
-    N_enabled_notes = 0 # for providing an error message if there is no note that is used for processing
-    mw.progress.start( label='Prep work for all.db creation', max=N_notes, immediate=True )
+    where = 'n.tags like "% morphman %"'
+    if since is not None:
+        where += ' and ( n.mod >= %d or n.id in ( select nid from cards where mod >= %d ) )' % ( since, since )
+    N_notes = db.scalar( 'select count() from notes n where ' + where )
+    progress().start( label='Prep work for all.db creation', max=N_notes, immediate=True )
 
-    if not allDb: allDb = MorphDb()
+    # allDb is updated in place through its methods, which keep fidDb in sync
     fidDb   = allDb.fidDb()
-    locDb   = allDb.locDb( recalc=False )   # fidDb() already forces locDb recalc
-
-    mw.progress.update( label='Generating all.db data' )
-    bulkMorphemizers = [ m.__class__.__name__ for m in getAllMorphemizers() if getattr(m, 'getMorphemesFromExprBulk', None) != None]
-    print("bulkMorphemizers: ", bulkMorphemizers)
-    morphCacheDB = getMorphCacheDB()
-    for morphemizer_name in bulkMorphemizers:
-        fields = []
-        morphemizer = getMorphemizerByName(morphemizer_name)
-        for i,( nid, mid, flds, guid, tags ) in enumerate( db.execute( 'select id, mid, flds, guid, tags from notes where tags like "% morphman %"' ) ):
-            if i % 500 == 0:    mw.progress.update( value=i )
-            note = mw.col.getNote(nid)
-            notecfg = getFilter(note)
-            if notecfg is None: continue
-            if morphemizer_name != notecfg['Morphemizer']:
-                continue
-            for fieldName in notecfg['Fields']:
-                try: # if doesn't have field, continue
-                    #fieldValue = normalizeFieldValue( getField( fieldName, flds, mid ) )
-                    fieldValue = extractFieldData( fieldName, flds, mid )
-                except KeyError: continue
-                except TypeError:
-                    mname = mw.col.models.get( mid )[ 'name' ]
-                    errorMsg( 'Failed to get field "{field}" from a note of model "{model}". Please fix your config.py file to match your collection appropriately and ignore the following error.'.format( model=mname, field=fieldName ) )
-                    raise
-                    
-                fields.append(fieldValue)
-        fields = [e for e in fields if (morphemizer.getDescription(), e) not in morphCacheDB.cache]
-        fields = list(set(fields))
-        # fields = fields[:100]
-        def chunks(l, n):
-            """Yield successive n-sized chunks from l."""
-            for i in range(0, len(l), n):
-                yield l[i:i + n]
-        # import IPython
-        # IPython.embed()
-        for i, chunk in enumerate(chunks(fields, 10000)):
-            print("chunk", i)
-            print("new cache", len(morphCacheDB.cache))
-            morphemes = morphemizer.getMorphemesFromExprBulk(chunk)
-            new_cache = {(morphemizer.getDescription(), e): ms for (e,ms) in zip(chunk, morphemes)}
-            # print("old cache", len(morphCacheDB.cache))
-            # print("add new_cache", len(new_cache))
-            # print("new_cache", new_cache)
-            morphCacheDB.cache.update(new_cache)
-            morphCacheDB.save()
-        
-    print("Done bulking", N_notes)
-        
-    for i,( nid, mid, flds, guid, tags ) in enumerate( db.execute( 'select id, mid, flds, guid, tags from notes where tags like "% morphman %"' ) ):
-        if i % 500 == 0:    mw.progress.update( value=i )
-        C = partial( cfg, mid, None )
-
-        note = mw.col.getNote(nid)
-        notecfg = getFilter(note)
-        if notecfg is None: continue
-        morphemizer = getMorphemizerByName(notecfg['Morphemizer'])
+    nid2locs = {}
+    for ( nid, guid, fieldName ), loc in fidDb.items():
+        nid2locs.setdefault( nid, [] ).append( loc )
+
+    # Read every note once; the bulk morphemizers and the location building below both work from this
+    progress().update( label='Reading notes' )
+    begin( 'read notes' )
+    notes = [] # [ ( NoteId, Guid, [Tag], Filter, [Maturity], [ ( FieldName, FieldValue ) ] ) ]
+    alreadyKnownTag = jcfg('Tag_AlreadyKnown')
+    for i,( nid, mid, flds, guid, tags, mats ) in enumerate( noteRows( db, where ) ):
+        if i % 500 == 0:    progress().update( value=i )
+        C = resolvedCfg( mid )
+        count( 'notes scanned' )
+
+        ts = TAG.split( tags )
+        notecfg = getFilterByMidAndTags( mid, ts )
+        oldLocs = nid2locs.pop( nid, [] )
+        if notecfg is None:
+            count( 'notes skipped' )
+            for loc in oldLocs: allDb.removeLoc( loc )
+            continue
+
+        # fields that aren't analyzed anymore
+        for loc in oldLocs:
+            if loc.fieldName not in notecfg['Fields']: allDb.removeLoc( loc )
 
-        N_enabled_notes += 1
-
-        mats = [ ( 0.5 if ivl == 0 and ctype == 1 else ivl ) for ivl, ctype in db.execute( 'select ivl, type from cards where nid = :nid', nid=nid ) ]
         if C('ignore maturity'):
             mats = [ 0 for mat in mats ]
-        ts, alreadyKnownTag = TAG.split( tags ), jcfg('Tag_AlreadyKnown')
         if alreadyKnownTag in ts:
             mats += [ C('threshold_mature')+1 ]
 
+        fields = []
         for fieldName in notecfg['Fields']:
             try: # if doesn't have field, continue
                 #fieldValue = normalizeFieldValue( getField( fieldName, flds, mid ) )
@@ -137,88 +145,151 @@ def mkAllDb( allDb=None ):
                 mname = mw.col.models.get( mid )[ 'name' ]
                 errorMsg( 'Failed to get field "{field}" from a note of model "{model}". Please fix your config.py file to match your collection appropriately and ignore the following error.'.format( model=mname, field=fieldName ) )
                 raise
+            fields.append( ( fieldName, fieldValue ) )
+        notes.append( ( nid, guid, ts, notecfg, mats, fields ) )
+    N_enabled_notes = len( notes ) # for providing an error message if there is no note that is used for processing
+    # notes that were deleted or lost their morphman tag; with a full run every remaining note is such a note
+    alive = set( db.list( 'select id from notes where tags like "% morphman %"' ) ) if since is not None else set()
+    end( 'read notes' )
+    progress().finish()
+
+    if N_enabled_notes == 0 and since is None:
+        errorMsg('There is no card that can be analyzed or be moved. Add cards or (re-)check your configuration under "Tools -> MorhpMan Preferences" or in "Anki/addons/morph/config.py" for mistakes.')
+        return None
+    return t_0, since, highWater, fingerprint, N_notes, notes, nid2locs, alive
+
+def analyzeNotes( allDb, batch ): # MorphDb -> NoteBatch -> IO MorphDb
+    '''The part of updating all.db that doesn't touch the collection, so it can run in a worker
+    thread: morphemizing the notes readAllDbNotes returned, updating and saving all.db'''
+    t_0, since, highWater, fingerprint, N_notes, notes, nid2locs, alive = batch
+    fidDb = allDb.fidDb()
+    progress().start( label='Generating all.db data', max=len( notes ), immediate=True )
+    begin( 'bulk morphemize' )
+    bulkMorphemizers = [ m.__class__.__name__ for m in getAllMorphemizers() if getattr(m, 'getMorphemesFromExprBulk', None) != None]
+    debugf( 'bulk morphemizers: %s', bulkMorphemizers )
+    morphCacheDB = getMorphCacheDB()
+    for morphemizer_name in bulkMorphemizers:
+        morphemizer = getMorphemizerByName(morphemizer_name)
+        fields = set( fieldValue for ( nid, guid, ts, notecfg, mats, fs ) in notes
+                if notecfg['Morphemizer'] == morphemizer_name and not hasReplaceRules( ts ) for ( fieldName, fieldValue ) in fs )
+        fields = [e for e in fields if (morphemizer.getDescription(), e) not in morphCacheDB]
+        def chunks(l, n):
+            """Yield successive n-sized chunks from l."""
+            for i in range(0, len(l), n):
+                yield l[i:i + n]
+        for i, chunk in enumerate(chunks(fields, 10000)):
+            progress().update( label='Analyzing %d expressions with %s' % ( len( fields ), morphemizer.getDescription() ), value=i*10000, max=len( fields ) )
+            debugf( 'chunk %d, %d cached expressions', i, len( morphCacheDB ) )
+            morphemes = morphemizer.getMorphemesFromExprBulk(chunk)
+            count( 'bulk expressions', len( chunk ) )
+            new_cache = {(morphemizer.getDescription(), e): ms for (e,ms) in zip(chunk, morphemes)}
+            morphCacheDB.update(new_cache)
+            morphCacheDB.flush()
+        morphCacheDB.save()
+
+    debugf( 'done bulking %d notes', N_notes )
+    end( 'bulk morphemize' )
+
+    begin( 'build locations' )
+    progress().update( label='Generating all.db data', value=0, max=len( notes ) )
+    i = 0
+    for i,( nid, guid, ts, notecfg, mats, fields ) in enumerate( notes ):
+        if i % 500 == 0:    progress().update( value=i )
+        morphemizer = getMorphemizerByName(notecfg['Morphemizer'])
 
+        for fieldName, fieldValue in fields:
             loc = fidDb.get( ( nid, guid, fieldName ), None )
             if not loc:
                 loc = AnkiDeck( nid, fieldName, fieldValue, guid, mats )
                 ms = getMorphemes(morphemizer, fieldValue, ts)
                 if ms: #TODO: this needed? should we change below too then?
-                    #printf( '    .loc for %d[%s]' % ( nid, fieldName ) )
-                    locDb[ loc ] = ms
+                    debugf( '    .loc for %d[%s]', nid, fieldName )
+                    allDb.addMsL( ms, loc )
+                    count( 'locations added' )
             else:
                 # mats changed -> new loc (new mats), move morphs
                 if loc.fieldValue == fieldValue and loc.maturities != mats:
-                    #printf( '    .mats for %d[%s]' % ( nid, fieldName ) )
+                    debugf( '    .mats for %d[%s]', nid, fieldName )
                     newLoc = AnkiDeck( nid, fieldName, fieldValue, guid, mats )
-                    locDb[ newLoc ] = locDb.pop( loc )
+                    allDb.replaceLoc( loc, newLoc )
+                    count( 'locations with new maturities' )
                 # field changed -> new loc, new morphs
                 elif loc.fieldValue != fieldValue:
-                    #printf( '    .morphs for %d[%s]' % ( nid, fieldName ) )
+                    debugf( '    .morphs for %d[%s]', nid, fieldName )
                     newLoc = AnkiDeck( nid, fieldName, fieldValue, guid, mats )
                     ms = getMorphemes(morphemizer, fieldValue, ts)
-                    locDb.pop( loc )
-                    locDb[ newLoc ] = ms
-
-    if N_enabled_notes == 0:
-        mw.progress.finish()
-        errorMsg('There is no card that can be analyzed or be moved. Add cards or (re-)check your configuration under "Tools -> MorhpMan Preferences" or in "Anki/addons/morph/config.py" for mistakes.')
-        return None
-
-    printf( 'Processed all %d notes in %f sec' % ( N_notes, time.time() - t_0 ) )
-    mw.progress.update( value=i, label='Creating all.db object' )
-    allDb.clear()
-    allDb.addFromLocDb( locDb )
+                    allDb.replaceLoc( loc, newLoc, ms )
+                    count( 'locations with new text' )
+
+    for nid, locs in nid2locs.items():
+        if nid not in alive:
+            for loc in locs: allDb.removeLoc( loc )
+            count( 'locations removed', len( locs ) )
+    end( 'build locations' )
+
+    printf( 'Processed %s %d notes in %f sec' % ( 'all' if since is None else 'changed', N_notes, time.time() - t_0 ) )
+    allDb.meta['recalc mod'] = highWater
+    allDb.meta['recalc cfg'] = fingerprint
     if cfg1('saveDbs'):
-        mw.progress.update( value=i, label='Saving all.db to disk' )
-        allDb.save( cfg1('path_all') )
+        progress().update( value=i, label='Saving all.db to disk' )
+        with span( 'save all.db' ):
+            allDb.save( cfg1('path_all') )
         printf( 'Processed all %d notes + saved all.db in %f sec' % ( N_notes, time.time() - t_0 ) )
-    mw.progress.finish()
+    progress().finish()
     return allDb
 
-def filterDbByMat( db, mat ):
-    '''Assumes safe to use cached locDb'''
-    newDb = MorphDb()
-    for loc, ms in db.locDb( recalc=False ).items():
-        if loc.maturity > mat:
-            newDb.addMsL( ms, loc )
-    return newDb
+PARALLEL_SCORING_MIN_NOTES = 20000 # below this starting the processes takes longer than scoring
+
+class BatchWriter:
+    '''Runs an executemany every `size` rows instead of once with all of them. Everything still
+    goes into Anki's open transaction; each batch is recorded as a span with the rows it touched.'''
+    def __init__( self, db, sql, size, name ): # DB -> Str -> Int -> Str -> ()
+        self.db, self.sql, self.size, self.name = db, sql, max( 1, size or 1 ), name
+        self.rows, self.batches, self.touched = [], 0, 0
+
+    def add( self, row ): # a -> IO ()
+        self.rows.append( row )
+        if len( self.rows ) >= self.size:
+            self.flush()
+
+    def flush( self ): # IO ()
+        if not self.rows: return
+        with span( self.name ):
+            before = self.db.scalar( 'select total_changes()' )
+            self.db.executemany( self.sql, self.rows )
+            touched = self.db.scalar( 'select total_changes()' ) - before
+            count( 'rows', len( self.rows ) )
+            count( 'rows touched', touched )
+        self.batches += 1
+        self.touched += touched
+        debugf( '%s: batch %d wrote %d rows, touched %d', self.name, self.batches, len( self.rows ), touched )
+        self.rows = []
+
+def tagNames(): # ( Tag, Tag, Tag, Tag, Tag, Tag, Tag, Tag )
+    return jcfg('Tag_Comprehension'), jcfg('Tag_Vocab'), jcfg('Tag_Fresh'), jcfg('Tag_NotReady'), jcfg('Tag_AlreadyKnown'), jcfg('Tag_Priority'), jcfg('Tag_TooShort'), jcfg('Tag_TooLong')
 
 def updateNotes( allDb ):
-    t_0, now, db, TAG   = time.time(), intTime(), mw.col.db, mw.col.tags
-    ds, nid2mmi         = [], {}
-    N_notes             = db.scalar( 'select count() from notes where tags like "% morphman %"' )
-    mw.progress.start( label='Updating data', max=N_notes, immediate=True )
-    fidDb   = allDb.fidDb()
-    locDb   = allDb.locDb( recalc=False ) # fidDb() already forces locDb recalc
-
-    # read tag names
-    compTag, vocabTag, freshTag, notReadyTag, alreadyKnownTag, priorityTag, tooShortTag, tooLongTag = tagNames = jcfg('Tag_Comprehension'), jcfg('Tag_Vocab'), jcfg('Tag_Fresh'), jcfg('Tag_NotReady'), jcfg('Tag_AlreadyKnown'), jcfg('Tag_Priority'), jcfg('Tag_TooShort'), jcfg('Tag_TooLong')
-    TAG.register( tagNames )
-    badLengthTag = jcfg2().get('Tag_BadLength')
+    pending, writer = readNotesToUpdate( allDb ), NoteWriter()
+    return writeNoteUpdates( writer, computeNoteUpdates( allDb, pending, writer.write ) )
 
-    # handle secondary databases
-    mw.progress.update( label='Creating seen/known/mature from all.db' )
-    seenDb      = filterDbByMat( allDb, cfg1('threshold_seen') )
-    knownDb     = filterDbByMat( allDb, cfg1('threshold_known') )
-    matureDb    = filterDbByMat( allDb, cfg1('threshold_mature') )
-    mw.progress.update( label='Loading priority.db' )
-    priorityDb  = MorphDb( cfg1('path_priority'), ignoreErrors=True ).db
+def readNotesToUpdate( allDb ): # MorphDb -> IO [ ( NoteId, ModelId, Str, Str, Str, Int, Int, {Morpheme} ) ]
+    '''The notes Recalc may modify, with their morphemes'''
+    db, TAG = mw.col.db, mw.col.tags
+    N_notes = db.scalar( 'select count() from notes where tags like "% morphman %"' )
+    progress().start( label='Reading notes to update', max=N_notes, immediate=True )
+    fidDb   = allDb.fidDb()
+    locDb   = allDb.locDb()
 
-    if cfg1('saveDbs'):
-        mw.progress.update( label='Saving seen/known/mature dbs' )
-        seenDb.save( cfg1('path_seen') )
-        knownDb.save( cfg1('path_known') )
-        matureDb.save( cfg1('path_mature') )
-        getMorphCacheDB().save()
-    
-    mw.progress.update( label='Updating notes' )
-    for i,( nid, mid, flds, guid, tags ) in enumerate( db.execute( 'select id, mid, flds, guid, tags from notes where tags like "% morphman %"' ) ):
-        if i % 500 == 0:    mw.progress.update( value=i )
-        C = partial( cfg, mid, None )
+    begin( 'read notes' )
+    pending = []
+    for i,( nid, mid, flds, guid, tags, sfld, csum, mod ) in enumerate( db.execute( 'select id, mid, flds, guid, tags, sfld, csum, mod from notes where tags like "% morphman %"' ) ):
+        if i % 500 == 0:    progress().update( value=i )
+        count( 'notes scanned' )
 
-        note = mw.col.getNote(nid)
-        notecfg = getFilter(note)
-        if notecfg is None or not notecfg['Modify']: continue
+        notecfg = getFilterByMidAndTags( mid, TAG.split( tags ) )
+        if notecfg is None or not notecfg['Modify']:
+            count( 'notes skipped' )
+            continue
 
         # Get all morphemes for note
         morphemes = set()
@@ -227,86 +298,76 @@ def updateNotes( allDb ):
                 loc = fidDb[ ( nid, guid, fieldName ) ]
                 morphemes.update( locDb[ loc ] )
             except KeyError: continue
+        pending.append( ( nid, mid, flds, tags, sfld, csum, mod, morphemes ) )
+    end( 'read notes' )
+    progress().finish()
+    return pending
+
+def computeNoteUpdates( allDb, pending, write ): # MorphDb -> [ ( NoteId, ModelId, Str, Str, Str, Int, Int, {Morpheme} ) ] -> ( [Map Str a] -> IO () ) -> IO NoteUpdates
+    '''Tiers, scores and the new fields and tags of the notes readNotesToUpdate returned. The notes
+    that changed are passed to `write` as they come, 'write batch size' at a time. Doesn't touch
+    the collection itself, so it can run in a worker thread.'''
+    t_0, TAG, nid2mmi = time.time(), mw.col.tags, {}
+    progress().start( label='Updating data', max=len( pending ), immediate=True )
 
-        # Determine un-seen/known/mature and i+N
-        unseens, unknowns, unmatures, newKnowns = set(), set(), set(), set()
-        for morpheme in morphemes:
-            if morpheme not in seenDb.db:      unseens.add( morpheme )
-            if morpheme not in knownDb.db:     unknowns.add( morpheme )
-            if morpheme not in matureDb.db:    unmatures.add( morpheme )
-            if morpheme not in matureDb.db and morpheme in knownDb.db:
-                newKnowns.add( morpheme )
+    # read tag names
+    compTag, vocabTag, freshTag, notReadyTag, alreadyKnownTag, priorityTag, tooShortTag, tooLongTag = tagNames()
+    badLengthTag = jcfg2().get('Tag_BadLength')
 
-        # Determine MMI - Morph Man Index
-        N, N_s, N_k, N_m = len( morphemes ), len( unseens ), len( unknowns ), len( unmatures )
+    # handle secondary databases
+    progress().update( label='Creating seen/known/mature from all.db' )
+    with span( 'tiering' ):
+        tiers       = MaturityTiers( allDb, cfg1('threshold_seen'), cfg1('threshold_known'), cfg1('threshold_mature') )
+    progress().update( label='Loading priority.db' )
+    with span( 'load priority.db' ):
+        priorityDb  = MorphDb( cfg1('path_priority'), ignoreErrors=True ).db
+
+    if cfg1('saveDbs'):
+        progress().update( label='Saving seen/known/mature dbs' )
+        with span( 'save seen/known/mature' ):
+            tiers.filteredDb( SEEN ).save( cfg1('path_seen') )
+            tiers.filteredDb( KNOWN ).save( cfg1('path_known') )
+            tiers.filteredDb( MATURE ).save( cfg1('path_mature') )
+            getMorphCacheDB().save()
+    
+    progress().update( label='Scoring notes' )
+    begin( 'scoring' )
+    table = MorphemeTable( allDb, priorityDb, tiers )
+    noteIds = [ [ m.id for m in ms ] for ( nid, mid, flds, tags, sfld, csum, mod, ms ) in pending ]
+    weights = [ NoteWeights( resolvedCfg( mid ) ) for ( nid, mid, flds, tags, sfld, csum, mod, ms ) in pending ]
+    scores, processes = None, cfg1('scoring processes')
+    if processes and len( pending ) >= PARALLEL_SCORING_MIN_NOTES:
+        try:
+            scores = scoreNotesParallel( table, noteIds, weights, processes )
+            count( 'scoring processes', processes )
+        except Exception as e:
+            printf( 'Scoring in %d processes failed, scoring in Anki instead: %r' % ( processes, e ) )
+    if scores is None:
+        scores = scoreNotes( table, noteIds, weights )
+    count( 'notes scored', len( pending ) )
+    end( 'scoring' )
+
+    progress().update( label='Updating notes', value=0 )
+    begin( 'note fields' )
+    rows, changed, size = [], 0, max( 1, cfg1('write batch size') or 1 ) # new values of the notes that changed, not yet written
+    for i,( ( nid, mid, flds, tags, sfld, csum, mod, morphemes ), ( N, N_k, N_m, F_k_avg, isPriority, lenDiffRaw, mmi ) ) in enumerate( zip( pending, scores ) ):
+        if i % 500 == 0:    progress().update( value=i )
+        C = resolvedCfg( mid )
 
         # Bail early for lite update
-        if N_k > 2 and C('only update k+2 and below'): continue
-
-            # average frequency of unknowns (ie. how common the word is within your collection)
-        F_k = 0
-        for focusMorph in unknowns: # focusMorph used outside loop
-            F_kt = allDb.frequency(focusMorph)
-            depends = {
-                "VVFIN" : "VVINF",	#	finites Verb, voll 	[du] gehst, [wir] kommen [an]
-                "VVIMP" : "VVINF",	#	Imperativ, voll 	komm [!]
-                # "VVINF" : "VVINF",	#	Infinitiv, voll 	gehen, ankommen
-                "VVIZU" : "VVINF",	#	Infinitiv mit ``zu'', voll 	anzukommen, loszulassen
-                "VVPP"  : "VVINF",	#	Partizip Perfekt, voll 	gegangen, angekommen
-
-                "VAFIN" : "VAINF",	#	finites Verb, aux 	[du] bist, [wir] werden
-                "VAIMP" : "VAINF",	#	Imperativ, aux 	sei [ruhig !]
-                # "VAINF" : "VAINF",	#	Infinitiv, aux 	werden, sein
-                "VAPP"  : "VAINF",	#	Partizip Perfekt, aux 	gewesen
-
-                "VMFIN" : "VMINF",	#	finites Verb, modal 	dürfen
-                # "VMINF" : "VMINF",	#	Infinitiv, modal 	wollen
-                "VMPP"  : "VMINF",	#	Partizip Perfekt, modal 	gekonnt, [er hat gehen] können
-            }
-            if focusMorph.subPos in depends and depends[focusMorph.subPos] != focusMorph.subPos:
-                baseMorph = Morpheme(focusMorph.base, focusMorph.inflected, focusMorph.pos, depends[focusMorph.subPos], focusMorph.read)
-                if baseMorph in allDb.db and baseMorph not in knownDb.db:
-                    F_kt = max(0, F_kt - (allDb.frequency(baseMorph) * (1 - max(min(allDb.maturity(baseMorph) / cfg1('threshold_mature'), 1), 0))))
-                    
-            if ( focusMorph.base != focusMorph.inflected):
-                baseMorph = Morpheme(focusMorph.inflected, focusMorph.inflected, focusMorph.pos, focusMorph.subPos, focusMorph.inflected)
-                if baseMorph in allDb.db and baseMorph not in knownDb.db:
-                    F_kt = max(0, F_kt - (allDb.frequency(baseMorph) * (1 - max(min(allDb.maturity(baseMorph) / cfg1('threshold_mature'), 1), 0))))
-            F_k += F_kt
-        F_k_avg = F_k // N_k if N_k > 0 else F_k
-        usefulness = F_k_avg
-
-            # add bonus for morphs in priority.db
-        isPriority = False
-        for focusMorph in unknowns:
-            if focusMorph in priorityDb:
-                isPriority = True
-                usefulness += C('priority.db weight')
-
-            # add bonus for studying recent learned knowns (reinforce)
-        for morpheme in newKnowns:
-            locs = allDb.db[ morpheme ]
-            if locs:
-                ivl = min( 1, max( loc.maturity for loc in locs ) )
-                usefulness += C('reinforce new vocab weight') // ivl #TODO: maybe average this so it doesnt favor long sentences
-
-        if any( morpheme.pos == '動詞' for morpheme in unknowns ): #FIXME: this isn't working???
-            usefulness += C('verb bonus')
-
-        usefulness = 999 - min( 999, usefulness )
-
-        # difference from optimal length range (too little context vs long sentence)
-        lenDiffRaw = min(N - C('min good sentence length'),
-                         max(0, N - C('max good sentence length')))
-        lenDiff = min(9, abs(lenDiffRaw))
-
-            # calculate mmi
-        mmi = 10000*N_k + 1000*lenDiff + usefulness
+        if N_k > 2 and C('only update k+2 and below'):
+            count( 'notes skipped' )
+            continue
+
         if C('set due based on mmi'):
-            nid2mmi[ nid ] = mmi
+            nid2mmi[ nid ] = ( mmi, mod )
+
+        unknowns  = [ m for m in morphemes if not tiers.isKnown( m ) ]
+        unmatures = [ m for m in morphemes if not tiers.isMature( m ) ]
 
         # Fill in various fields/tags on the note based on cfg
         ts, fs = TAG.split( tags ), splitFields( flds )
+        oldFs = list( fs )
 
         # clear any 'special' tags, the appropriate will be set in the next few lines
         ts = [ t for t in ts if t not in [ notReadyTag, compTag, vocabTag, freshTag ] ]
@@ -317,13 +378,13 @@ def updateNotes( allDb ):
             setField( mid, fs, jcfg('Field_FocusMorph'), '' )
         elif N_k == 1:  # new vocab card, k+1
             ts = ts + [ vocabTag ]
-            setField( mid, fs, jcfg('Field_FocusMorph'), '%s' % focusMorph.base )
+            setField( mid, fs, jcfg('Field_FocusMorph'), '%s' % unknowns[0].base )
         elif N_k > 1:   # M+1+ and K+2+
             ts = ts + [ notReadyTag ]
             setField( mid, fs, jcfg('Field_FocusMorph'), '')
         elif N_m == 1: # we have k+0, and m+1, so this card does not introduce a new vocabulary -> card for newly learned morpheme
             ts = ts + [ freshTag ]
-            setField( mid, fs, jcfg('Field_FocusMorph'), '%s' % list(unmatures)[0].base)
+            setField( mid, fs, jcfg('Field_FocusMorph'), '%s' % unmatures[0].base)
         else: # only case left: we have k+0, but m+2 or higher, so this card does not introduce a new vocabulary -> card for newly learned morpheme
             ts = ts + [ freshTag ]
             setField( mid, fs, jcfg('Field_FocusMorph'), '')
@@ -360,58 +421,209 @@ def updateNotes( allDb ):
         tags_ = TAG.join( TAG.canonify( ts ) )
         flds_ = joinFields( fs )
         if flds != flds_ or tags != tags_:  # only update notes that have changed
-            csum = fieldChecksum( fs[0] )
-            sfld = stripHTML( fs[ getSortFieldIndex( mid ) ] )
-            ds.append( { 'now':now, 'tags':tags_, 'flds':flds_, 'sfld':sfld, 'csum':csum, 'usn':mw.col.usn(), 'nid':nid } )
-
-    mw.progress.update( value=i, label='Updating anki database...' )
-    mw.col.db.executemany( 'update notes set tags=:tags, flds=:flds, sfld=:sfld, csum=:csum, mod=:now, usn=:usn where id=:nid', ds )
-
-    # Now reorder new cards based on MMI
-    mw.progress.update( value=i, label='Updating new card ordering...' )
-    ds = []
-
+            # the checksum and sort field only have to be computed again if their fields changed (usually they don't)
+            if fs[0] != oldFs[0]:
+                csum = fieldChecksum( fs[0] )
+            sortIdx = getSortFieldIndex( mid )
+            if fs[ sortIdx ] != oldFs[ sortIdx ]:
+                sfld = stripHTML( fs[ sortIdx ] )
+            rows.append( { 'tags':tags_, 'flds':flds_, 'sfld':sfld, 'csum':csum, 'nid':nid, 'mod':mod } )
+            if len( rows ) >= size:
+                changed += len( rows )
+                write( rows )
+                rows = []
+    if rows:
+        changed += len( rows )
+        write( rows )
+    count( 'notes changed', changed )
+    end( 'note fields' )
+    progress().finish()
+    return t_0, tiers, nid2mmi
+
+class NoteWriter:
+    '''Writes the notes computeNoteUpdates changed to the collection as they come in. Lives on the
+    main thread; spans can't be recorded there while a worker stage runs, so it only keeps counts.
+    Notes that were modified after readNotesToUpdate read them (eg. edited while Recalc ran in
+    the background) are left alone; the next Recalc picks them up.'''
+    def __init__( self ): # IO ()
+        self.now, self.usn = None, mw.col.usn()
+        self.notes = BatchWriter( mw.col.db, 'update notes set tags=:tags, flds=:flds, sfld=:sfld, csum=:csum, mod=:now, usn=:usn where id=:nid and mod=:mod',
+                                  cfg1('write batch size'), 'write notes' )
+        self.rows = 0
+        self.reordered = 0 # new cards writeNoteUpdates gave another due
+
+    def write( self, rows ): # [Map Str a] -> IO ()
+        if self.now is None:
+            self.now = intTime()
+            mw.col.tags.register( tagNames() )
+        for row in rows:
+            row['now'], row['usn'] = self.now, self.usn
+            self.notes.add( row )
+        self.rows += len( rows )
+
+def writeNoteUpdates( writer, update ): # NoteWriter -> NoteUpdates -> IO {Morpheme}
+    '''Writes the last notes computeNoteUpdates passed to `writer` and reorders new cards, except
+    those of notes modified meanwhile. Returns the known morphemes; the mod time the notes and
+    cards were written with and how many of them are in `writer`.'''
+    t_0, tiers, nid2mmi = update
+    if writer.now is None: writer.now = intTime()
+    now, usn, db, notesWriter = writer.now, writer.usn, mw.col.db, writer.notes
+    progress().start( label='Updating notes', immediate=True )
+
+    begin( 'write' )
+    notesWriter.flush()
+    count( 'write notes batches', notesWriter.batches )
+    count( 'notes written', notesWriter.touched )
+    count( 'notes changed meanwhile', writer.rows - notesWriter.touched )
+
+    # Now reorder new cards based on MMI. The scores go into a temp table so only new cards of scored
+    # notes are looked at, and all of them are updated by a single statement.
     # "type = 0": new cards
     # "type = 1": learning cards [is supposed to be learning: in my case no learning card had this type]
     # "type = 2": review cards
-    for ( cid, nid, due ) in db.execute( 'select id, nid, due from cards where type = 0' ):
-        if nid in nid2mmi: # owise it was disabled
-            due_ = nid2mmi[ nid ]
-            if due != due_: # only update cards that have changed
-                ds.append( { 'now':now, 'due':due_, 'usn':mw.col.usn(), 'cid':cid } )
-    mw.col.db.executemany( 'update cards set due=:due, mod=:now, usn=:usn where id=:cid', ds )
+    progress().update( label='Updating new card ordering...' )
+    begin( 'reorder cards' )
+    db.execute( 'drop table if exists temp.mm_mmi' )
+    db.execute( 'create temp table mm_mmi ( nid integer primary key, due integer not null, mod integer not null )' )
+    mmiWriter = BatchWriter( db, 'insert into temp.mm_mmi values ( ?,?,? )', cfg1('write batch size'), 'load mmi' )
+    for nid, ( mmi, mod ) in nid2mmi.items():
+        mmiWriter.add( ( nid, mmi, mod ) )
+    mmiWriter.flush()
+    # a note still has the mod it was read with, or `now` if it was written above; otherwise it was
+    # modified meanwhile and its score may be stale
+    db.execute( 'delete from temp.mm_mmi where ( select mod from notes where id = mm_mmi.nid ) not in ( mm_mmi.mod, ? )', now )
+    before = db.scalar( 'select total_changes()' )
+    db.execute( '''update cards set due = ( select due from temp.mm_mmi where nid = cards.nid ), mod = ?, usn = ?
+            where type = 0 and nid in ( select nid from temp.mm_mmi ) and due != ( select due from temp.mm_mmi where nid = cards.nid )''', now, usn )
+    reordered = writer.reordered = db.scalar( 'select total_changes()' ) - before
+    db.execute( 'drop table temp.mm_mmi' )
+    count( 'cards reordered', reordered )
+    end( 'reorder cards' )
+    end( 'write' )
     mw.reset()
 
-    printf( 'Updated notes in %f sec' % ( time.time() - t_0 ) )
-    mw.progress.finish()
-    return knownDb
+    printf( 'Updated %d notes in %d batches and reordered %d cards in %f sec' % ( notesWriter.touched, notesWriter.batches, reordered, time.time() - t_0 ) )
+    progress().finish()
+    return tiers.morphemes( KNOWN )
+
+def markRecalcWrites( allDb, highWater, writer ): # MorphDb -> Int -> NoteWriter -> IO ()
+    '''Moves the mark of incremental Recalcs past the notes and cards this Recalc wrote itself (all
+    with mod `now`), so the next one doesn't analyze them again. Unless other changes were made
+    after the notes were read (eg. while Recalc ran in the background), including reviews or edits
+    in the same second as our writes; then the mark stays and the next Recalc looks at those, and
+    once more at ours.'''
+    db, now = mw.col.db, writer.now
+    other = max( db.scalar( 'select max(mod) from notes where mod != ?', now ) or 0, db.scalar( 'select max(mod) from cards where mod != ?', now ) or 0 )
+    if other > highWater or allDb.meta.get( 'recalc mod' ) != highWater:
+        return
+    # the rows with mod `now` have to be exactly ours
+    if db.scalar( 'select count() from notes where mod = ?', now ) != writer.notes.touched or db.scalar( 'select count() from cards where mod = ?', now ) != writer.reordered:
+        return
+    allDb.meta['recalc mod'] = now + 1
+    if cfg1('saveDbs'):
+        from .morphStore import writeMeta
+        writeMeta( cfg1('path_all'), { 'recalc mod':now + 1 } )
 
 def main():
-    # load existing all.db
-    mw.progress.start( label='Loading existing all.db', immediate=True )
+    from . import backgroundTask
+    if backgroundTask.running() is not None:
+        infoMsg( 'MorphMan Recalc is already running.' )
+        return
+    before, outer = cacheStats(), instrument.start()
+    def finished( completed ): # Bool -> IO ()
+        instrument.claim()
+        # hits and misses of the bounded caches during this Recalc
+        for name, st in cacheStats().items():
+            for k in [ 'hits', 'misses' ]:
+                count( '%s %s' % ( name, k ), st[ k ] - before.get( name, {} ).get( k, 0 ) )
+        instrument.stop( cfg1('path_timings'), outer )
+        if not completed and cfg1('saveDbs'):
+            util._allDb = None # may be partly updated; the next Recalc reads all.db from disk again
+        printf( 'Cache stats: %s' % cacheStats() )
+        util.flushLog()
+
+    if cfg1('background recalc'):
+        backgroundTask.Task( 'MorphMan Recalc', STAGES, finished ).start()
+        return
+    completed = False
+    try:
+        completed = recalc()
+    finally:
+        finished( completed )
+
+def recalc(): # IO Bool
+    '''Runs all stages right away; False if one of them ended Recalc early'''
+    state = {}
+    for name, inWorker, f in STAGES:
+        if f( state ) is False:
+            return False
+    return True
+
+# Recalc in stages. The ones that don't touch the collection (or Qt) can run in a worker thread,
+# see backgroundTask.py. Stages share their results through the `st` dict.
+def loadAllDbStage( st ):
+    progress().start( label='Loading existing all.db', immediate=True )
     t_0 = time.time()
-    cur = util.allDb() if cfg1('loadAllDb') else None
+    with span( 'load all.db' ):
+        st['allDb'] = util.allDb() if cfg1('loadAllDb') else None
     printf( 'Loaded all.db in %f sec' % ( time.time() - t_0 ) )
-    mw.progress.finish()
+    progress().finish()
 
-    # update all.db
-    allDb = mkAllDb( cur )
-    if not allDb: # there was an (non-critical-/non-"exception"-)error but error message was already displayed
-        mw.progress.finish()
-        return
+def readNotesStage( st ):
+    begin( 'mkAllDb' )
+    if not st['allDb']: st['allDb'] = MorphDb()
+    st['batch'] = readAllDbNotes( st['allDb'] )
+    if not st['batch']: # there was an (non-critical-/non-"exception"-)error but error message was already displayed
+        return False
 
-    # merge in external.db
-    mw.progress.start( label='Merging ext.db', immediate=True )
-    ext = MorphDb( cfg1('path_ext'), ignoreErrors=True )
-    allDb.merge( ext )
-    mw.progress.finish()
+def analyzeNotesStage( st ):
+    allDb = analyzeNotes( st['allDb'], st['batch'] )
+    end( 'mkAllDb' )
 
-    # update notes
-    knownDb = updateNotes( allDb )
+    # merge in external.db
+    progress().start( label='Merging ext.db', immediate=True )
+    with span( 'merge ext.db' ):
+        ext = MorphDb( cfg1('path_ext'), ignoreErrors=True )
+        count( 'entries added', allDb.merge( ext ) )
+    progress().finish()
+
+def readUpdatesStage( st ):
+    begin( 'updateNotes' )
+    st['pending'] = readNotesToUpdate( st['allDb'] )
+    st['writer'] = NoteWriter()
+
+def computeUpdatesStage( st ):
+    # changed notes are handed to the main thread a batch at a time, so they never all are in memory
+    from .backgroundTask import onMain
+    writer = st['writer']
+    st['update'] = computeNoteUpdates( st['allDb'], st.pop( 'pending' ), lambda rows: onMain( writer.write, rows ) )
+
+def writeUpdatesStage( st ):
+    allDb = st['allDb']
+    known = writeNoteUpdates( st['writer'], st['update'] )
+    markRecalcWrites( allDb, st['batch'][2], st['writer'] )
+    end( 'updateNotes' )
 
     # update stats and refresh display
-    stats.updateStats( knownDb )
+    with span( 'stats' ):
+        stats.updateStats( known )
     mw.toolbar.draw()
 
-    # set global allDb
-    util._allDb = allDb
+    # the reviewer only needs the snapshot; all.db is read from disk again by the next Recalc,
+    # unless it isn't saved
+    from . import morphHighlight, morphSnapshot
+    util.closeSnapshot()
+    morphHighlight.invalidate()
+    with span( 'save snapshot' ):
+        morphSnapshot.write( cfg1('path_snapshot'), allDb )
+        instrument.countFile( 'bytes written', cfg1('path_snapshot') )
+    util._allDb = None if cfg1('saveDbs') else allDb
+
+STAGES = [ # [ ( Str, Bool, Map Str a -> IO Maybe Bool ) ]; name, whether it can run in a worker thread, stage
+    ( 'Loading all.db',             True,   loadAllDbStage ),
+    ( 'Reading notes',              False,  readNotesStage ),
+    ( 'Analyzing notes',            True,   analyzeNotesStage ),
+    ( 'Reading notes to update',    False,  readUpdatesStage ),
+    ( 'Scoring notes',              True,   computeUpdatesStage ),
+    ( 'Writing notes',              False,  writeUpdatesStage ),
+]
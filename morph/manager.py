@@ -148,7 +148,7 @@ class MorphMan( QDialog ):
         elif type == 'inter':   ms = aSet.intersection( bSet )
         elif type == 'union':   ms = aSet.union( bSet )
 
-        self.db.db = {}
+        self.db.clear()
         for m in ms:
             locs = set()
             if m in self.aDb.db: locs.update( self.aDb.db[m] )
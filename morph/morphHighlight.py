@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+'''
+Renders the morphHighlight field filter: every morpheme of a field is wrapped in a <span> that
+tells how well it is known.
+
+All inflected forms of a text go into one regex alternation, longest first, so the text is
+scanned once and a longer morpheme always wins over a shorter one it contains. Only text
+outside of HTML tags is touched. Rendered fields are cached until all.db changes, so showing
+a card again (or its answer side) costs a dict lookup. Maturities come from the all.db
+snapshot (see morphSnapshot.py), not from all.db itself.
+'''
+import re
+
+from .util_external import namedCache
+
+SPAN = '<span class="morphHighlight" mtype="{mtype}" mat="{mat}">{morph}</span>'
+TAG_RE = re.compile( '(<[^>]*>)' )
+
+def matureType( mat, thresholds ): # Maturity -> ( Maturity, Maturity, Maturity ) -> Str
+    thresholdSeen, thresholdKnown, thresholdMature = thresholds
+    if   mat >= thresholdMature:    return 'mature'
+    elif mat >= thresholdKnown:     return 'known'
+    elif mat >= thresholdSeen:      return 'seen'
+    return 'unknown'
+
+def render( txt, ms, maturityOf, thresholds ): # Str -> [Morpheme] -> ( Morpheme -> Maturity ) -> ( Maturity, Maturity, Maturity ) -> Str
+    '''`txt` with the inflected forms of `ms` highlighted. If morphemes share an inflected form,
+    the first of them decides its maturity.'''
+    spans = {} # Map Str Str; inflected form -> its <span>
+    for m in ms:
+        if not m.inflected or m.inflected in spans: continue
+        mat = maturityOf( m )
+        spans[ m.inflected ] = SPAN.format( morph=m.inflected, mtype=matureType( mat, thresholds ), mat=mat )
+    if not spans:
+        return txt
+    matcher = re.compile( '|'.join( re.escape( f ) for f in sorted( spans, key=len, reverse=True ) ) )
+    sub = lambda mo: spans[ mo.group( 0 ) ]
+    return ''.join( part if i % 2 else matcher.sub( sub, part ) for i, part in enumerate( TAG_RE.split( txt ) ) ) # odd parts are tags
+
+_renderedFor = None # id of the Snapshot the cached renderings were made with
+def cachedRender( key, db, render ): # a -> Snapshot -> ( () -> Str ) -> Str
+    '''Rendering for `key` made with `db`, calling `render` if there is none'''
+    global _renderedFor
+    cache = namedCache( 'highlight' )
+    if _renderedFor != id( db ):
+        cache.clear()
+        _renderedFor = id( db )
+    try:
+        return cache[ key ]
+    except KeyError:
+        html = cache[ key ] = render()
+        return html
+
+def invalidate(): # IO ()
+    '''Forgets all renderings; has to be called whenever all.db changed'''
+    global _renderedFor
+    _renderedFor = None
+    namedCache( 'highlight' ).clear()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''
+Read-only snapshot of all.db for the reviewer: per morpheme only its max maturity and frequency.
+
+Recalc writes it next to all.db. The reviewer maps it into memory instead of loading all.db,
+so opening it costs no unpickling and no memory beyond the pages that are actually read, and
+every Anki process (or profile) reading the same file shares those pages.
+
+Layout (little endian):
+
+    header   magic 'MMSNAP01', Int32 entry count, Int32 offset of the keys
+    entries  per morpheme: Int32 key offset, Int32 key length, Float64 max maturity, Float64 frequency
+    keys     UTF-8 'base\\x1fpos\\x1fsubPos\\x1fread'
+
+Entries are sorted by their key bytes, so a lookup is a binary search over the entries.
+'''
+import mmap, struct
+
+from .util_external import atomicPath
+
+MAGIC = b'MMSNAP01'
+HEADER = struct.Struct( '<8sII' )
+ENTRY = struct.Struct( '<IIdd' )
+
+def keyOf( m ): # Morpheme -> Bytes
+    return '\x1f'.join( ( m.base, m.pos, m.subPos, m.read ) ).encode( 'utf-8' )
+
+def write( path, db ): # FilePath -> MorphDb -> IO ()
+    '''Writes the snapshot of `db`; atomically, so a reader never maps a half-written file'''
+    rows = sorted( ( keyOf( m ), agg[1], agg[0] ) for m, agg in db.agg.items() )
+    keysAt = HEADER.size + ENTRY.size * len( rows )
+    out, keys = bytearray( HEADER.pack( MAGIC, len( rows ), keysAt ) ), bytearray()
+    for key, maxMat, freq in rows:
+        out += ENTRY.pack( keysAt + len( keys ), len( key ), maxMat, freq )
+        keys += key
+    with atomicPath( path ) as tmp:
+        with open( tmp, 'wb' ) as f:
+            f.write( out )
+            f.write( keys )
+
+def whole( x ): # Float -> Number
+    '''Maturities and frequencies are mostly integers; give them back as such'''
+    return int( x ) if x.is_integer() else x
+
+class Snapshot:
+    '''A mapped snapshot file. Morphemes that aren't in it have maturity and frequency 0.'''
+
+    def __init__( self, path ): # FilePath -> IO ()
+        self.path = path
+        with open( path, 'rb' ) as f:
+            self.mm = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ ) # stays valid after the file is closed
+        magic, self.n, self.keysAt = HEADER.unpack_from( self.mm, 0 )
+        if magic != MAGIC:
+            self.mm.close()
+            raise IOError( 'Not a MorphMan snapshot: %s' % path )
+
+    def close( self ): # IO ()
+        self.mm.close()
+
+    def __len__( self ): # Int
+        return self.n
+
+    def _find( self, m ): # Morpheme -> IO Maybe ( Maturity, Frequency )
+        key, mm = keyOf( m ), self.mm
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = ( lo + hi ) // 2
+            at, length, maxMat, freq = ENTRY.unpack_from( mm, HEADER.size + ENTRY.size * mid )
+            k = mm[ at:at + length ]
+            if k < key:     lo = mid + 1
+            elif k > key:   hi = mid
+            else:           return whole( maxMat ), whole( freq )
+        return None
+
+    def __contains__( self, m ): # Morpheme -> IO Bool
+        return self._find( m ) is not None
+
+    def maxMaturity( self, m ): # Morpheme -> IO Maturity
+        r = self._find( m )
+        return r[0] if r else 0
+
+    def frequency( self, m ): # Morpheme -> IO Frequency
+        r = self._find( m )
+        return r[1] if r else 0
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+'''
+On-disk storage for MorphDb.
+
+A MorphDb file is a SQLite database with a `morphemes` table, a `locations` table and a
+`morph_locs` table linking the two. Compared to the old gzip-pickled `Map Morpheme {Location}`
+files this allows looking up single morphemes (see MorphStore) without loading the whole db.
+
+Files in the old format are still read transparently; they are converted the next time
+they are saved (or explicitly with migrate()).
+'''
+import gzip, json, os, pickle, sqlite3
+
+from .morphemes import Morpheme, Nowhere, Corpus, TextFile, AnkiDeck
+from .util_external import atomicPath, fileLock
+
+STORE_VERSION = 2 # 2: per-morpheme aggregates in the morphemes table
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+SCHEMA = '''
+create table meta (
+    key     text primary key,
+    value   text
+);
+create table morphemes (
+    id          integer primary key,
+    base        text not null,
+    inflected   text not null,
+    pos         text not null,
+    subPos      text not null,
+    read        text not null,
+    frequency,
+    maxMaturity,
+    sumSquares
+);
+create unique index ix_morphemes_key on morphemes ( base, pos, subPos, read );
+create table locations (
+    id          integer primary key,
+    kind        text not null,
+    maturity,
+    weight,
+    noteId      integer,
+    guid        text,
+    fieldName   text,
+    fieldValue  text,
+    maturities  text,
+    name        text,
+    filePath    text,
+    lineNo      integer,
+    data        blob
+);
+create index ix_locations_fid on locations ( noteId, guid, fieldName );
+create table morph_locs (
+    mid integer not null,
+    lid integer not null,
+    primary key ( mid, lid )
+) without rowid;
+'''
+
+################################################################################
+## File format detection
+################################################################################
+
+def isStoreFile( path ): # FilePath -> IO Bool
+    '''Raises IOError if the file doesn't exist'''
+    with open( path, 'rb' ) as f:
+        return f.read( len( SQLITE_MAGIC ) ) == SQLITE_MAGIC
+
+def loadLegacy( path ): # FilePath -> IO Map Morpheme {Location}
+    f = gzip.open( path, 'rb' )
+    try:     return pickle.load( f )
+    finally: f.close()
+
+def migrate( path ): # FilePath -> IO Bool
+    '''Converts a gzip-pickled db into the indexed format in place. Returns whether anything was done.'''
+    if isStoreFile( path ): return False
+    writeDb( path, loadLegacy( path ) )
+    return True
+
+################################################################################
+## Location (de)serialization
+################################################################################
+
+LOC_COLUMNS = 'kind, maturity, weight, noteId, guid, fieldName, fieldValue, maturities, name, filePath, lineNo, data'
+
+def locToRow( loc ): # Location -> Tuple
+    weight, maturity = getattr( loc, 'weight', 1 ), getattr( loc, 'maturity', 1 )
+    if type( loc ) is AnkiDeck:
+        return ( 'AnkiDeck', maturity, weight, loc.noteId, loc.guid, loc.fieldName, loc.fieldValue, json.dumps( loc.maturities ), None, None, None, None )
+    elif type( loc ) is TextFile:
+        return ( 'TextFile', maturity, weight, None, None, None, None, None, None, loc.filePath, loc.lineNo, None )
+    elif type( loc ) is Corpus:
+        return ( 'Corpus', maturity, weight, None, None, None, None, None, loc.name, None, None, None )
+    elif type( loc ) is Nowhere:
+        return ( 'Nowhere', maturity, weight, None, None, None, None, None, None, None, None, None )
+    # unknown location type (eg. from a third party); keep it as is
+    return ( 'pickle', maturity, weight, None, None, None, None, None, None, None, None, pickle.dumps( loc, -1 ) )
+
+def rowToLoc( row ): # Tuple -> Location
+    kind, maturity, weight, noteId, guid, fieldName, fieldValue, maturities, name, filePath, lineNo, data = row
+    if kind == 'AnkiDeck':
+        return AnkiDeck( noteId, fieldName, fieldValue, guid, json.loads( maturities ), weight )
+    elif kind == 'TextFile':
+        return TextFile( filePath, lineNo, maturity, weight )
+    elif kind == 'Corpus':
+        return Corpus( name, weight )
+    elif kind == 'Nowhere':
+        return Nowhere( maturity, weight )
+    return pickle.loads( data )
+
+def rowToMorpheme( row ): # Tuple -> Morpheme
+    base, inflected, pos, subPos, read = row
+    return Morpheme( base, inflected, pos, subPos, read )
+
+################################################################################
+## Whole-db reading and writing
+################################################################################
+
+def connect( path, readOnly=True ): # FilePath -> Bool -> IO sqlite3.Connection
+    if readOnly and not os.path.isfile( path ):
+        raise IOError( 'No such MorphDb file: %s' % path )
+    return sqlite3.connect( path )
+
+def writeDb( path, db, meta={}, agg=None ): # FilePath -> Map Morpheme {Location} -> Map Str a -> Maybe Map Morpheme [Number] -> IO ()
+    '''`agg` are the MorphDb aggregates ( frequency, max maturity, sum of squared maturities ) per morpheme; computed if not given.
+    The file is replaced atomically (see util_external.atomicPath).'''
+    from .morphemes import MorphDb
+    if agg is None:
+        agg = dict( ( m, MorphDb.aggregate( ls ) ) for m,ls in db.items() )
+    with atomicPath( path ) as tmp:
+        _writeDb( tmp, db, meta, agg )
+
+def _writeDb( path, db, meta, agg ): # FilePath -> Map Morpheme {Location} -> Map Str a -> Map Morpheme [Number] -> IO ()
+    conn = connect( path, readOnly=False )
+    try:
+        # the file is written from scratch, so a rollback journal would only slow us down
+        conn.execute( 'pragma journal_mode = off' )
+        conn.execute( 'pragma synchronous = off' )
+        conn.executescript( SCHEMA )
+        conn.execute( "insert into meta values ( 'version', ? )", ( str( STORE_VERSION ), ) )
+        conn.executemany( 'insert into meta values ( ?,? )', ( ( 'db.' + k, json.dumps( v ) ) for k,v in meta.items() ) )
+
+        lids = {} # Map id(Location) Int; locations are shared between morphemes and hashed by identity
+        def locRows():
+            for ls in db.values():
+                for l in ls:
+                    if id( l ) not in lids:
+                        lids[ id( l ) ] = lid = len( lids ) + 1
+                        yield ( lid, ) + locToRow( l )
+        conn.executemany( 'insert into locations ( id, %s ) values ( ?,?,?,?,?,?,?,?,?,?,?,?,? )' % LOC_COLUMNS, locRows() )
+
+        ms = list( db.keys() )
+        conn.executemany( 'insert into morphemes values ( ?,?,?,?,?,?,?,?,? )',
+                ( ( i+1, m.base, m.inflected, m.pos, m.subPos, m.read ) + tuple( agg[ m ] ) for i,m in enumerate( ms ) ) )
+        conn.executemany( 'insert into morph_locs values ( ?,? )',
+                ( ( i+1, lids[ id( l ) ] ) for i,m in enumerate( ms ) for l in db[ m ] ) )
+        conn.commit()
+    finally:
+        conn.close()
+
+def writeMeta( path, meta ): # FilePath -> Map Str a -> IO Bool
+    '''Sets entries of the `meta` of a MorphDb file in place, without writing the whole file again.
+    Returns False if there is no such file in the indexed format.'''
+    with fileLock( path ):
+        if not os.path.isfile( path ) or not isStoreFile( path ): return False
+        conn = connect( path, readOnly=False )
+        try:
+            conn.executemany( 'insert or replace into meta values ( ?,? )', ( ( 'db.' + k, json.dumps( v ) ) for k,v in meta.items() ) )
+            conn.commit()
+        finally:
+            conn.close()
+    return True
+
+def storeVersion( conn ): # sqlite3.Connection -> IO Int
+    r = conn.execute( "select value from meta where key = 'version'" ).fetchone()
+    return int( r[0] ) if r else 0
+
+def readDb( path ): # FilePath -> IO ( Map Morpheme {Location}, Map Str a, Maybe Map Morpheme [Number] )
+    '''Aggregates are None for files written before they were stored'''
+    conn = connect( path )
+    try:
+        meta = dict( ( k[3:], json.loads( v ) ) for k,v in conn.execute( "select key, value from meta where key like 'db.%'" ) )
+        locs = dict( ( r[0], rowToLoc( r[1:] ) ) for r in conn.execute( 'select id, %s from locations' % LOC_COLUMNS ) )
+        ms, agg = {}, None
+        if storeVersion( conn ) >= 2:
+            agg = {}
+            for r in conn.execute( 'select id, base, inflected, pos, subPos, read, frequency, maxMaturity, sumSquares from morphemes' ):
+                m = ms[ r[0] ] = rowToMorpheme( r[1:6] )
+                agg[ m ] = list( r[6:] )
+        else:
+            ms = dict( ( r[0], rowToMorpheme( r[1:] ) ) for r in conn.execute( 'select id, base, inflected, pos, subPos, read from morphemes' ) )
+        db = dict( ( m, set() ) for m in ms.values() )
+        for mid, lid in conn.execute( 'select mid, lid from morph_locs' ):
+            db[ ms[ mid ] ].add( locs[ lid ] )
+        return db, meta, agg
+    finally:
+        conn.close()
+
+################################################################################
+## Point lookups
+################################################################################
+
+class MorphStore:
+    '''Read-only view on a MorphDb file that answers questions about single morphemes
+    without loading the whole db into memory. Old gzip-pickled files are migrated on open.'''
+
+    def __init__( self, path ): # FilePath -> IO ()
+        self.path = path
+        migrate( path )
+        self.conn = connect( path )
+        self.version = storeVersion( self.conn )
+
+    def close( self ): # IO ()
+        self.conn.close()
+
+    def _mid( self, m ): # Morpheme -> IO Maybe Int
+        r = self.conn.execute( 'select id from morphemes where base = ? and pos = ? and subPos = ? and read = ?',
+                ( m.base, m.pos, m.subPos, m.read ) ).fetchone()
+        return r[0] if r else None
+
+    def __contains__( self, m ): # Morpheme -> IO Bool
+        return self._mid( m ) is not None
+
+    def __len__( self ): # IO Int
+        return self.conn.execute( 'select count() from morphemes' ).fetchone()[0]
+
+    def morphemes( self ): # IO [Morpheme]
+        for r in self.conn.execute( 'select base, inflected, pos, subPos, read from morphemes' ):
+            yield rowToMorpheme( r )
+
+    def locations( self, m ): # Morpheme -> IO {Location}
+        return set( rowToLoc( r ) for r in self.conn.execute(
+                'select %s from locations join morph_locs on lid = id where mid = ?' % LOC_COLUMNS, ( self._mid( m ), ) ) )
+
+    def frequency( self, m ): # Morpheme -> IO Int
+        if self.version >= 2:
+            r = self.conn.execute( 'select frequency from morphemes where base = ? and pos = ? and subPos = ? and read = ?',
+                    ( m.base, m.pos, m.subPos, m.read ) ).fetchone()
+            return r[0] if r else 0
+        r = self.conn.execute( 'select sum( weight ) from locations join morph_locs on lid = id where mid = ?', ( self._mid( m ), ) ).fetchone()
+        return r[0] or 0
+
+    def maxMaturity( self, m ): # Morpheme -> IO Maturity
+        if self.version >= 2:
+            r = self.conn.execute( 'select maxMaturity from morphemes where base = ? and pos = ? and subPos = ? and read = ?',
+                    ( m.base, m.pos, m.subPos, m.read ) ).fetchone()
+            return r[0] if r else 0
+        r = self.conn.execute( 'select max( maturity ) from locations join morph_locs on lid = id where mid = ?', ( self._mid( m ), ) ).fetchone()
+        return r[0] or 0
+
+    def frequencies( self ): # IO [(Morpheme, Int)]
+        if self.version >= 2:
+            for r in self.conn.execute( 'select base, inflected, pos, subPos, read, frequency from morphemes' ):
+                yield rowToMorpheme( r[:5] ), r[5]
+            return
+        for r in self.conn.execute( '''select base, inflected, pos, subPos, read, coalesce( sum( weight ), 0 ) from morphemes
+                left join morph_locs on mid = morphemes.id left join locations on lid = locations.id group by morphemes.id''' ):
+            yield rowToMorpheme( r[:5] ), r[5]
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
-import codecs, pickle as pickle, gzip, os, subprocess, re
-from .util_external import memoize
+import codecs, pickle as pickle, gzip, os, subprocess, re, threading
+from sys import intern
+from .util_external import memoize, namedCache, fileLock
+from . import instrument
 import math
 
 # need some fallbacks if not running from anki and thus morph.util isn't available
@@ -14,7 +16,25 @@ except ImportError:
 ## Lexical analysis
 ################################################################################
 
+# Every distinct (base, pos, subPos, read) gets a dense integer id for the lifetime of the process.
+# Morphemes hash and compare by that id, so sets and dicts of morphemes only do integer work.
+_morphemeIds = {} # Map (Str, Str, Str, Str) Int
+
+def internMorpheme( base, pos, subPos, read ): # Str -> Str -> Str -> Str -> Int
+    key = ( base, pos, subPos, read )
+    try:
+        return _morphemeIds[ key ]
+    except KeyError:
+        i = _morphemeIds[ key ] = len( _morphemeIds )
+        return i
+
+def morphemeIdCount(): # Int
+    '''Upper bound (exclusive) of all morpheme ids handed out so far'''
+    return len( _morphemeIds )
+
 class Morpheme:
+    __slots__ = ( 'pos', 'subPos', 'read', 'base', 'inflected', 'id' )
+
     def __init__( self, base, inflected, pos, subPos, read ):
         """ Initialize morpheme class.
 
@@ -28,28 +48,32 @@ class Morpheme:
         :param str subPos: 自立
         :param str read: アルイ
 
+        Morphemes are immutable: the id is derived from base, pos, subPos and read, so create a
+        new Morpheme instead of changing those.
         """
         # values are created by "mecab" in the order of the parameters and then directly passed into this constructor
         # example of mecab output:    "歩く     歩い    動詞    自立      アルイ"
         # matches to:                 "base     infl    pos     subPos    read"
-        self.pos    = pos # type of morpheme detemined by mecab tool. for example: u'動詞' or u'助動詞', u'形容詞'
-        self.subPos = subPos
-        self.read   = read
-        self.base   = base
-        self.inflected = inflected
+        self.pos    = intern( pos ) # type of morpheme detemined by mecab tool. for example: u'動詞' or u'助動詞', u'形容詞'
+        self.subPos = intern( subPos )
+        self.read   = intern( read )
+        self.base   = intern( base )
+        self.inflected = intern( inflected )
+        self.id     = internMorpheme( self.base, self.pos, self.subPos, self.read ) # inflected isn't part of the identity
 
     def __eq__( self, o ):
         if not isinstance( o, Morpheme ): return False
-        if self.pos != o.pos: return False
-        if self.subPos != o.subPos: return False
-        if self.read != o.read: return False
-        if self.base != o.base: return False
-        #if self.inflected != o.inflected: return False
-        return True
+        return self.id == o.id
 
     def __hash__( self ):
-        #return hash( (self.pos, self.subPos, self.read, self.base, self.inflected) )
-        return hash( (self.pos, self.subPos, self.read, self.base) )
+        return self.id
+
+    # ids are only valid within one process, so pickle the fields and re-intern on load
+    def __reduce__( self ):
+        return ( Morpheme, ( self.base, self.inflected, self.pos, self.subPos, self.read ) )
+
+    def __setstate__( self, d ): # for dbs/caches pickled before Morpheme had __slots__
+        self.__init__( d['base'], d['inflected'], d['pos'], d['subPos'], d['read'] )
 
     def show( self ): # str
         return '\t'.join([ self.base, self.pos, self.subPos, self.read ])
@@ -58,39 +82,79 @@ def ms2str( ms ): # [Morpheme] -> Str
     return '\n'.join( m.show() for m in ms )
 
 class MorphCache():
-    # shared
-    def __init__(self):
-        from aqt import mw # this script isn't imported until profile is loaded
-        import os.path
-        self.path = os.path.join( mw.pm.profileFolder(), 'dbs', 'morph_cache.db' )
-        if os.path.isfile(self.path):
-            import pickle
-            with open(self.path, 'rb') as fp:
-                self.cache = pickle.load(fp)
-        else:
-            self.cache = {}
-    def save(self):
-        import pickle
-        print("saving ", len(self.cache) )
-        if not os.path.exists(os.path.dirname(self.path)):
-            try:
-                os.makedirs(os.path.dirname(self.path))
-            except OSError as exc: # Guard against race condition
-                if exc.errno != errno.EEXIST:
-                    raise
-        with open(self.path, 'wb') as fp:
-            pickle.dump(self.cache, fp)
+    '''Map (MorphemizerDescription, Expression) [Morpheme], backed by an append-only log so
+    new entries are cheap to persist and nothing is unpickled before it is needed.'''
+    def __init__( self, path=None ): # Maybe FilePath -> IO ()
+        from .appendLog import AppendLog
+        if path is None:
+            from aqt import mw # this script isn't imported until profile is loaded
+            path = os.path.join( mw.pm.profileFolder(), 'dbs', 'morph_cache.log' )
+        self.path = path
+        os.makedirs( os.path.dirname( self.path ), exist_ok=True )
+        self.log = AppendLog( self.path )
+        self.lock = threading.RLock() # the log's file handles are shared by Recalc's worker thread and the reviewer
+        self.cache = namedCache( 'morph cache' ) # entries already read from or written to the log
+        self.migrate( os.path.join( os.path.dirname( self.path ), 'morph_cache.db' ) )
+
+    def migrate( self, legacyPath ): # FilePath -> IO ()
+        '''Moves the entries of a whole-file pickled cache into the log'''
+        if not os.path.isfile( legacyPath ): return
+        with open( legacyPath, 'rb' ) as fp:
+            self.update( pickle.load( fp ) )
+        self.save()
+        os.remove( legacyPath )
+
+    def __contains__( self, key ): return key in self.log
+    def __len__( self ):           return len( self.log )
+
+    def get( self, key ): # Key -> IO Maybe [Morpheme]
+        try:
+            return self.cache[ key ]
+        except KeyError:
+            with self.lock:
+                ms = self.log.get( key )
+            if ms is not None:
+                self.cache[ key ] = ms
+            return ms
+
+    def put( self, key, ms ): # Key -> [Morpheme] -> IO ()
+        self.cache[ key ] = ms
+        with self.lock:
+            self.log.put( key, ms )
+
+    def update( self, d ): # Map Key [Morpheme] -> IO ()
+        for key, ms in d.items():
+            self.put( key, ms )
+
+    def flush( self ): # IO ()
+        with self.lock:
+            self.log.flush()
+
+    def save( self ): # IO ()
+        with self.lock, fileLock( self.path ):
+            self.log.checkpoint()
 
 @memoize
 def getMorphCacheDB():
     return MorphCache()
     
+def hasReplaceRules(note_tags): # [Str] -> Bool
+    '''Whether any of the ReplaceRules can apply to notes with these tags. Expressions of such notes
+    have to go through getMorphemes instead of a morphemizer's bulk method.'''
+    replace_rules = jcfg('ReplaceRules')
+    if not replace_rules: return False
+    note_tags_set = set(note_tags)
+    return any(set(filter_tags) <= note_tags_set for (filter_tags, regex, morphemes) in replace_rules)
+
 n = 0
 def getMorphemes(morphemizer, expression, note_tags=None):
     morphCacheDB = getMorphCacheDB()
     morph_key = (morphemizer.getDescription(), expression)
-    if morph_key in morphCacheDB.cache:
-        return morphCacheDB.cache[morph_key]
+    ms = morphCacheDB.get(morph_key)
+    if ms is not None:
+        instrument.count('morph cache hits')
+        return ms
+    instrument.count('morph cache misses')
 
     # go through all replacement rules and search if a rule (which dictates a string to morpheme conversion) can be applied
     replace_rules = jcfg('ReplaceRules')
@@ -117,12 +181,13 @@ def getMorphemes(morphemizer, expression, note_tags=None):
             break
     else:
         ms = morphemizer.getMorphemesFromExpr(expression)
+        instrument.count('morphemizer calls')
     if ms is not None:
-        morphCacheDB.cache[morph_key] = ms
+        morphCacheDB.put(morph_key, ms)
         global n
         n += 1
         if n % 100 == 0:
-            morphCacheDB.save()
+            morphCacheDB.flush()
     return ms
 
 
@@ -195,6 +260,10 @@ class MorphDb:
 
     def __init__( self, path=None, ignoreErrors=False ): # Maybe Filepath -> m ()
         self.db     = {} # Map Morpheme {Location}
+        self.agg    = {} # Map Morpheme [Frequency, MaxMaturity, SumOfSquaredMaturities]; kept in sync with self.db
+        self.meta   = {} # Map Str a; bookkeeping saved along with the db (eg. when it was last updated)
+        self._locDb = None # Maybe Map Location {Morpheme}; built on first use, then kept in sync
+        self._fidDb = None # Maybe Map FactId Location; likewise
         if path:
             try: self.load( path )
             except IOError:
@@ -222,34 +291,85 @@ class MorphDb:
         return ms2str( list(self.db.keys()) )
 
     def save( self, path ): # FilePath -> IO ()
+        from .morphStore import writeDb
         par = os.path.split( path )[0]
-        if not os.path.exists( par ):
+        if par and not os.path.exists( par ):
             os.makedirs( par )
-        f = gzip.open( path, 'wb' )
-        pickle.dump( self.db, f, -1 )
-        f.close()
+        writeDb( path, self.db, self.meta, self.agg )
+        instrument.countFile( 'bytes written', path )
 
     def load( self, path ): # FilePath -> m ()
-        f = gzip.open( path, 'rb' )
-        self.db = pickle.load( f )
-        f.close()
+        '''Reads both the indexed format and old gzip-pickled dbs'''
+        from .morphStore import isStoreFile, readDb, loadLegacy
+        if isStoreFile( path ):
+            self.db, self.meta, agg = readDb( path )
+        else:
+            self.db, self.meta, agg = loadLegacy( path ), {}, None
+        if agg is None: # file from before aggregates were stored
+            agg = dict( ( m, self.aggregate( ls ) ) for m,ls in self.db.items() )
+        self.agg = agg
+        self.invalidateIndexes()
+
+    # Aggregates
+    @staticmethod
+    def aggregate( locs ): # {Location} -> [Frequency, MaxMaturity, SumOfSquaredMaturities]
+        mats = [ getattr( loc, 'maturity', 1 ) for loc in locs ]
+        return [ sum( getattr( loc, 'weight', 1 ) for loc in locs ), max( mats ) if mats else 0, sum( mat ** 2 for mat in mats ) ]
+
+    def _added( self, m, loc ): # Morpheme -> Location -> m ()
+        w, mat = getattr( loc, 'weight', 1 ), getattr( loc, 'maturity', 1 )
+        a = self.agg.get( m )
+        if a is None:
+            self.agg[ m ] = [ w, mat, mat ** 2 ]
+        else:
+            a[0] += w
+            if mat > a[1]: a[1] = mat
+            a[2] += mat ** 2
+
+    def _removed( self, m, loc ): # Morpheme -> Location -> m ()
+        locs = self.db[ m ]
+        if not locs: # no rounding errors left behind
+            self.agg[ m ] = [ 0, 0, 0 ]
+            return
+        w, mat = getattr( loc, 'weight', 1 ), getattr( loc, 'maturity', 1 )
+        a = self.agg[ m ]
+        a[0] -= w
+        a[2] -= mat ** 2
+        if mat >= a[1]:
+            a[1] = max( getattr( l, 'maturity', 1 ) for l in locs )
 
     # Adding
     def clear( self ): # m ()
         self.db = {}
+        self.agg = {}
+        self.invalidateIndexes()
+
+    def addML( self, m, loc ): # Morpheme -> Location -> m Bool
+        '''Returns whether the location is new for that morpheme'''
+        try:
+            locs = self.db[ m ]
+        except KeyError:
+            locs = self.db[ m ] = set()
+        if loc in locs: return False
+        locs.add( loc )
+        self._added( m, loc )
+        if self._locDb is not None:
+            try: self._locDb[ loc ].add( m )
+            except KeyError:
+                self._locDb[ loc ] = set([ m ])
+                if self._fidDb is not None: self._addFid( loc )
+        return True
 
     def addMLs( self, mls ): # [ (Morpheme,Location) ] -> m ()
         for m,loc in mls:
-            try:
-                self.db[m].add( loc )
-            except KeyError:
-                self.db[m] = set([ loc ])
+            self.addML( m, loc )
 
     def addMLs1( self, m, locs ): # Morpheme -> {Location} -> m ()
         if m not in self.db:
-            self.db[m] = locs
-        else:
-            self.db[m].update( locs )
+            self.db[ m ] = set()
+            self.agg[ m ] = [ 0, 0, 0 ]
+        for loc in locs:
+            self.addML( m, loc )
 
     def addMsL( self, ms, loc ): # [Morpheme] -> Location -> m ()
         self.addMLs( (m,loc) for m in ms )
@@ -257,23 +377,62 @@ class MorphDb:
     def addFromLocDb( self, ldb ): # Map Location {Morpheme} -> m ()
         for l,ms in ldb.items():
             for m in ms:
-                try:
-                    self.db[ m ].add( l )
-                except KeyError:
-                    self.db[ m ] = set([ l ])
+                self.addML( m, l )
 
     # returns number of added entries
     def merge( self, md ): # Db -> m Int
         new = 0
         for m,locs in md.db.items():
-            try:
-                new += len( locs - self.db[m] )
-                self.db[m].update( locs )
-            except KeyError:
-                self.db[m] = locs
-                new += len( locs )
+            self.addMLs1( m, () )
+            for loc in locs:
+                new += self.addML( m, loc )
         return new
 
+    # Removing
+    def removeML( self, m, loc ): # Morpheme -> Location -> m ()
+        locs = self.db[ m ]
+        if loc not in locs: return
+        locs.remove( loc )
+        self._removed( m, loc )
+        if self._locDb is not None:
+            ms = self._locDb[ loc ]
+            ms.discard( m )
+            if not ms:
+                del self._locDb[ loc ]
+                if self._fidDb is not None: self._removeFid( loc )
+
+    def removeMorpheme( self, m ): # Morpheme -> m ()
+        for loc in list( self.db[ m ] ):
+            self.removeML( m, loc )
+        del self.db[ m ]
+        del self.agg[ m ]
+
+    def removeLoc( self, loc ): # Location -> m ()
+        '''Removes a location from all its morphemes, and morphemes left without locations'''
+        for m in list( self.locDb().get( loc, () ) ):
+            self.removeML( m, loc )
+            if not self.db[ m ]:
+                self.removeMorpheme( m )
+
+    def replaceLoc( self, loc, newLoc, ms=None ): # Location -> Location -> Maybe [Morpheme] -> m ()
+        '''Puts `newLoc` in place of `loc`, for the same morphemes unless `ms` is given'''
+        if ms is None:
+            ms = list( self.locDb().get( loc, () ) )
+        self.removeLoc( loc )
+        self.addMsL( ms, newLoc )
+
+    def removeLocs( self, pred ): # (Location -> Bool) -> m Int
+        '''Removes locations that match `pred`, and morphemes left without locations. Returns the number of morphemes removed.'''
+        empty = []
+        for m,locs in self.db.items():
+            for loc in [ loc for loc in locs if pred( loc ) ]:
+                self.removeML( m, loc )
+            if not locs:
+                empty.append( m )
+        for m in empty:
+            self.removeMorpheme( m )
+        return len( empty )
+
     def importFile( self, path, morphemizer, maturity=0 ): # FilePath -> Morphemizer -> Maturity? -> IO ()
         f = codecs.open( path, 'r', 'utf-8' )
         inp = f.readlines()
@@ -285,16 +444,25 @@ class MorphDb:
 
     # Analysis (local)
     def frequency( self, m ): # Morpheme -> Int
-        return sum(getattr(loc, 'weight', 1) for loc in self.db[m])
-    
-    # Analysis (local)
+        return self.agg[ m ][0]
+
+    def maxMaturity( self, m ): # Morpheme -> Maturity
+        return self.agg[ m ][1]
+
     def maturity( self, m ): # Morpheme -> Int
-        return math.sqrt(sum(getattr(loc, 'maturity', 1) ** 2 for loc in self.db[m]))
+        return math.sqrt( self.agg[ m ][2] )
 
     # Analysis (global)
-    def locDb( self, recalc=True ): # Maybe Bool -> m Map Location {Morpheme}
-        if hasattr( self, '_locDb' ) and not recalc:
+    # The inverted indexes are built on first use and afterwards updated by every method that adds or
+    # removes locations, so they must not be changed by callers. Pass recalc=True (or call
+    # invalidateIndexes()) only if self.db was changed directly.
+    def invalidateIndexes( self ): # m ()
+        self._locDb = self._fidDb = None
+
+    def locDb( self, recalc=False ): # Maybe Bool -> m Map Location {Morpheme}
+        if self._locDb is not None and not recalc:
             return self._locDb
+        self._fidDb = None
         self._locDb = d = {}
         for m,ls in self.db.items():
             for l in ls:
@@ -302,15 +470,26 @@ class MorphDb:
                 except KeyError: d[ l ] = set([ m ])
         return d
 
-    def fidDb( self, recalc=True ): # Maybe Bool -> m Map FactId Location
-        if hasattr( self, '_fidDb' ) and not recalc:
+    def fidDb( self, recalc=False ): # Maybe Bool -> m Map FactId Location
+        if self._fidDb is not None and not recalc:
             return self._fidDb
-        self._fidDb = d = {}
-        for loc in self.locDb():
-            try:
-                d[ ( loc.noteId, loc.guid, loc.fieldName ) ] = loc
-            except AttributeError: pass # location isn't an anki fact
-        return d
+        locDb = self.locDb( recalc )
+        self._fidDb = {}
+        for loc in locDb:
+            self._addFid( loc )
+        return self._fidDb
+
+    def _addFid( self, loc ): # Location -> m ()
+        try:
+            self._fidDb[ ( loc.noteId, loc.guid, loc.fieldName ) ] = loc
+        except AttributeError: pass # location isn't an anki fact
+
+    def _removeFid( self, loc ): # Location -> m ()
+        try:
+            fid = ( loc.noteId, loc.guid, loc.fieldName )
+        except AttributeError: return
+        if self._fidDb.get( fid ) is loc:
+            del self._fidDb[ fid ]
 
     def countByType( self ): # Map Pos Int
         d = {}
@@ -327,3 +506,37 @@ class MorphDb:
         self.analyze()
         posStr = '\n'.join( '%d\t%d%%\t%s' % ( v, 100.*v/self.count, k ) for k,v in self.posBreakdown.items() )
         return 'Total morphemes: %d\nBy part of spech:\n%s' % ( self.count, posStr )
+
+### Maturity tiers
+SEEN, KNOWN, MATURE = 1, 2, 4
+
+class MaturityTiers:
+    '''Which morphemes of a MorphDb are seen/known/mature, as one byte of flags per Morpheme.id.
+    A morpheme is in a tier if any of its locations has a maturity above the tier's threshold.'''
+
+    def __init__( self, db, thresholdSeen, thresholdKnown, thresholdMature ): # MorphDb -> Maturity -> Maturity -> Maturity -> m ()
+        self.db = db
+        self.thresholds = { SEEN:thresholdSeen, KNOWN:thresholdKnown, MATURE:thresholdMature }
+        self.flags = bytearray( morphemeIdCount() )
+        for m, locs in db.db.items():
+            if not locs: continue
+            maxMat = db.maxMaturity( m )
+            self.flags[ m.id ] = ( SEEN if maxMat > thresholdSeen else 0 ) | ( KNOWN if maxMat > thresholdKnown else 0 ) | ( MATURE if maxMat > thresholdMature else 0 )
+
+    def has( self, tier, m ): # Tier -> Morpheme -> Bool
+        return m.id < len( self.flags ) and self.flags[ m.id ] & tier != 0
+
+    def isSeen( self, m ):   return self.has( SEEN, m )
+    def isKnown( self, m ):  return self.has( KNOWN, m )
+    def isMature( self, m ): return self.has( MATURE, m )
+
+    def morphemes( self, tier ): # Tier -> {Morpheme}
+        return set( m for m in self.db.db if self.has( tier, m ) )
+
+    def filteredDb( self, tier ): # Tier -> MorphDb
+        '''The morphemes of a tier with only their locations above its threshold (eg. known.db)'''
+        mat, newDb = self.thresholds[ tier ], MorphDb()
+        for m, locs in self.db.db.items():
+            if self.has( tier, m ):
+                newDb.addMLs1( m, [ loc for loc in locs if getattr( loc, 'maturity', 1 ) > mat ] )
+        return newDb
@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
-import pickle, gzip, os, subprocess, re
+import atexit, pickle, gzip, os, subprocess, re, threading
 import importlib
 
 from .morphemes import Morpheme
-from .util_external import memoize
+from .util_external import memoize, boundedMemoize
 
 ####################################################################################################
 # Base Class
@@ -48,6 +48,9 @@ class MecabMorphemizer(Morphemizer):
     def getMorphemesFromExpr(self, e): # Str -> IO [Morpheme]
         return getMorphemesMecab(e)
 
+    def getMorphemesFromExprBulk(self, es): # [Str] -> IO [[Morpheme]]
+        return getMorphemesMecabBulk(es)
+
     def getDescription(self):
         return 'Japanese'
 
@@ -59,20 +62,28 @@ MECAB_POS_BLACKLIST = [
     '記号',     # "symbol", generally punctuation
 ]
 
-@memoize
-def getMorphemesMecab(e):
-    ms = [ tuple( m.split('\t') ) for m in interact( e ).split('\r') ] # morphemes
+FIX_READING_POS = ['動詞', '助動詞', '形容詞'] # verb, aux verb, i-adj
+
+def parseMecab( out ): # Str -> [Morpheme]
+    '''Turns the output of `interact` into morphemes (with the reading of the inflected form)'''
+    ms = [ tuple( m.split('\t') ) for m in out.split('\r') ] # morphemes
     ms = [ Morpheme( *m ) for m in ms if len( m ) == MECAB_NODE_LENGTH ] # filter garbage
-    ms = [ m for m in ms if m.pos not in MECAB_POS_BLACKLIST ]
-    ms = [ fixReading( m ) for m in ms ]
-    return ms
+    return [ m for m in ms if m.pos not in MECAB_POS_BLACKLIST ]
+
+@boundedMemoize('mecab morphemes')
+def getMorphemesMecab(e):
+    return [ fixReading( m ) for m in parseMecab( interact( e ) ) ]
+
+def getMorphemesMecabBulk( es ): # [Str] -> IO [[Morpheme]]
+    '''getMorphemesMecab for many expressions, without one mecab round trip per expression'''
+    return fixReadingsBulk( [ parseMecab( out ) for out in interactBulk( es ) ] )
 
 def spawnCmd(cmd, startupinfo): # [Str] -> subprocess.STARTUPINFO -> IO subprocess.Popen
     return subprocess.Popen(cmd, startupinfo=startupinfo,
         bufsize=-1, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
-def spawnMecab(base_cmd, startupinfo): # [Str] -> subprocess.STARTUPINFO -> IO MecabProc
-    '''Try to start a MeCab subprocess in the given way, or fail.
+def probeMecab(base_cmd, startupinfo): # [Str] -> subprocess.STARTUPINFO -> IO ()
+    '''Check whether MeCab can be started in the given way, or fail.
 
     Raises OSError if the given base_cmd and startupinfo don't work
     for starting up MeCab, or the MeCab they produce has a dictionary
@@ -101,22 +112,14 @@ like `mecab-ipadic`.
                       + dicinfo_dump)
     MECAB_ENCODING = charset_match.group(1)
 
-    args = ['--node-format=%s\r' % ('\t'.join(MECAB_NODE_PARTS),),
-            '--eos-format=\n',
-            '--unk-format=']
-    return spawnCmd(base_cmd + args, startupinfo)
-
 @memoize
-def mecab(): # IO MecabProc
-    '''Start a MeCab subprocess and return it.
-
-    `mecab` reads expressions from stdin at runtime, so only one
-    instance is needed.  That's why this function is memoized.
-    '''
+def mecabCmd(): # IO ([Str], subprocess.STARTUPINFO)
+    '''Find a working MeCab and return how to start it.'''
     try:
         # First, try `mecab` from the system.  See if that exists and
         # is compatible with our assumptions.
-        return spawnMecab(['mecab'], None)
+        probeMecab(['mecab'], None)
+        return ['mecab'], None
     except OSError:
         # If no luck, rummage inside the Japanese Support addon and borrow its way
         # of running the mecab bundled inside it.
@@ -130,29 +133,188 @@ def mecab(): # IO MecabProc
         # sys.stderr.write(str(m.mecabCmd[:1]))
         # sys.stderr.write(str(m.mecabCmd[4:]))
         # sys.stderr.write(str(reading.si))
-        return spawnMecab(m.mecabCmd[:1] + m.mecabCmd[4:], reading.si)
+        base_cmd = m.mecabCmd[:1] + m.mecabCmd[4:]
+        probeMecab(base_cmd, reading.si)
+        return base_cmd, reading.si
 
-@memoize
+def spawnMecab(): # IO MecabProc
+    '''Start a MeCab subprocess that reads expressions from stdin.'''
+    base_cmd, startupinfo = mecabCmd()
+    args = ['--node-format=%s\r' % ('\t'.join(MECAB_NODE_PARTS),),
+            '--eos-format=\n',
+            '--unk-format=']
+    return spawnCmd(base_cmd + args, startupinfo)
+
+MECAB_POOL_SIZE = None  # None means one process per CPU core
+MECAB_MIN_SHARD = 500   # don't start another process for fewer expressions than this
+
+class MecabPool:
+    '''
+    MeCab worker processes. Bulk input is sharded over the workers and the results are merged back
+    in input order. Single expressions go to a process of their own that bulk work never uses, so a
+    lookup (eg. from the reviewer while Recalc runs in the background) doesn't wait for a shard.
+    Processes are started when they are first needed and restarted if they died.
+    '''
+    def __init__(self, size=None):
+        self.procs = []
+        self.locks = []
+        self.single = None # Maybe MecabProc; for single expressions
+        self.singleLock = threading.Lock()
+        self.resize(size)
+
+    def resize(self, size): # Maybe Int -> IO ()
+        size = size or os.cpu_count() or 1
+        for p in self.procs[size:]:
+            self.stopWorker(p)
+        self.procs = self.procs[:size] + [None] * (size - len(self.procs))
+        self.locks = self.locks[:size] + [threading.Lock() for _ in range(size - len(self.locks))]
+
+    def __len__(self):
+        return len(self.procs)
+
+    def worker(self, i): # Int -> IO MecabProc
+        p = self.procs[i]
+        if p is None or p.poll() is not None:
+            p = self.procs[i] = spawnMecab()
+        return p
+
+    def singleWorker(self): # IO MecabProc
+        if self.single is None or self.single.poll() is not None:
+            self.single = spawnMecab()
+        return self.single
+
+    def restartWorker(self, i): # Int -> IO MecabProc
+        self.stopWorker(self.procs[i])
+        self.procs[i] = None
+        return self.worker(i)
+
+    @staticmethod
+    def stopWorker(p): # Maybe MecabProc -> IO ()
+        if p is None or p.poll() is not None: return
+        try:
+            p.stdin.close()
+            p.wait(timeout=2)
+        except (IOError, subprocess.TimeoutExpired):
+            p.kill()
+            p.wait()
+
+    def shutdown(self): # IO ()
+        for i, p in enumerate(self.procs):
+            self.stopWorker(p)
+            self.procs[i] = None
+        with self.singleLock:
+            self.stopWorker(self.single)
+            self.single = None
+
+    def interact(self, expr): # Str -> IO Str
+        with self.singleLock:
+            p = self.singleWorker()
+            expr = expr.encode( MECAB_ENCODING, 'ignore' )
+            p.stdin.write( expr + b'\n' )
+            p.stdin.flush()
+            return '\r'.join( [ str( p.stdout.readline().rstrip( b'\r\n' ), MECAB_ENCODING ) for l in expr.split(b'\n') ] )
+
+    def interactBulk(self, exprs): # [Str] -> IO [Str]
+        n = max(1, min(len(self.procs), len(exprs) // MECAB_MIN_SHARD))
+        bounds = [len(exprs) * i // n for i in range(n + 1)]
+        shards = [exprs[bounds[i]:bounds[i+1]] for i in range(n)]
+        results, errors = [None] * n, []
+        for i in range(n): self.worker(i) # start processes here, not concurrently in the threads
+
+        def run(i):
+            try:
+                with self.locks[i]:
+                    try:
+                        results[i] = interactWith(self.worker(i), shards[i])
+                    except OSError:
+                        # the process died (eg. on bad input); give it one more try. There's no timeout,
+                        # so a mecab that hangs without exiting hangs here
+                        results[i] = interactWith(self.restartWorker(i), shards[i])
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(i,), name='mecab shard %d' % i) for i in range(n)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        if errors: raise errors[0]
+        return [out for r in results for out in r]
+
+_mecabPool = None
+def mecabPool(): # IO MecabPool
+    global _mecabPool
+    if _mecabPool is None:
+        _mecabPool = MecabPool(MECAB_POOL_SIZE)
+        atexit.register(_mecabPool.shutdown)
+    return _mecabPool
+
+def setMecabPoolSize(size): # Maybe Int -> IO ()
+    global MECAB_POOL_SIZE
+    MECAB_POOL_SIZE = size
+    if _mecabPool is not None:
+        _mecabPool.resize(size)
+
+def mecab(): # IO MecabProc
+    '''Return the MeCab subprocess used for single expressions (starting it if needed).'''
+    return mecabPool().singleWorker()
+
+@boundedMemoize('mecab interact')
 def interact( expr ): # Str -> IO Str
     ''' "interacts" with 'mecab' command: writes expression to stdin of 'mecab' process and gets all the morpheme infos from its stdout. '''
-    p = mecab()
-    expr = expr.encode( MECAB_ENCODING, 'ignore' )
-    p.stdin.write( expr + b'\n' )
-    p.stdin.flush()
-    return '\r'.join( [ str( p.stdout.readline().rstrip( b'\r\n' ), MECAB_ENCODING ) for l in expr.split(b'\n') ] )
-
-@memoize
+    return mecabPool().interact( expr )
+
+def interactBulk( exprs ): # [Str] -> IO [Str]
+    '''`interact` for many expressions at once, spread over the processes in the pool'''
+    return mecabPool().interactBulk( exprs )
+
+def interactWith( p, exprs ): # MecabProc -> [Str] -> IO [Str]
+    '''Streams expressions through one MeCab process. A writer thread feeds all expressions to
+    mecab while this thread reads the results, so neither side waits for a round trip (and a full
+    pipe can't deadlock us). Results are told apart by counting EOS-terminated lines.'''
+    exprs = [ e.encode( MECAB_ENCODING, 'ignore' ) for e in exprs ]
+    def write():
+        try:
+            for e in exprs:
+                p.stdin.write( e + b'\n' )
+            p.stdin.flush()
+        except (IOError, ValueError): pass # mecab died; the reader below notices
+    writer = threading.Thread( target=write, name='mecab writer' )
+    writer.daemon = True
+    writer.start()
+
+    outs = []
+    for e in exprs:
+        lines = []
+        for _ in e.split( b'\n' ): # mecab answers every input line with one line
+            l = p.stdout.readline()
+            if not l:
+                raise OSError( 'MeCab exited unexpectedly' )
+            lines.append( str( l.rstrip( b'\r\n' ), MECAB_ENCODING ) )
+        outs.append( '\r'.join( lines ) )
+    writer.join()
+    return outs
+
+@boundedMemoize('mecab readings')
 def fixReading( m ): # Morpheme -> IO Morpheme
     '''
     'mecab' prints the reading of the kanji in inflected forms (and strangely in katakana). So 歩い[て] will
     have アルイ as reading. This function sets the reading to the reading of the base form (in the example it will be 'アルク').
     '''
-    if m.pos in ['動詞', '助動詞', '形容詞']: # verb, aux verb, i-adj
+    if m.pos in FIX_READING_POS:
         n = interact( m.base ).split('\t')
         if len(n) == MECAB_NODE_LENGTH:
-            m.read = n[ MECAB_NODE_READING_INDEX ].strip()
+            return Morpheme( m.base, m.inflected, m.pos, m.subPos, n[ MECAB_NODE_READING_INDEX ].strip() )
     return m
 
+def fixReadingsBulk( mss ): # [[Morpheme]] -> IO [[Morpheme]]
+    '''fixReading for many morphemes, looking up the readings of all base forms in one pass'''
+    bases = list( set( m.base for ms in mss for m in ms if m.pos in FIX_READING_POS ) )
+    readings = {}
+    for base, out in zip( bases, interactBulk( bases ) ):
+        n = out.split('\t')
+        if len(n) == MECAB_NODE_LENGTH:
+            readings[ base ] = n[ MECAB_NODE_READING_INDEX ].strip()
+    return [ [ Morpheme( m.base, m.inflected, m.pos, m.subPos, readings[ m.base ] ) if m.pos in FIX_READING_POS and m.base in readings else m
+               for m in ms ] for ms in mss ]
+
 
 
 
@@ -3,7 +3,7 @@ from aqt import reviewer, dialogs
 from aqt.qt import *
 from aqt.utils import tooltip
 from anki import sched
-from .util import addBrowserNoteSelectionCmd, addBrowserCardSelectionCmd, jcfg, cfg, cfg1, wrap, tooltip, mw, addHook, allDb, partial
+from .util import addBrowserNoteSelectionCmd, addBrowserCardSelectionCmd, jcfg, cfg, cfg1, wrap, tooltip, mw, addHook, snapshot, partial
 
 # only for jedi-auto-completion
 import aqt.main
@@ -194,7 +194,6 @@ def browseSameFocus( self ): #3
 # addBrowserCardSelectionCmd( 'MorphMan: Learn Now', pre, per, post, tooltip='Immediately review the selected new cards', shortcut=('Ctrl+Shift+N',) )
 
 ########## 5 - highlight morphemes using morphHighlight
-import re
 
 def isNoteSame(note, fieldDict):
     # compare fields
@@ -216,11 +215,7 @@ def highlight( txt, extra, fieldDict, field, mod_field ):
     from .util import getFilterByTagsAndType
     from .morphemizer import getMorphemizerByName
     from .morphemes import getMorphemes
-
-    # must avoid formatting a smaller morph that is contained in a bigger morph
-    # => do largest subs first and don't sub anything already in <span>
-    def nonSpanSub( sub, repl, string ):
-        return ''.join( re.sub( sub, repl, s ) if not s.startswith('<span') else s for s in re.split( '(<span.*?</span>)', string ) )
+    from . import morphHighlight
 
     # find morphemizer; because no note/card information is exposed through arguments, we have to find morphemizer based on tags alone
     #from aqt.qt import debug; debug()
@@ -237,21 +232,10 @@ def highlight( txt, extra, fieldDict, field, mod_field ):
     morphemizer = getMorphemizerByName(filter['Morphemizer'])
     if morphemizer is None:
         return txt
-    ms = getMorphemes(morphemizer, txt, tags)
-
-    for m in sorted( ms, key=lambda x: len(x.inflected), reverse=True ): # largest subs first
-        locs = allDb().db.get( m, set() )
-        mat = max( loc.maturity for loc in locs ) if locs else 0
-
-        if   mat >= cfg1( 'threshold_mature' ):  mtype = 'mature'
-        elif mat >= cfg1( 'threshold_known' ):   mtype = 'known'
-        elif mat >= cfg1( 'threshold_seen' ):    mtype = 'seen'
-        else:                                    mtype = 'unknown'
-        repl = '<span class="morphHighlight" mtype="{mtype}" mat="{mat}">{morph}</span>'.format(
-                morph = m.inflected,
-                mtype = mtype,
-                mat = mat
-                )
-        txt = nonSpanSub( m.inflected, repl, txt )
-    return txt
+
+    db = snapshot()
+    thresholds = ( cfg1( 'threshold_seen' ), cfg1( 'threshold_known' ), cfg1( 'threshold_mature' ) )
+    def render():
+        return morphHighlight.render( txt, getMorphemes( morphemizer, txt, tags ), db.maxMaturity, thresholds )
+    return morphHighlight.cachedRender( ( filter['Morphemizer'], txt, tuple( tags ), thresholds ), db, render )
 addHook( 'fmod_morphHighlight', highlight )
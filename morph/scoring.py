@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+'''
+Morph Man Index (MMI) scoring for all notes at once.
+
+Everything updateNotes needs to know about a single morpheme (is it seen/known/mature, how
+often does it occur, is it in priority.db, ...) only depends on the dbs, not on the note, so
+it is computed once per morpheme and stored in tables indexed by Morpheme.id. Scoring a note
+then only sums table entries over the ids of its morphemes.
+
+With numpy available all notes are scored with a few array operations over the note x morpheme
+incidence (in CSR form); otherwise the same arithmetic runs as a plain Python loop.
+'''
+from .morphemes import Morpheme, morphemeIdCount, MATURE
+from .scoringKernel import numpyOrNone, NoteWeights, scoreNote, scoreNotesNumpy, scoreNotesParallel
+
+# Inflected German verb forms (STTS tags) whose infinitive shouldn't count as new vocabulary on its own.
+# Occurrences of a not yet known infinitive are subtracted from the frequency of the inflected form.
+DEPENDS = {
+    "VVFIN" : "VVINF",	#	finites Verb, voll 	[du] gehst, [wir] kommen [an]
+    "VVIMP" : "VVINF",	#	Imperativ, voll 	komm [!]
+    # "VVINF" : "VVINF",	#	Infinitiv, voll 	gehen, ankommen
+    "VVIZU" : "VVINF",	#	Infinitiv mit ``zu'', voll 	anzukommen, loszulassen
+    "VVPP"  : "VVINF",	#	Partizip Perfekt, voll 	gegangen, angekommen
+
+    "VAFIN" : "VAINF",	#	finites Verb, aux 	[du] bist, [wir] werden
+    "VAIMP" : "VAINF",	#	Imperativ, aux 	sei [ruhig !]
+    # "VAINF" : "VAINF",	#	Infinitiv, aux 	werden, sein
+    "VAPP"  : "VAINF",	#	Partizip Perfekt, aux 	gewesen
+
+    "VMFIN" : "VMINF",	#	finites Verb, modal 	dürfen
+    # "VMINF" : "VMINF",	#	Infinitiv, modal 	wollen
+    "VMPP"  : "VMINF",	#	Partizip Perfekt, modal 	gekonnt, [er hat gehen] können
+}
+
+class MorphemeTable:
+    '''Per-morpheme scoring inputs, indexed by Morpheme.id. Morphemes that aren't in allDb count
+    as unknown/unmature with frequency 0.'''
+
+    def __init__( self, allDb, priorityDb, tiers ): # MorphDb -> Map Morpheme a -> MaturityTiers -> m ()
+        n = morphemeIdCount()
+        self.tiers      = tiers
+        self.priority   = bytearray( n )
+        self.verb       = bytearray( n )
+        self.focusFreq  = [ 0 ] * n # frequency of an unknown morpheme, minus the `DEPENDS` adjustments
+        self.reinforceIvl = [ 1 ] * n # divisor for the 'reinforce new vocab weight' of known but unmature morphemes
+
+        thresholdMature = tiers.thresholds[ MATURE ]
+
+        def penalty( baseMorph ): # Morpheme -> Maybe Number
+            if baseMorph in allDb.db and not tiers.isKnown( baseMorph ):
+                return allDb.frequency( baseMorph ) * ( 1 - max( min( allDb.maturity( baseMorph ) / thresholdMature, 1 ), 0 ) )
+            return None
+
+        for m in allDb.db:
+            i = m.id
+            self.priority[ i ] = m in priorityDb
+            self.verb[ i ]     = m.pos == '動詞'
+            if tiers.isKnown( m ):
+                if not tiers.isMature( m ):
+                    self.reinforceIvl[ i ] = min( 1, allDb.maxMaturity( m ) )
+                continue
+            f = allDb.frequency( m )
+            if m.subPos in DEPENDS and DEPENDS[ m.subPos ] != m.subPos:
+                p = penalty( Morpheme( m.base, m.inflected, m.pos, DEPENDS[ m.subPos ], m.read ) )
+                if p is not None: f = max( 0, f - p )
+            if m.base != m.inflected:
+                p = penalty( Morpheme( m.inflected, m.inflected, m.pos, m.subPos, m.inflected ) )
+                if p is not None: f = max( 0, f - p )
+            self.focusFreq[ i ] = f
+
+# ( N, N_k, N_m, F_k_avg, isPriority, lenDiffRaw, mmi )
+def scoreNotes( table, notes, weights ): # MorphemeTable -> [[MorphemeId]] -> [NoteWeights] -> [( Int, Int, Int, Number, Bool, Int, Int )]
+    '''Scores notes given the ids of their (distinct) morphemes'''
+    np = numpyOrNone()
+    if np is None or not notes:
+        return [ scoreNote( table, ids, w ) for ids, w in zip( notes, weights ) ]
+    return scoreNotesNumpy( np, table, notes, weights )
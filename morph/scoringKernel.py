@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+'''
+The parts of MMI scoring (see scoring.py) that also run in worker processes.
+
+With 'scoring processes' set, updateNotes scores the notes in a pool of processes. The
+per-morpheme tables are copied once into a shared memory block that every worker maps
+read-only, so only the morpheme ids of the notes and the scores are sent around.
+
+Workers load this file as a top-level module (`scoringKernel`) instead of as part of the
+add-on package, because importing the package needs a running Anki. So this module may only
+import the standard library (and numpy). multiprocessing.shared_memory (Python 3.8+) is only
+imported once scoring in processes is asked for; without it updateNotes scores in-process.
+'''
+import array, importlib.util, multiprocessing, os, sys, types
+
+try:
+    from .morphemes import KNOWN, MATURE
+except ImportError: # loaded on its own in a worker process
+    KNOWN, MATURE = 2, 4
+
+def numpyOrNone(): # Maybe Module
+    '''numpy isn't shipped with Anki, so it's only used when the user has it installed'''
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+class NoteWeights:
+    '''The model dependent settings that enter the MMI of a note, read from a ResolvedCfg'''
+    __slots__ = ( 'priority', 'reinforce', 'verbBonus', 'minLength', 'maxLength' )
+
+    def __init__( self, C ):
+        self.priority   = C('priority.db weight')
+        self.reinforce  = C('reinforce new vocab weight')
+        self.verbBonus  = C('verb bonus')
+        self.minLength  = C('min good sentence length')
+        self.maxLength  = C('max good sentence length')
+
+    def values( self ): # ( Number, Number, Number, Int, Int )
+        return tuple( getattr( self, a ) for a in self.__slots__ )
+
+    @staticmethod
+    def fromValues( vs ): # ( Number, Number, Number, Int, Int ) -> NoteWeights
+        w = NoteWeights.__new__( NoteWeights )
+        for a, v in zip( NoteWeights.__slots__, vs ): setattr( w, a, v )
+        return w
+
+def scoreNote( table, ids, w ): # MorphemeTable -> [MorphemeId] -> NoteWeights -> ( Int, Int, Int, Number, Bool, Int, Int )
+    flags, size = table.tiers.flags, len( table.tiers.flags )
+    N = len( ids )
+    N_k = N_m = priorities = 0
+    F_k = reinforce = 0
+    verb = False
+    for i in ids:
+        if i >= size: # not in allDb
+            N_k += 1
+            N_m += 1
+            continue
+        known, mature = flags[ i ] & KNOWN, flags[ i ] & MATURE
+        if not known:
+            N_k += 1
+            F_k += table.focusFreq[ i ]
+            priorities += table.priority[ i ]
+            verb = verb or table.verb[ i ] == 1
+        if not mature:
+            N_m += 1
+            if known:
+                reinforce += w.reinforce // table.reinforceIvl[ i ]
+    F_k_avg = F_k // N_k if N_k > 0 else F_k
+
+    usefulness = F_k_avg + priorities * w.priority + reinforce + ( w.verbBonus if verb else 0 )
+    usefulness = 999 - min( 999, usefulness )
+
+    # difference from optimal length range (too little context vs long sentence)
+    lenDiffRaw = min( N - w.minLength, max( 0, N - w.maxLength ) )
+    lenDiff = min( 9, abs( lenDiffRaw ) )
+
+    mmi = 10000*N_k + 1000*lenDiff + usefulness
+    return N, N_k, N_m, F_k_avg, priorities > 0, lenDiffRaw, int( mmi )
+
+def scoreNotesNumpy( np, table, notes, weights ): # Module -> MorphemeTable -> [[MorphemeId]] -> [NoteWeights] -> [( Int, Int, Int, Number, Bool, Int, Int )]
+    nNotes, size = len( notes ), len( table.tiers.flags )
+
+    # CSR incidence: morpheme ids of all notes back to back, `row` says which note an entry belongs to
+    lengths = np.fromiter( ( len( ids ) for ids in notes ), dtype=np.int64, count=nNotes )
+    row = np.repeat( np.arange( nNotes ), lengths )
+    col = np.fromiter( ( i for ids in notes for i in ids ), dtype=np.int64, count=int( lengths.sum() ) )
+    inTable = col < size
+    col = np.where( inTable, col, 0 )
+
+    def perMorpheme( values, default ): # [a] -> a -> Array a
+        return np.where( inTable, np.asarray( values )[ col ], default )
+    flags   = perMorpheme( np.frombuffer( table.tiers.flags, dtype=np.uint8 ), 0 )
+    known, mature = ( flags & KNOWN ) != 0, ( flags & MATURE ) != 0
+    unknown, newKnown = ~known, known & ~mature
+
+    def perNote( entryValues ): # Array Number -> Array Number
+        return np.bincount( row, weights=entryValues, minlength=nNotes )
+    w = lambda attr: np.array( [ getattr( x, attr ) for x in weights ], dtype=np.float64 )
+
+    N   = lengths
+    N_k = perNote( unknown ).astype( np.int64 )
+    N_m = perNote( ~mature ).astype( np.int64 )
+    F_k = perNote( unknown * perMorpheme( table.focusFreq, 0 ) )
+    F_k_avg = np.where( N_k > 0, np.floor_divide( F_k, np.maximum( N_k, 1 ) ), F_k )
+    priorities = perNote( unknown * perMorpheme( np.frombuffer( table.priority, dtype=np.uint8 ), 0 ) )
+    reinforce = perNote( np.where( newKnown, np.floor_divide( w( 'reinforce' )[ row ], perMorpheme( table.reinforceIvl, 1 ) ), 0 ) )
+    verb = perNote( unknown * perMorpheme( np.frombuffer( table.verb, dtype=np.uint8 ), 0 ) ) > 0
+
+    usefulness = F_k_avg + priorities * w( 'priority' ) + reinforce + verb * w( 'verbBonus' )
+    usefulness = 999 - np.minimum( 999, usefulness )
+
+    lenDiffRaw = np.minimum( N - w( 'minLength' ), np.maximum( 0, N - w( 'maxLength' ) ) )
+    lenDiff = np.minimum( 9, np.abs( lenDiffRaw ) )
+
+    mmi = 10000*N_k + 1000*lenDiff + usefulness
+    return list( zip( N.tolist(), N_k.tolist(), N_m.tolist(), F_k_avg.tolist(), ( priorities > 0 ).tolist(),
+                      lenDiffRaw.astype( np.int64 ).tolist(), np.floor( mmi ).astype( np.int64 ).tolist() ) )
+
+################################################################################
+## Scoring in worker processes
+################################################################################
+
+# ( attribute of MorphemeTable, array type ); 8 byte columns first so all of them stay aligned
+COLUMNS = [ ( 'focusFreq', 'd' ), ( 'reinforceIvl', 'd' ), ( 'priority', 'B' ), ( 'verb', 'B' ), ( 'flags', 'B' ) ]
+ITEM_SIZES = { 'd':8, 'B':1 }
+
+class SharedTable:
+    '''The columns of a MorphemeTable in one shared memory block. Has the same attributes as
+    MorphemeTable (including `tiers.flags`), so the scoring functions work on it unchanged.'''
+
+    def __init__( self, name, n, create=False ): # Str -> Int -> Bool -> IO ()
+        from multiprocessing import shared_memory
+        self.n, self.owner = n, create
+        size = max( 1, n * sum( ITEM_SIZES[ t ] for c, t in COLUMNS ) )
+        self.shm = shared_memory.SharedMemory( name=name, create=create, size=size if create else 0 )
+        self.name = self.shm.name
+        self.views, offset = [], 0
+        try:
+            for col, t in COLUMNS:
+                view = self.shm.buf[ offset:offset + n * ITEM_SIZES[ t ] ].cast( t )
+                self.views.append( view )
+                setattr( self, col, view )
+                offset += n * ITEM_SIZES[ t ]
+        except BaseException:
+            self.close()
+            raise
+        self.tiers = self
+
+    @staticmethod
+    def fromTable( table ): # MorphemeTable -> IO SharedTable
+        # The table's columns cover every morpheme id interned when it was built, which can be more
+        # than the tiers saw (eg. priority.db is loaded after tiering); those have no tier flags.
+        n = len( table.priority )
+        shared = SharedTable( None, n, create=True )
+        try:
+            for col, t in COLUMNS:
+                if col == 'flags':
+                    flags = table.tiers.flags[ :n ]
+                    shared.flags[ :len( flags ) ] = flags
+                    shared.flags[ len( flags ): ] = bytes( n - len( flags ) )
+                    continue
+                src = getattr( table, col )
+                getattr( shared, col )[:] = src if t == 'B' else array.array( 'd', src )
+        except BaseException:
+            shared.close()
+            raise
+        return shared
+
+    def close( self ): # IO ()
+        for view in self.views: view.release()
+        self.views = []
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+_table = None # SharedTable of a worker process
+
+def initWorker( name, n ): # Str -> Int -> IO ()
+    global _table
+    _table = SharedTable( name, n )
+
+def scoreChunk( job ): # ( [[MorphemeId]], [( Number, ... )], [Int] ) -> [( Int, Int, Int, Number, Bool, Int, Int )]
+    '''Scores a slice of the notes in a worker. Weights are sent as the distinct weight values plus
+    an index per note, since NoteWeights of the add-on package can't be unpickled here.'''
+    notes, weightValues, weightIdx = job
+    weights = [ NoteWeights.fromValues( vs ) for vs in weightValues ]
+    weights = [ weights[ i ] for i in weightIdx ]
+    np = numpyOrNone()
+    if np is None or not notes:
+        return [ scoreNote( _table, ids, w ) for ids, w in zip( notes, weights ) ]
+    return scoreNotesNumpy( np, _table, notes, weights )
+
+def workerModule(): # IO Module
+    '''This file loaded as the top-level module workers import it as'''
+    if __name__ == 'scoringKernel':
+        return sys.modules[ __name__ ]
+    mod = sys.modules.get( 'scoringKernel' )
+    if mod is None or os.path.abspath( getattr( mod, '__file__', '' ) ) != os.path.abspath( __file__ ):
+        spec = importlib.util.spec_from_file_location( 'scoringKernel', __file__ )
+        mod = importlib.util.module_from_spec( spec )
+        sys.modules[ 'scoringKernel' ] = mod
+        spec.loader.exec_module( mod )
+    return mod
+
+def startPool( processes, shared ): # Int -> SharedTable -> IO multiprocessing.Pool
+    '''Spawns the workers. While they start, this directory is on sys.path (so they can import
+    this module) and __main__ is replaced by an empty module, as spawned processes would
+    otherwise run the script that started Anki (or mm) again.'''
+    if getattr( sys, 'frozen', False ):
+        raise RuntimeError( 'no Python interpreter to start scoring processes with in a frozen Anki' )
+    here = os.path.dirname( os.path.abspath( __file__ ) )
+    main = sys.modules.get( '__main__' )
+    sys.path.insert( 0, here )
+    sys.modules[ '__main__' ] = types.ModuleType( '__main__' )
+    try:
+        return multiprocessing.get_context( 'spawn' ).Pool( processes, initializer=initWorker, initargs=( shared.name, shared.n ) )
+    finally:
+        sys.modules[ '__main__' ] = main
+        sys.path.remove( here )
+
+def scoreNotesParallel( table, notes, weights, processes ): # MorphemeTable -> [[MorphemeId]] -> [NoteWeights] -> Int -> IO [( Int, Int, Int, Number, Bool, Int, Int )]
+    '''Same as scoring.scoreNotes, with the notes split over `processes` worker processes'''
+    kernel = workerModule()
+    distinct, weightIdx = {}, []
+    for w in weights:
+        weightIdx.append( distinct.setdefault( w.values(), len( distinct ) ) )
+    weightValues = sorted( distinct, key=distinct.get )
+
+    size = max( 1, -( -len( notes ) // ( processes * 4 ) ) ) # a few slices per process, so they finish about together
+    jobs = [ ( notes[ i:i+size ], weightValues, weightIdx[ i:i+size ] ) for i in range( 0, len( notes ), size ) ]
+    shared = kernel.SharedTable.fromTable( table )
+    try:
+        pool = kernel.startPool( processes, shared )
+        try:
+            results = pool.map( kernel.scoreChunk, jobs )
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shared.close()
+    return [ score for part in results for score in part ]
@@ -2,6 +2,8 @@
 import glob, gzip, os, pickle as pickle
 
 from .util import addHook, cfg1, wrap, mw
+from .instrument import countFile
+from .util_external import atomicPath
 from aqt import toolbar
 
 def getStatsPath(): return cfg1('path_stats')
@@ -18,21 +20,24 @@ def loadStats():
         return None
 
 def saveStats( d ):
-    f = gzip.open( getStatsPath(), 'wb' )
-    pickle.dump( d, f, -1 )
-    f.close()
+    with atomicPath( getStatsPath() ) as tmp:
+        with gzip.open( tmp, 'wb' ) as f:
+            pickle.dump( d, f, -1 )
+    countFile( 'bytes written', getStatsPath() )
 
-def updateStats( knownDb=None ):
+def updateStats( known=None ): # Maybe {Morpheme} -> IO Stats
+    '''`known` are the known morphemes, if they are already at hand (eg. after Recalc)'''
     mw.progress.start( label='Updating stats', immediate=True )
 
-    from .morphemes import MorphDb
+    from .morphStore import MorphStore
     d = {}
 
-    # Load known.db and get total morphemes known
-    if knownDb is None:
-        knownDb = MorphDb( cfg1('path_known'), ignoreErrors=True )
+    # Get total morphemes known; known.db only has to be queried, not loaded
+    if known is None:
+        try:    known = MorphStore( cfg1('path_known') )
+        except IOError: known = {}
 
-    d['totalKnown'] = len( knownDb.db )
+    d['totalKnown'] = len( known )
 
     # Load Goal.*.db dbs, get morphemes required, and compare vs known.db
     d['goals'] = {}
@@ -40,19 +45,19 @@ def updateStats( knownDb=None ):
 
     for path in goalDbPaths:
         name = os.path.basename( path )[5:][:-3]
-        gdb = MorphDb( path )
+        gdb = MorphStore( path )
 
         # track total unique morphemes + when weighted by frequency
         # NOTE: a morpheme may occur multiple times within the same sentence, but this frequency is wrt note fields
         numUniqueReq, numUniqueKnown, numFreqReq, numFreqKnown = 0, 0, 0, 0
-        for m in gdb.db.keys():
-            freq = gdb.db.frequency(m)
+        for m, freq in gdb.frequencies():
             numUniqueReq += 1
             numFreqReq   += freq
-            if m in knownDb.db:
+            if m in known:
                 numUniqueKnown += 1
                 numFreqKnown   += freq
 
+        gdb.close()
         d['goals'][ name ] = { 'total':numUniqueReq, 'known':numUniqueKnown, 'freqTotal':numFreqReq, 'freqKnown':numFreqKnown }
 
     saveStats( d )
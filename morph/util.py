@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-import codecs, datetime
+import atexit, codecs, datetime, logging, logging.handlers, os, queue, sys
 from PyQt5.QtWidgets import *
 from functools import partial
 from PyQt5.QtCore import *
@@ -25,6 +25,27 @@ def allDb():
         _allDb = MorphDb( cfg1('path_all'), ignoreErrors=True )
     return _allDb
 
+_snapshot = None
+def snapshot():
+    '''The reviewer's read-only view on all.db (see morphSnapshot.py), mapped on first use.
+    Made from all.db if Recalc hasn't written one yet.'''
+    global _snapshot
+    if _snapshot is None:
+        from . import morphSnapshot
+        from .morphemes import MorphDb
+        path = cfg1('path_snapshot')
+        if not os.path.exists( path ):
+            morphSnapshot.write( path, _allDb or MorphDb( cfg1('path_all'), ignoreErrors=True ) )
+        _snapshot = morphSnapshot.Snapshot( path )
+    return _snapshot
+
+def closeSnapshot():
+    '''Unmaps the snapshot, eg. before Recalc replaces it'''
+    global _snapshot
+    if _snapshot is not None:
+        _snapshot.close()
+        _snapshot = None
+
 ###############################################################################
 ## Config
 ###############################################################################
@@ -35,6 +56,7 @@ def initCfg():
     from . import config
     cfgMod = config
     dbsPath = config.default['path_dbs']
+    applyCfg()
 
     # Redraw toolbar to update stats
     mw.toolbar.draw()
@@ -46,24 +68,51 @@ def initJcfg():
 
     # this ensures forward compatibility, because it adds new options in configuration without any notice
     jcfgAddMissing()
+    invalidateFilters() # new collection, new filters
+
+def applyCfg():
+    '''Pushes config.py settings into the parts of the addon that don't read cfg() themselves
+    (because they are shared with the command line tool). Call again after reloading config.py.'''
+    invalidateCfg()
+    from .util_external import configureCaches
+    from .morphemizer import setMecabPoolSize
+    configureCaches( cfg1('cache policies') )
+    setMecabPoolSize( cfg1('mecab processes') )
+    configureLog()
 
 addHook( 'profileLoaded', initCfg )
 addHook( 'profileLoaded', initJcfg )
 
 def cfg1( key, mid=None, did=None ): return cfg( mid, did, key )
 def cfg( modelId, deckId, key ):
+    return resolvedCfg( modelId, deckId )[ key ]
+
+class ResolvedCfg( dict ):
+    '''All config.py settings for one (model, deck) with the overrides applied.
+    Can be called like `partial( cfg, mid, did )`, ie. C('verb bonus').'''
+    __call__ = dict.__getitem__
+
+_resolvedCfgs = {} # Map ( Maybe ModelId, Maybe DeckId ) ResolvedCfg
+def resolvedCfg( mid=None, did=None ): # Maybe ModelId -> Maybe DeckId -> ResolvedCfg
+    try:
+        return _resolvedCfgs[ ( mid, did ) ]
+    except KeyError:
+        pass
     assert cfgMod, 'Tried to use cfgMods before profile loaded'
     profile = mw.pm.name
-    model = mw.col.models.get( modelId )[ 'name' ] if modelId else None
-    deck = mw.col.decks.get( deckId )[ 'name' ] if deckId else None
-    if key in cfgMod.deck_overrides.get( deck, [] ):
-        return cfgMod.deck_overrides[ deck ][ key ]
-    elif key in cfgMod.model_overrides.get( model, [] ):
-        return cfgMod.model_overrides[ model ][ key ]
-    elif key in cfgMod.profile_overrides.get( profile, [] ):
-        return cfgMod.profile_overrides[ profile ][ key ]
-    else:
-        return cfgMod.default[ key ]
+    model = mw.col.models.get( mid )[ 'name' ] if mid else None
+    deck = mw.col.decks.get( did )[ 'name' ] if did else None
+    # later updates take precedence: deck overrides > model overrides > profile overrides > defaults
+    C = ResolvedCfg( cfgMod.default )
+    C.update( cfgMod.profile_overrides.get( profile, {} ) )
+    C.update( cfgMod.model_overrides.get( model, {} ) )
+    C.update( cfgMod.deck_overrides.get( deck, {} ) )
+    _resolvedCfgs[ ( mid, did ) ] = C
+    return C
+
+def invalidateCfg():
+    '''Forgets resolved settings; needed after config.py is reloaded or models/decks are renamed'''
+    _resolvedCfgs.clear()
 
 def jcfg_default():
     return {
@@ -135,6 +184,8 @@ def jcfg(name):
 def jcfgUpdate(jcfg):
     original = mw.col.conf['addons']['morphman'].copy()
     mw.col.conf['addons']['morphman'].update(jcfg)
+    invalidateFilters()
+    invalidateCfg()
     if not mw.col.conf['addons']['morphman'] == original:
         mw.col.setMod()
 
@@ -148,15 +199,43 @@ def jcfgAddMissing():
     jcfgUpdate(current)
 
 
+_compiledFilters = None # [ ( Maybe ModelName, frozenset Tag, Filter ) ]
+def compiledFilters():
+    '''The 'Filter' preference with the required tags turned into sets once'''
+    global _compiledFilters
+    if _compiledFilters is None:
+        _compiledFilters = [ ( f['Type'], frozenset( f['Tags'] ), f ) for f in jcfg('Filter') ]
+    return _compiledFilters
+
+def invalidateFilters():
+    '''Has to be called whenever the 'Filter' preference may have changed'''
+    global _compiledFilters
+    from .util_external import namedCache
+    _compiledFilters = None
+    namedCache( 'filters' ).clear()
+
 def getFilter(note):
     return getFilterByTagsAndType(note.model()['name'], note.tags)
 
+def getFilterByMidAndTags(mid, tags):
+    return getFilterByTagsAndType(mw.col.models.get(mid)['name'], tags)
+
 def getFilterByTagsAndType(type, tags):
-    for f in jcfg('Filter'):
-        if f['Type'] is not None and type != f['Type']: continue
-        if not set(f['Tags']) <= set(tags): continue # required tags have to be subset of actual tags
-        return f
-    return None
+    '''First filter matching the note type and tags. Memoized per (type, tags) in the 'filters' cache.'''
+    from .util_external import namedCache
+    cache, key = namedCache( 'filters' ), ( type, frozenset( tags ) )
+    try:
+        return cache[ key ]
+    except KeyError:
+        pass
+    found = None
+    for fType, fTags, f in compiledFilters():
+        if fType is not None and type != fType: continue
+        if not fTags <= key[1]: continue # required tags have to be subset of actual tags
+        found = f
+        break
+    cache[ key ] = found
+    return found
 
 
 ###############################################################################
@@ -221,15 +300,120 @@ def infoMsg( msg ):
     showInfo( msg )
     printf( msg )
 
-def printf( msg ):
-    txt = '%s: %s' % ( datetime.datetime.now(), msg )
-    f = codecs.open( cfg1('path_log'), 'a', 'utf-8' )
-    f.write( txt+'\r\n' )
-    f.close()
-    print(txt.encode('utf-8'))
+class LogFile( logging.handlers.RotatingFileHandler ):
+    '''morphman.log, rotated by size. Writes aren't flushed one by one; LogWriter flushes whenever
+    it runs out of records. Lines end in CRLF on every platform.
+
+    The size is counted here instead of asked from the file, as RotatingFileHandler does with a
+    seek (which flushes the stream) and a stat for every record.'''
+    terminator = '\n'
+    size = 0        # bytes in the file, including what is still buffered
+    regular = True  # only regular files are rotated
+
+    def _open( self ):
+        # newline translation instead of a '\r\n' terminator, which Windows' text mode would turn into \r\r\n
+        from stat import S_ISREG
+        stream = open( self.baseFilename, self.mode, encoding=self.encoding, errors=self.errors, newline='\r\n' )
+        st = os.fstat( stream.fileno() )
+        self.size, self.regular = st.st_size, S_ISREG( st.st_mode )
+        return stream
+
+    def doRollover( self ):
+        super().doRollover()
+        if self.stream is None: self.size = 0
+
+    def encodedSize( self, msg ): # Str -> Int
+        return len( msg.encode( self.encoding or 'utf-8', self.errors or 'strict' ) ) + msg.count( '\n' ) # every \n is written as \r\n
+
+    def overflows( self, n ): # Int -> IO Bool
+        if self.stream is None:
+            self.stream = self._open()
+        return self.maxBytes > 0 and self.regular and self.size > 0 and self.size + n >= self.maxBytes
+
+    def shouldRollover( self, record ):
+        return self.overflows( self.encodedSize( self.format( record ) + self.terminator ) )
+
+    def emit( self, record ):
+        try:
+            msg = self.format( record ) + self.terminator
+            n = self.encodedSize( msg )
+            if self.overflows( n ):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write( msg )
+            self.size += n
+        except Exception:
+            self.handleError( record )
+
+class LogWriter( logging.handlers.QueueListener ):
+    '''Background thread taking the records printf queues and writing them out'''
+    def dequeue( self, block ):
+        if block and self.queue.empty():
+            for h in self.handlers: h.flush()
+        return self.queue.get( block )
+
+class LogFormatter( logging.Formatter ):
+    def formatTime( self, record, datefmt=None ):
+        return str( datetime.datetime.fromtimestamp( record.created ) )
+
+_log = None # Maybe ( Settings, Logger, LogWriter, LogFile )
+def logger(): # IO Logger
+    if _log is None:
+        configureLog()
+    return _log[1]
+
+def configureLog(): # IO ()
+    '''Sets up the 'morphman' logger from config.py, unless it already is with the same settings'''
+    global _log
+    settings = ( cfg1('path_log'), cfg1('log level'), cfg1('log max bytes'), cfg1('log backups') )
+    if _log is not None and _log[0] == settings:
+        return
+    closeLog()
+    path, level, maxBytes, backups = settings
+    fmt = LogFormatter( '%(asctime)s: %(message)s' )
+    logFile = LogFile( path, maxBytes=maxBytes or 0, backupCount=backups, encoding='utf-8', delay=True )
+    console = logging.StreamHandler( sys.stdout )
+    for h in ( logFile, console ): h.setFormatter( fmt )
+    q = queue.SimpleQueue()
+    log = logging.getLogger( 'morphman' )
+    log.handlers = [ logging.handlers.QueueHandler( q ) ]
+    log.setLevel( level )
+    log.propagate = False
+    writer = LogWriter( q, logFile, console )
+    writer.start()
+    _log = ( settings, log, writer, logFile )
+
+def flushLog(): # IO ()
+    '''Waits until everything logged so far is written'''
+    if _log is not None:
+        settings, log, writer, logFile = _log
+        writer.stop()
+        logFile.flush()
+        writer.start()
+
+def closeLog(): # IO ()
+    global _log
+    if _log is not None:
+        settings, log, writer, logFile = _log
+        writer.stop()
+        logFile.close()
+        _log = None
+atexit.register( closeLog )
+
+def printf( msg, level=logging.INFO ):
+    logger().log( level, '%s', msg )
+
+def debugf( msg, *args ):
+    '''Debug output for hot loops: `msg % args` is only computed if the 'log level' lets it through'''
+    log = logger()
+    if log.isEnabledFor( logging.DEBUG ):
+        log.debug( msg, *args )
 
 def clearLog():
-    f = codecs.open( cfg1('path_log'), 'w', 'utf-8' )
+    path = cfg1('path_log')
+    closeLog()
+    f = codecs.open( path, 'w', 'utf-8' )
     f.close()
 
 ###############################################################################
@@ -1,13 +1,18 @@
-import functools
+import functools, os, sys, threading, time
+from contextlib import contextmanager
+from collections import OrderedDict
 
 ###############################################################################
 ## Functional tools
 ###############################################################################
 class memoize(object):
-   '''Decorator that memoizes a function'''
-   def __init__(self, func):
+   '''Decorator that memoizes a function.
+
+   The results are kept in `cache`, which is a plain dict unless a BoundedCache is passed;
+   see `boundedMemoize` for caches that can be limited through the config.'''
+   def __init__(self, func, cache=None):
       self.func = func
-      self.cache = {}
+      self.cache = {} if cache is None else cache
    def __call__(self, *args):
       try:
          return self.cache[args]
@@ -23,3 +28,259 @@ class memoize(object):
    def __get__(self, obj, objtype):
       """Support instance methods"""
       return functools.partial(self.__call__, obj)
+
+def boundedMemoize(name):
+   '''Like `memoize`, but stores results in the named cache so its size can be limited by `configureCaches`.'''
+   return lambda func: memoize(func, namedCache(name))
+
+###############################################################################
+## Bounded caches
+###############################################################################
+def approxSize(o): # a -> Int
+   '''Rough number of bytes held by `o`; shared objects (like interned strings) are counted every time.'''
+   s = sys.getsizeof(o)
+   if isinstance(o, (list, tuple, set, frozenset)):
+      s += sum(approxSize(x) for x in o)
+   elif isinstance(o, dict):
+      s += sum(approxSize(k) + approxSize(v) for k, v in o.items())
+   elif hasattr(o, '__slots__'):
+      s += sum(sys.getsizeof(getattr(o, a, None)) for a in o.__slots__)
+   return s
+
+class BoundedCache(object):
+   '''Dict-like cache that evicts entries when it holds more than `maxEntries` entries or
+   more than (approximately) `maxBytes` bytes. Limits of None mean no limit.
+
+   `evict` is 'lru' (drop the least recently used entry) or 'lfu' (drop the least frequently used
+   entry, the least recently used one among equals). Hits, misses and evictions are counted.
+   Caches are shared by Recalc's worker thread and the reviewer, so changes take a lock.'''
+   def __init__(self, maxEntries=None, maxBytes=None, evict='lru'):
+      self.lock = threading.RLock()
+      self.data = {}          # Map Key (Value, Size)
+      self.order = OrderedDict()  # lru: Map Key (), least recently used first
+      self.counts = {}        # lfu: Map Key UseCount
+      self.buckets = {}       # lfu: Map UseCount (OrderedDict Key ())
+      self.minCount = 0
+      self.bytes = 0
+      self.hits = self.misses = self.evictions = 0
+      self.maxEntries, self.maxBytes, self.evict = None, None, 'lru'
+      self.configure(maxEntries, maxBytes, evict)
+
+   def configure(self, maxEntries=None, maxBytes=None, evict='lru'):
+      with self.lock:
+         self._configure(maxEntries, maxBytes, evict)
+
+   def _configure(self, maxEntries, maxBytes, evict):
+      assert evict in ('lru', 'lfu'), 'Unknown cache eviction policy: %s' % evict
+      if evict != self.evict or (maxBytes is None) != (self.maxBytes is None):
+         # rebuild the bookkeeping for the new policy
+         items = [(k, v) for k, (v, _) in self.data.items()]
+         self.maxEntries, self.maxBytes, self.evict = None, maxBytes, evict
+         self.data, self.order, self.counts, self.buckets, self.bytes = {}, OrderedDict(), {}, {}, 0
+         for k, v in items:
+            self[k] = v
+      self.maxEntries, self.maxBytes = maxEntries, maxBytes
+      self._shrink()
+
+   # bookkeeping
+   def _touch(self, key):
+      if self.evict == 'lru':
+         self.order.move_to_end(key)
+      else:
+         c = self.counts[key]
+         b = self.buckets[c]
+         del b[key]
+         if not b:
+            del self.buckets[c]
+            if self.minCount == c: self.minCount = c + 1
+         self.counts[key] = c + 1
+         self.buckets.setdefault(c + 1, OrderedDict())[key] = None
+
+   def _track(self, key):
+      if self.evict == 'lru':
+         self.order[key] = None
+      else:
+         self.counts[key] = 1
+         self.buckets.setdefault(1, OrderedDict())[key] = None
+         self.minCount = 1
+
+   def _untrack(self, key):
+      if self.evict == 'lru':
+         del self.order[key]
+      else:
+         c = self.counts.pop(key)
+         b = self.buckets[c]
+         del b[key]
+         if not b:
+            del self.buckets[c]
+            if self.minCount == c: self.minCount = min(self.buckets) if self.buckets else 0
+
+   def _victim(self):
+      if self.evict == 'lru':
+         return next(iter(self.order))
+      return next(iter(self.buckets[self.minCount]))
+
+   def _shrink(self):
+      while self.data and ((self.maxEntries is not None and len(self.data) > self.maxEntries)
+                           or (self.maxBytes is not None and self.bytes > self.maxBytes)):
+         del self[self._victim()]
+         self.evictions += 1
+
+   # dict interface
+   def __len__(self):
+      return len(self.data)
+
+   def __contains__(self, key):
+      return key in self.data
+
+   def __getitem__(self, key):
+      with self.lock:
+         try:
+            value = self.data[key][0]
+         except KeyError:
+            self.misses += 1
+            raise
+         self.hits += 1
+         self._touch(key)
+         return value
+
+   def get(self, key, default=None):
+      try:
+         return self[key]
+      except KeyError:
+         return default
+
+   def __setitem__(self, key, value):
+      size = approxSize(key) + approxSize(value) if self.maxBytes is not None else 0
+      with self.lock:
+         if key in self.data:
+            self.bytes -= self.data[key][1]
+            self._touch(key)
+         else:
+            self._track(key)
+         self.data[key] = (value, size)
+         self.bytes += size
+         self._shrink()
+
+   def __delitem__(self, key):
+      with self.lock:
+         self.bytes -= self.data.pop(key)[1]
+         self._untrack(key)
+
+   def clear(self):
+      with self.lock:
+         self.data, self.order, self.counts, self.buckets, self.minCount, self.bytes = {}, OrderedDict(), {}, {}, 0, 0
+
+   def stats(self): # Map Str Int
+      return { 'entries':len(self.data), 'bytes':self.bytes, 'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions }
+
+CACHES = {} # Map Name BoundedCache
+
+def namedCache(name): # Str -> BoundedCache
+   '''Returns the cache with the given name, creating an unbounded one if needed.'''
+   try:
+      return CACHES[name]
+   except KeyError:
+      c = CACHES[name] = BoundedCache()
+      return c
+
+def configureCaches(policies): # Map Name {'max entries':Maybe Int, 'max bytes':Maybe Int, 'evict':Str} -> m ()
+   for name, p in policies.items():
+      namedCache(name).configure(p.get('max entries'), p.get('max bytes'), p.get('evict', 'lru'))
+
+def cacheStats(): # Map Name (Map Str Int)
+   return dict((name, c.stats()) for name, c in CACHES.items())
+
+###############################################################################
+## Safe file writes
+###############################################################################
+# Files are replaced by writing a temporary file next to them and renaming it over the old one,
+# so a reader (or a crash) never sees half a file. Writers of the same file serialize on an
+# advisory lock, which the Anki add-on and the `mm` tool share.
+try:
+   import fcntl
+   def _lockFile(f):
+      fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+   def _unlockFile(f):
+      fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+except ImportError: # Windows
+   import msvcrt
+   def _lockFile(f):
+      f.seek(0)
+      while True:
+         try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1) # gives up after 10 seconds
+            return
+         except OSError:
+            continue
+   def _unlockFile(f):
+      f.seek(0)
+      msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+_fileLocks = {}   # Map FilePath [RLock, Depth, Maybe File]
+_fileLocksLock = threading.Lock()
+
+@contextmanager
+def fileLock(path): # FilePath -> IO ()
+   '''Holds the advisory lock of `path` (the file `path`.lock). Other processes block until it is
+   released; within a process the lock is reentrant and taken by one thread at a time.'''
+   lockPath = os.path.abspath(path) + '.lock'
+   with _fileLocksLock:
+      entry = _fileLocks.setdefault(lockPath, [threading.RLock(), 0, None])
+   with entry[0]:
+      if entry[1] == 0:
+         os.makedirs(os.path.dirname(lockPath), exist_ok=True)
+         f = open(lockPath, 'a+b')
+         try:
+            _lockFile(f)
+         except BaseException:
+            f.close()
+            raise
+         entry[2] = f
+      entry[1] += 1
+      try:
+         yield
+      finally:
+         entry[1] -= 1
+         if entry[1] == 0:
+            f, entry[2] = entry[2], None
+            try:
+               _unlockFile(f)
+            finally:
+               f.close()
+
+def fsyncPath(path): # FilePath -> IO ()
+   with open(path, 'rb') as f:
+      os.fsync(f.fileno())
+
+def _replace(src, dest): # FilePath -> FilePath -> IO ()
+   for i in range(20):
+      try:
+         return os.replace(src, dest)
+      except PermissionError: # Windows: a reader has `dest` open right now
+         if i == 19: raise
+         time.sleep(0.05)
+
+@contextmanager
+def atomicPath(path): # FilePath -> IO FilePath
+   '''Yields a temporary path to write the new version of `path` to. If the block ends without an
+   exception the temporary file is synced to disk and renamed over `path`; otherwise it is removed.
+   The whole block holds fileLock( path ).'''
+   par = os.path.dirname(os.path.abspath(path))
+   os.makedirs(par, exist_ok=True)
+   with fileLock(path):
+      tmp = '%s.%d.tmp' % (path, os.getpid())
+      if os.path.exists(tmp):
+         os.remove(tmp)
+      try:
+         yield tmp
+         fsyncPath(tmp)
+         _replace(tmp, path)
+      except BaseException:
+         if os.path.exists(tmp):
+            os.remove(tmp)
+         raise
+      if hasattr(os, 'O_DIRECTORY'): # make the rename itself durable
+         fd = os.open(par, os.O_RDONLY | os.O_DIRECTORY)
+         try:     os.fsync(fd)
+         finally: os.close(fd)